@@ -0,0 +1,162 @@
+"""Память на игру: прежние словари против записей со __slots__.
+
+Прогоняет одну и ту же игру (участники, фото с повторами, оценки двух
+судей, несколько раундов) через Game из botTG.py и через прежнюю модель,
+где участник и фото — словари, а каждое фото текущего раунда хранится
+дважды, и печатает, сколько памяти занимает игра по tracemalloc:
+
+    python bench_game_memory.py
+
+Прежняя модель — это не код до перехода на записи, а его приближение:
+LegacyGame наследует нынешний Game (индексы, счётчики, таблица лидеров
+те же) и заменяет только хранение участников, фото и оценок словарями.
+Поэтому экономия относится к самим записям, а не ко всему прежнему коду.
+
+Строки (file_id, ники) создаются до замера: они одинаковы в обеих моделях.
+Код выхода 1, если новая модель не экономнее прежней.
+"""
+import gc
+import sys
+import tracemalloc
+
+import botTG
+from botTG import Game
+
+# (участников, раундов)
+SIZES = [(20, 5), (100, 10), (300, 15)]
+REPEAT_EVERY = 10  # каждое десятое фото уходит на повтор и переснимается
+JUDGES = ((1, "Ведущего"), (2, "Дашуля"))
+
+class LegacyGame(Game):
+    """Приближение прежней модели данных: нынешний Game со словарями вместо записей."""
+
+    def clear_round_photos(self):
+        self.photos_this_round = {}
+        self.submitted_count = 0
+        self.repeat_count = 0
+        self.photo_counter = 0
+        self.pending_ids = {uid for uid, p in self.participants.items() if not p.get("eliminated")}
+
+    def add_participant(self, user_id, nickname, username):
+        self.participants[user_id] = {
+            "nickname": nickname,
+            "username": username,
+            "score": 0,
+            "eliminated": False,
+            "rounds_played": [],
+            "rounds_mask": 0
+        }
+        self.leaderboard.add(user_id)
+        self.pending_ids.add(user_id)
+
+    def record_photo(self, user_id, message_id, file_id, caption, thumb_file_id=None, number=None):
+        if self.photos_this_round.get(user_id) == "REPEAT":
+            self.repeat_count -= 1
+        previous = self.photos_all_rounds.get(self.current_round, {}).get(user_id)
+        if previous:
+            self.unindex_photo(previous["message_id"])
+        self.index_photo(message_id, user_id, self.current_round)
+        self.photos_this_round[user_id] = {
+            "file_id": file_id, "message_id": message_id, "caption": caption,
+            "thumb_file_id": thumb_file_id, "number": number
+        }
+        self.photos_all_rounds.setdefault(self.current_round, {})[user_id] = {
+            "file_id": file_id, "message_id": message_id, "caption": caption,
+            "thumb_file_id": thumb_file_id, "number": number
+        }
+        self.photo_counter = max(self.photo_counter, number)
+        pdata = self.participants[user_id]
+        pdata["rounds_played"].append(self.current_round)
+        pdata["rounds_mask"] |= 1 << self.current_round
+        self.submitted_count += 1
+        self.pending_ids.discard(user_id)
+
+    def archive_round(self):
+        for uid, pdata in self.photos_this_round.items():
+            if pdata == "REPEAT":
+                previous = self.photos_all_rounds.get(self.current_round, {}).get(uid)
+                if previous:
+                    self.unindex_photo(previous["message_id"])
+        self.photos_all_rounds[self.current_round] = {
+            uid: pdata for uid, pdata in self.photos_this_round.items() if isinstance(pdata, dict)
+        }
+        self.clear_round_photos()
+
+    def mark_repeat(self, user_id):
+        if isinstance(self.photos_this_round.get(user_id), dict):
+            self.submitted_count -= 1
+        self.photos_this_round[user_id] = "REPEAT"
+        self.repeat_count += 1
+        self.participants[user_id]["rounds_mask"] &= ~(1 << self.current_round)
+        self.pending_ids.add(user_id)
+
+    def apply_score(self, user_id, judge_id, judge_name, points):
+        pdata = self.participants[user_id]
+        pdata["score"] += points
+        detailed = pdata.setdefault("detailed_scores", {})
+        if judge_id in detailed:
+            detailed[judge_id]["points"] += points
+        else:
+            detailed[judge_id] = {"name": judge_name, "points": points}
+        self.leaderboard.update(user_id, pdata["score"])
+
+def inputs(players, rounds):
+    """Строки для игры: ники и file_id каждого фото (с переснятыми)."""
+    names = {uid: (f"Игрок {uid}", f"player_{uid}") for uid in range(100, 100 + players)}
+    files = {
+        (rnd, uid, take): (f"AgACAgIAAxkBAAI{rnd:04d}{uid:08d}{take}" + "x" * 50, f"AQADthumb{rnd}{uid}{take}")
+        for rnd in range(1, rounds + 1) for uid in names for take in (0, 1)
+    }
+    return names, files
+
+def play(cls, names, files, rounds):
+    """Играет игру: все присылают фото, каждое REPEAT_EVERY-е уходит на повтор, судьи ставят баллы."""
+    game = cls(botTG.MAIN_CHAT_ID, 1)
+    game.mode = "normal"
+    for uid, (nickname, username) in names.items():
+        game.add_participant(uid, nickname, username)
+    message_ids = iter(range(1, 10**9))
+    for rnd in range(1, rounds + 1):
+        if rnd > 1:
+            game.archive_round()
+            game.next_round()
+        game.reset_round()
+        for index, uid in enumerate(names):
+            file_id, thumb = files[rnd, uid, 0]
+            game.record_photo(uid, next(message_ids), file_id, None, thumb, game.next_photo_number())
+            if index % REPEAT_EVERY == 0:
+                game.mark_repeat(uid)
+                file_id, thumb = files[rnd, uid, 1]
+                game.record_photo(uid, next(message_ids), file_id, None, thumb, game.next_photo_number())
+            for judge_id, judge_name in JUDGES:
+                game.apply_score(uid, judge_id, judge_name, (uid + rnd + judge_id) % 5 - 1)
+    return game
+
+def measure(cls, names, files, rounds):
+    """Байты, занятые игрой после прогона (без строк из inputs)."""
+    gc.collect()
+    tracemalloc.start()
+    game = play(cls, names, files, rounds)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return game, size
+
+def main():
+    failed = 0
+    print(f"{'игра':<22} {'было, КБ':>10} {'стало, КБ':>10} {'на участника, Б':>18} {'экономия':>9}")
+    for players, rounds in SIZES:
+        names, files = inputs(players, rounds)
+        old_game, old = measure(LegacyGame, names, files, rounds)
+        new_game, new = measure(Game, names, files, rounds)
+        assert [old_game.participants[uid]["score"] for uid in names] == [new_game.participants[uid].score for uid in names]
+        if new >= old:
+            failed += 1
+        print(
+            f"{f'{players} × {rounds} раундов':<22} {old / 1024:>10.1f} {new / 1024:>10.1f} "
+            f"{f'{old // players} → {new // players}':>18} {1 - new / old:>9.0%}"
+        )
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Разбор ответов судьи: таблица случаев и микробенчмарк.
+
+Сравнивает JudgeCommands из botTG.py с прежней цепочкой проверок из
+reply_on_photo_handler и печатает, где поведение изменилось:
+
+    python bench_judge_commands.py
+
+Код выхода 1, если новый разбор расходится с ожидаемым в CASES.
+"""
+import sys
+import timeit
+
+import botTG
+from botTG import CMD_AUTHOR, CMD_ELIMINATE, CMD_REPEAT, CMD_SCORE, ELIMINATION_WORDS
+
+# (текст ответа, ожидаемая команда)
+CASES = [
+    ("кто автор", (CMD_AUTHOR, None)),
+    ("Автор?", (CMD_AUTHOR, None)),
+    ("  автор  ", (CMD_AUTHOR, None)),
+    ("кто   автор", (CMD_AUTHOR, None)),
+    ("автор вылет", (CMD_ELIMINATE, None)),
+    ("соавтор", None),
+    ("+5б", (CMD_SCORE, 5)),
+    ("-3б", (CMD_SCORE, -3)),
+    ("+ 10 б", (CMD_SCORE, 10)),
+    ("+5Б", (CMD_SCORE, 5)),
+    ("+5б.", (CMD_SCORE, 5)),
+    ("+5б минус свет", (CMD_SCORE, 5)),
+    ("-2б вылетает за рамку", (CMD_SCORE, -2)),
+    ("+5", None),
+    ("+5баллов", None),
+    ("+-5б", None),
+    ("5б", None),
+    ("вылет", (CMD_ELIMINATE, None)),
+    ("Вылетает!", (CMD_ELIMINATE, None)),
+    ("к сожалению, выбыла", (CMD_ELIMINATE, None)),
+    ("покидает  нас 😢", (CMD_ELIMINATE, None)),
+    ("минус", (CMD_ELIMINATE, None)),
+    ("минусовая экспозиция", None),
+    ("вылетел", (CMD_ELIMINATE, None)),
+    ("Вылетела.", (CMD_ELIMINATE, None)),
+    ("невылетная погода", None),
+    ("повтор", (CMD_REPEAT, None)),
+    ("Переделай", (CMD_REPEAT, None)),
+    ("повтор пожалуйста", None),
+    ("красиво!", None),
+    ("", None),
+]
+
+def legacy_classify(text):
+    """Прежняя цепочка проверок из reply_on_photo_handler — для сравнения."""
+    text = text.strip().lower()
+    if text in ["кто автор", "автор", "автор?"]:
+        return CMD_AUTHOR, None
+    if any(word in text for word in ELIMINATION_WORDS):
+        return CMD_ELIMINATE, None
+    if (text.startswith("+") or text.startswith("-")) and text.endswith("б"):
+        try:
+            sign = 1 if text.startswith("+") else -1
+            return CMD_SCORE, int(text[1:-1]) * sign
+        except ValueError:
+            return None
+    if text in ["повтор", "повтори", "переделай"]:
+        return CMD_REPEAT, None
+    return None
+
+def show(command):
+    if command is None:
+        return "—"
+    kind, points = command
+    return f"{kind}({points:+d})" if kind == CMD_SCORE else kind
+
+def main():
+    classify = botTG.judge_commands.classify
+    failed = 0
+    print(f"{'ответ':<26} {'было':<12} {'стало':<12}")
+    for text, expected in CASES:
+        old, new = legacy_classify(text), classify(text)
+        mark = "" if old == new else "  ← изменилось"
+        if new != expected:
+            mark += f"  ✗ ожидалось {show(expected)}"
+            failed += 1
+        print(f"{text!r:<26} {show(old):<12} {show(new):<12}{mark}")
+
+    texts = [text for text, _ in CASES]
+    number = 2000
+    for name, func in (("было", legacy_classify), ("стало", classify)):
+        seconds = min(timeit.repeat(lambda: [func(t) for t in texts], number=number, repeat=5))
+        print(f"{name}: {seconds / (number * len(texts)) * 1e9:.0f} нс на ответ")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,42 @@
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes
+    MessageHandler, TypeHandler, filters, ContextTypes, BaseRateLimiter
 )
-from telegram.error import TelegramError, BadRequest
+from telegram.error import TelegramError, BadRequest, NetworkError, RetryAfter, TimedOut
 import asyncio
+import concurrent.futures
+import bisect
+import contextlib
+import csv
+import functools
+import heapq
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import random
 import re
+import secrets
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
 from dotenv import load_dotenv
 import os
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from typing import Optional
+import httpx
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps  # необязательно: без Pillow нет поиска похожих фото и контактных листов
+except ImportError:
+    Image = None
 
 load_dotenv()
 
@@ -20,14 +46,367 @@ MAIN_CHAT_ID = os.getenv("MAIN_CHAT_ID")
 TOPIC_BLITZ_ID = os.getenv("TOPIC_BLITZ_ID")
 TOPIC_BLACK_MIRROR_ID = os.getenv("TOPIC_BLACK_MIRROR_ID")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+DB_PATH = os.getenv("DB_PATH", "couture.db")
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "1.0"))  # секунды между записями на диск
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "couture.journal")
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv("JOURNAL_SNAPSHOT_EVERY", "1000"))  # событий между снимками
+RESTORE_FROM = os.getenv("RESTORE_FROM", "sqlite")  # откуда поднимать игры после рестарта: sqlite | journal
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))  # одновременных ЛС в рассылке
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))  # повторов важной отправки при сбое сети
+SEND_BACKOFF_MAX = float(os.getenv("SEND_BACKOFF_MAX", "30"))  # потолок паузы между повторами, секунды
+CRITICAL_READ_TIMEOUT = 20  # ожидание ответа на важную отправку, секунды
+PROFILE_TTL = float(os.getenv("PROFILE_TTL", "86400"))  # сколько секунд доверяем сохранённому имени
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))  # профилей в памяти
+HOST_MENU_DEBOUNCE = float(os.getenv("HOST_MENU_DEBOUNCE", "0.3"))  # секунды, за которые правки меню склеиваются
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media")  # локальные копии фото
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_MB", "512")) * 1024 * 1024  # потолок их общего объёма
+MEDIA_FETCH_CONCURRENCY = int(os.getenv("MEDIA_FETCH_CONCURRENCY", "8"))  # одновременных загрузок миниатюр
+CONTACT_SHEET = os.getenv("CONTACT_SHEET", "1") == "1"  # контактный лист раунда в тему после остановки приёма
+SHEET_WORKERS = int(os.getenv("SHEET_WORKERS", "1"))  # процессов, рисующих контактные листы
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "4"))  # одновременных загрузок фото для архива
+EXPORT_ON_END = os.getenv("EXPORT_ON_END", "0") == "1"  # сразу присылать ведущему архив по завершении игры
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "6"))  # различающихся бит из 64, при которых фото похожи; 0 — не искать
+PHOTO_PRINTS_DAYS = float(os.getenv("PHOTO_PRINTS_DAYS", "180"))  # сколько дней помнить фото прошлых игр; 0 — всегда
+SCORE_DIGEST_SECONDS = float(os.getenv("SCORE_DIGEST_SECONDS", "60"))  # окно сводки оценок; 0 — до конца раунда
+
+# Приём апдейтов: если задан WEBHOOK_URL — вебхук, иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # X-Telegram-Bot-Api-Secret-Token, обязателен для вебхука
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных запросов от Telegram
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))  # апдейтов в очереди и в обработке до притормаживания приёма
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # апдейтов в обработке одновременно
+BOT_API_URL = os.getenv("BOT_API_URL")  # свой Bot API (локальный сервер или стенд replay_updates.py)
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")  # файл, куда писать входящие апдейты для replay_updates.py
+
+# Несколько процессов: приёмный процесс раздаёт апдейты WORKERS обработчикам, у каждого свои игры
+WORKERS = int(os.getenv("WORKERS", "0"))  # 0 — всё в одном процессе
+WORKER_SOCKET = os.getenv("WORKER_SOCKET", "couture.sock")  # unix-сокет между приёмным процессом и обработчиками
+WORKER_BACKLOG = os.getenv("WORKER_BACKLOG", "couture.backlog")  # неподтверждённые апдейты, пережидающие перезапуск
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30"))  # сколько при остановке ждать подтверждений, секунды
+WORKER_CHECKPOINT_WAIT = float(os.getenv("WORKER_CHECKPOINT_WAIT", "30"))  # сколько сброс на диск ждёт апдейтов в обработке, секунды
 
 # -------------------- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ --------------------
-games = {}  # {chat_id: GameObject}
-ELIMINATION_WORDS = ["выбыл", "выбыла", "выбывает", "минус", "вылет", "вылетает", "покидает нас"]
+ELIMINATION_WORDS = ["выбыл", "выбыла", "выбывает", "минус", "вылет", "вылетает", "вылетел", "вылетела", "покидает нас"]
+AUTHOR_WORDS = ["кто автор", "автор", "автор?"]
+REPEAT_WORDS = ["повтор", "повтори", "переделай"]
+
+# -------------------- ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ --------------------
+# Приоритеты запросов к Bot API (меньше — важнее)
+PRIORITY_HIGH = 0    # фото и сообщения в тему, правки меню ведущего
+PRIORITY_NORMAL = 1  # ответы в ЛС
+PRIORITY_BULK = 2    # массовые рассылки участникам
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 в минуту в группу, ~1/с в личный чат
+FLOOD_GLOBAL_PER_SECOND = 30
+FLOOD_GROUP_PER_MINUTE = 20
+FLOOD_PRIVATE_PER_SECOND = 1
+FLOOD_MAX_RETRIES = 3
+
+# Какие методы считаются отправкой сообщений и попадают под лимиты
+RATE_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate            # токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0    # пауза после RetryAfter
+
+    def delay(self, now):
+        """Сколько ждать до следующего токена (0 — можно отправлять)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Единая очередь всех запросов бота с глобальным и початовыми лимитами.
+
+    Запросы ждут своей очереди по приоритету: пока в группе нет свободного
+    токена, идут запросы в другие чаты, а как только освобождается
+    глобальный токен, его получает самый важный ожидающий запрос.
+    Приоритет передаётся через rate_limit_args, по умолчанию группы и правки
+    сообщений идут как PRIORITY_HIGH, личные чаты — как PRIORITY_NORMAL.
+    RetryAfter ставит чат на паузу и запрос повторяется автоматически.
+    Запросы без chat_id (правки inline-сообщений) ждут только глобальный
+    токен и не делят между собой общую «чатовую» корзину.
+    В режиме воркеров общий лимит делится поровну между обработчиками
+    (share), а токены групп выдаёт приёмный процесс (group_tokens): в
+    MAIN_CHAT_ID пишут все игры, и лимит группы у него один на всех.
+    """
+
+    def __init__(self, max_retries=FLOOD_MAX_RETRIES, share=1, group_tokens=None):
+        self.max_retries = max_retries
+        self.share = share  # процессов, делящих общий лимит бота
+        self.group_tokens = group_tokens  # RemoteGroupTokens в обработчике, иначе None
+        self._global = TokenBucket(FLOOD_GLOBAL_PER_SECOND / share, FLOOD_GLOBAL_PER_SECOND / share)
+        self._chats = {}            # {chat_id: TokenBucket}
+        self._waiting = []          # куча (приоритет, порядковый номер, chat_id или None, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def initialize(self):
+        # PTB вызывает initialize и от Application, и от Updater
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id.startswith("-"):
+                bucket = TokenBucket(FLOOD_GROUP_PER_MINUTE / 60, FLOOD_GROUP_PER_MINUTE)
+            else:
+                bucket = TokenBucket(FLOOD_PRIVATE_PER_SECOND, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            retry_in = None
+            for item in sorted(self._waiting):
+                _, _, chat_id, future = item
+                if future.done():  # запрос отменили, пока он ждал
+                    self._waiting.remove(item)
+                    continue
+                global_delay = self._global.delay(now)
+                if global_delay:
+                    retry_in = global_delay
+                    break
+                if chat_id is not None:
+                    chat_delay = self._bucket(chat_id).delay(now)
+                    if chat_delay:
+                        retry_in = chat_delay if retry_in is None else min(retry_in, chat_delay)
+                        continue
+                    self._bucket(chat_id).take()
+                self._global.take()
+                self._waiting.remove(item)
+                future.set_result(None)
+            heapq.heapify(self._waiting)
+
+            if retry_in is not None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=retry_in)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _acquire(self, priority, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), chat_id, future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(RATE_LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        chat_id = data.get("chat_id")
+        if chat_id is not None:
+            chat_id = str(chat_id)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif chat_id is None or chat_id.startswith("-") or endpoint.startswith("edit"):
+            priority = PRIORITY_HIGH
+        else:
+            priority = PRIORITY_NORMAL
+
+        remote = self.group_tokens if chat_id is not None and chat_id.startswith("-") else None
+        for attempt in range(self.max_retries + 1):
+            if remote:
+                await remote.take(chat_id, priority)  # лимит группы — в приёмном процессе
+            await self._acquire(priority, None if remote else chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                if remote:
+                    print(f"Флуд-лимит в чате {chat_id}: ждём {e.retry_after} с ({endpoint})")
+                    remote.block(chat_id, float(e.retry_after))
+                    continue
+                if chat_id is None:
+                    print(f"Флуд-лимит бота: ждём {e.retry_after} с ({endpoint})")
+                    self._global.block(time.monotonic() + float(e.retry_after))
+                    continue
+                print(f"Флуд-лимит в чате {chat_id}: ждём {e.retry_after} с ({endpoint})")
+                self._bucket(chat_id).block(time.monotonic() + float(e.retry_after))
+
+# -------------------- ТАБЛИЦА ЛИДЕРОВ --------------------
+class Leaderboard:
+    """Баллы участников с плотной нумерацией мест (одинаковые баллы — одно место).
+
+    Различные значения баллов хранятся отсортированным списком, поэтому место
+    игрока, победитель и верх таблицы находятся двоичным поиском без
+    пересортировки. Изменение баллов — O(1), если новое значение уже есть у
+    кого-то и старое остаётся у кого-то ещё; иначе вставка или удаление
+    значения в списке — O(k), а не O(log k): сдвигается до k элементов, где
+    k — число различных баллов, а не игроков (обычно десятки). Это
+    сознательный компромисс: сбалансированного дерева в стандартной
+    библиотеке нет, а сдвиг десятков чисел — один memmove. Баллы, которые
+    делят несколько игроков, хранятся отдельным множеством: общие места
+    находятся без обхода всей таблицы.
+    """
+
+    def __init__(self):
+        self.scores = {}    # {user_id: баллы}
+        self.buckets = {}   # {баллы: {user_id, ...}}
+        self.levels = []    # различные баллы по возрастанию
+        self.tied = set()   # баллы, которые есть больше чем у одного игрока
+
+    def _put(self, user_id, score):
+        self.scores[user_id] = score
+        bucket = self.buckets.get(score)
+        if bucket is None:
+            bucket = self.buckets[score] = set()
+            bisect.insort(self.levels, score)
+        bucket.add(user_id)
+        if len(bucket) == 2:
+            self.tied.add(score)
+
+    def _take(self, user_id):
+        score = self.scores.pop(user_id)
+        bucket = self.buckets[score]
+        bucket.discard(user_id)
+        if len(bucket) == 1:
+            self.tied.discard(score)
+        if not bucket:
+            del self.buckets[score]
+            del self.levels[bisect.bisect_left(self.levels, score)]
+
+    def add(self, user_id, score=0):
+        if user_id in self.scores:
+            self._take(user_id)
+        self._put(user_id, score)
+
+    def update(self, user_id, score):
+        if self.scores.get(user_id) != score:
+            self.add(user_id, score)
+
+    def rank(self, user_id):
+        """Место игрока (1 — лучший) или None, если его нет в таблице."""
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return self._place(score)
+
+    def _place(self, score):
+        return len(self.levels) - bisect.bisect_left(self.levels, score)
+
+    def top_score(self):
+        return self.levels[-1] if self.levels else None
+
+    def winners(self):
+        top = self.top_score()
+        return set(self.buckets[top]) if top is not None else set()
+
+    def places(self, limit=None):
+        """Места сверху вниз: (место, баллы, {user_id, ...})."""
+        levels = self.levels if limit is None else self.levels[-limit:]
+        for offset, score in enumerate(reversed(levels)):
+            yield offset + 1, score, self.buckets[score]
+
+    def tied_places(self):
+        """Места, которые делят несколько игроков, по возрастанию: O(log k) на каждое."""
+        return sorted(self._place(score) for score in self.tied)
 
 # -------------------- КЛАСС ИГРЫ --------------------
+PHOTO_ACCEPTED, PHOTO_REPEAT = "accepted", "repeat"  # статус фото в раунде (как в таблице photos)
+
+class SlotRecord:
+    """Основа компактных записей: поля перечислены в __slots__, у экземпляров нет __dict__."""
+    __slots__ = ()
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in self.as_dict().items())
+        return f"{type(self).__name__}({fields})"
+
+class ScoreEntry(SlotRecord):
+    """Сколько баллов один судья дал участнику за игру."""
+    __slots__ = ("name", "points")
+
+    def __init__(self, name: str, points: int = 0):
+        self.name = name
+        self.points = points
+
+class Participant(SlotRecord):
+    __slots__ = ("nickname", "username", "score", "eliminated", "round_out", "rounds_mask", "detailed_scores")
+
+    def __init__(
+        self, nickname: str, username: Optional[str], score: int = 0, eliminated: bool = False,
+        round_out: Optional[int] = None, rounds_mask: int = 0
+    ):
+        self.nickname = nickname
+        self.username = username
+        self.score = score
+        self.eliminated = eliminated
+        self.round_out = round_out
+        self.rounds_mask = rounds_mask  # бит N = прислал фото в раунде N
+        self.detailed_scores = {}       # {judge_id: ScoreEntry}
+
+    @property
+    def rounds_played(self):
+        """Раунды с принятым фото по возрастанию — без повторов, в отличие от прежнего списка."""
+        return [rnd for rnd in range(self.rounds_mask.bit_length()) if self.rounds_mask >> rnd & 1]
+
+class PhotoRecord(SlotRecord):
+    """Фото участника в раунде. Запись одна: на неё ссылаются и photos_this_round, и photos_all_rounds."""
+    __slots__ = ("file_id", "message_id", "caption", "thumb_file_id", "number", "status")
+
+    def __init__(
+        self, file_id: Optional[str], message_id: Optional[int], caption: Optional[str] = None,
+        thumb_file_id: Optional[str] = None, number: Optional[int] = None, status: str = PHOTO_ACCEPTED
+    ):
+        self.file_id = file_id
+        self.message_id = message_id  # None — ещё не выложено в тему (показ альбомами)
+        self.caption = caption
+        self.thumb_file_id = thumb_file_id
+        self.number = number          # "Фото #N" в теме
+        self.status = status
+
+# Поля Game, которые сохраняются как есть (настройки и состояние раунда)
+GAME_STATE_FIELDS = (
+    "mode", "ref_mode", "current_ref_sent", "show_eliminated_nicks", "can_join_late",
+    "skip_allowed", "show_nicks", "participant_limit", "current_round", "round_active",
+    "last_round_message_id", "host_menu_message_id", "photo_reception_active", "co_host_username",
+    "reveal_mode", "deliveries", "co_host_id",
+)
+
 class Game:
     def __init__(self, chat_id, host_id):
+        self.game_id = secrets.token_hex(4)
         self.chat_id = chat_id
         self.host_id = host_id
         self.topic_id = None
@@ -38,24 +417,1524 @@ class Game:
         self.can_join_late = False
         self.skip_allowed = True
         self.show_nicks = True
+        self.reveal_mode = False  # фото раунда публикуются альбомами после остановки приёма
         self.participant_limit = None
-        self.participants = {}
+        self.participants = {}           # {user_id: Participant}
+        self.leaderboard = Leaderboard()
         self.current_round = 1
         self.round_active = False
-        self.photos_this_round = {}      # данные текущего раунда
-        self.photos_all_rounds = {}      # все раунды
+        self.photos_this_round = {}      # {user_id: PhotoRecord} текущего раунда
+        self.submitted_count = 0         # принятых фото в раунде (без повторов)
+        self.repeat_count = 0            # фото на повторе
+        self.pending_ids = set()         # активные участники без принятого фото
+        self.photos_all_rounds = {}      # {раунд: {user_id: PhotoRecord}} — те же записи, что в photos_this_round
+        self.photo_counter = 0           # последний номер "Фото #N" в раунде
+        self.photo_index = {}            # {message_id в теме: (user_id, раунд)}
+        self.deliveries = {}             # {ключ идемпотентности: message_id} для важных отправок
         self.last_round_message_id = None
         self.host_menu_message_id = None
         self.photo_reception_active = True
         self.co_host_username = None  # Юзернейм второго судьи
+        self.co_host_id = None  # id второго судьи, как только он известен
         self.waiting_for_cohost_input = False # Флаг, что бот ждет ввода ника
+        self.started = False
+        self.finished = False
+        self.journal = None  # GameJournal, куда пишутся изменения запущенной игры
+
+    def state(self):
+        return {field: getattr(self, field) for field in GAME_STATE_FIELDS}
+
+    def emit(self, kind, **data):
+        if self.journal:
+            self.journal.append(self.game_id, kind, data)
+
+    def set(self, **fields):
+        """Меняет простые поля игры (флаги, id сообщений) с записью в журнал."""
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self.emit("set", **fields)
 
     def reset_round(self):
         self.round_active = True
         self.photo_reception_active = True
+        self.clear_round_photos()
+        self.emit("round_start")
+
+    def next_round(self):
+        self.current_round += 1
+        self.current_ref_sent = False
+        self.photo_reception_active = True
+        self.host_menu_message_id = None
+        self.emit("next_round")
+
+    def finish(self):
+        self.round_active = False
+        self.finished = True
+        self.emit("end")
+
+    def clear_round_photos(self):
+        """Очищает фото текущего раунда: все активные участники снова ждут отправки."""
         self.photos_this_round = {}
+        self.submitted_count = 0
+        self.repeat_count = 0
+        self.photo_counter = 0
+        self.pending_ids = {uid for uid, p in self.participants.items() if not p.eliminated}
+
+    @property
+    def pending_count(self):
+        return len(self.pending_ids)
+
+    def add_participant(self, user_id, nickname, username):
+        self.participants[user_id] = Participant(nickname, username)
+        self.leaderboard.add(user_id)
+        self.pending_ids.add(user_id)
+        self.emit("join", uid=user_id, nickname=nickname, username=username)
+
+    def next_photo_number(self):
+        """Номер для следующего "Фото #N"; номера фото, ушедших на повтор, не переиспользуются."""
+        return self.photo_counter + 1
+
+    def record_photo(self, user_id, message_id, file_id, caption, thumb_file_id=None, number=None):
+        """Принимает фото участника в текущем раунде (number — номер в теме, если фото уже выложено)."""
+        status = self.photos_this_round.get(user_id)
+        if status and status.status == PHOTO_REPEAT:
+            self.repeat_count -= 1
+
+        # Фото, отправленное до "повтора", больше не участвует в раунде
+        previous = self.photos_all_rounds.get(self.current_round, {}).get(user_id)
+        if previous:
+            self.unindex_photo(previous.message_id)
+        if message_id is not None:
+            self.index_photo(message_id, user_id, self.current_round)
+
+        record = PhotoRecord(file_id, message_id, caption, thumb_file_id, number)
+        self.photos_this_round[user_id] = record
+        self.photos_all_rounds.setdefault(self.current_round, {})[user_id] = record
+        if number:
+            self.photo_counter = max(self.photo_counter, number)
+        self.participants[user_id].rounds_mask |= 1 << self.current_round
+        self.submitted_count += 1
+        self.pending_ids.discard(user_id)
+        self.emit(
+            "photo", uid=user_id, message_id=message_id, file_id=file_id, caption=caption,
+            thumb_file_id=thumb_file_id, number=number
+        )
+
+    def unpublished(self):
+        """Принятые, но ещё не выложенные в тему фото текущего раунда (режим показа альбомами)."""
+        return [
+            uid for uid, record in self.photos_this_round.items()
+            if record.status == PHOTO_ACCEPTED and record.message_id is None
+            and f"photo:{self.current_round}:{uid}" not in self.deliveries  # ушло в тему без ответа Telegram
+        ]
+
+    def number_photos(self, user_ids):
+        """Раздаёт придержанным фото номера в порядке показа."""
+        for user_id in user_ids:
+            self.photo_counter += 1
+            self.photos_this_round[user_id].number = self.photo_counter
+        self.emit("number", uids=list(user_ids))
+
+    def publish_photo(self, user_id, message_id, number=None):
+        """Запоминает, под каким message_id и номером фото участника выложено в тему."""
+        record = self.photos_all_rounds.get(self.current_round, {}).get(user_id)
+        if record:
+            record.message_id = message_id
+            record.number = number
+        if number:
+            self.photo_counter = max(self.photo_counter, number)
+        self.index_photo(message_id, user_id, self.current_round)
+        self.emit("publish", uid=user_id, message_id=message_id, number=number)
+
+    def archive_round(self):
+        """Переносит фото текущего раунда в общее хранилище и очищает раунд."""
+        # Фото, ушедшие на повтор и не переснятые, выпадают из раунда
+        for record in self.photos_this_round.values():
+            if record.status == PHOTO_REPEAT:
+                self.unindex_photo(record.message_id)
+
+        self.photos_all_rounds[self.current_round] = {
+            uid: record for uid, record in self.photos_this_round.items() if record.status == PHOTO_ACCEPTED
+        }
+        # Ключи отправок раунда ("photo:", "round:", ...) больше не понадобятся, а снимок игры пишется часто
+        self.deliveries = {
+            key: message_id for key, message_id in self.deliveries.items()
+            if key.startswith("results:") or int(key.split(":")[1]) > self.current_round
+        }
+        self.clear_round_photos()
+        self.emit("archive")
+
+    def record_delivery(self, key, message_id):
+        """Запоминает, что отправка с ключом key уже дошла до темы."""
+        self.deliveries[key] = message_id
+        self.emit("delivery", key=key, message_id=message_id)
+
+    def mark_repeat(self, user_id):
+        """Отправляет фото участника на повтор: он снова должен прислать фото."""
+        record = self.photos_this_round.get(user_id)
+        if record and record.status == PHOTO_REPEAT:
+            return
+        if record:
+            self.submitted_count -= 1
+            record.status = PHOTO_REPEAT
+        else:
+            self.photos_this_round[user_id] = PhotoRecord(None, None, status=PHOTO_REPEAT)
+        self.repeat_count += 1
+        self.deliveries.pop(f"photo:{self.current_round}:{user_id}", None)
+        pdata = self.participants[user_id]
+        pdata.rounds_mask &= ~(1 << self.current_round)
+        if not pdata.eliminated:
+            self.pending_ids.add(user_id)
+        self.emit("repeat", uid=user_id)
+
+    def apply_score(self, user_id, judge_id, judge_name, points):
+        """Начисляет (или снимает) баллы и записывает, какой судья их дал."""
+        pdata = self.participants[user_id]
+        pdata.score += points
+        entry = pdata.detailed_scores.get(judge_id)
+        if entry is None:
+            entry = pdata.detailed_scores[judge_id] = ScoreEntry(judge_name)
+        entry.points += points
+        self.leaderboard.update(user_id, pdata.score)
+        self.emit("score", uid=user_id, judge=judge_id, name=judge_name, points=points)
+
+    def ranked_participants(self):
+        """Участники в порядке итоговой таблицы: по баллам, внутри места — активные выше."""
+        for _, _, uids in self.leaderboard.places():
+            yield from sorted(
+                uids,
+                key=lambda uid: -(self.participants[uid].round_out or 0),
+                reverse=True
+            )
+
+    def submitted_in(self, user_id, round_num):
+        return bool(self.participants[user_id].rounds_mask >> round_num & 1)
+
+    def eliminate(self, user_id, round_out):
+        pdata = self.participants[user_id]
+        pdata.eliminated = True
+        pdata.round_out = round_out
+        self.pending_ids.discard(user_id)
+        self.emit("eliminate", uid=user_id, round_out=round_out)
+
+    def rebuild_derived(self):
+        """Пересобирает индекс фото, счётчики раунда и таблицу лидеров из основных данных."""
+        self.photo_index = {}
+        for rnd, photos in self.photos_all_rounds.items():
+            for uid, record in photos.items():
+                if record.message_id is not None:
+                    self.index_photo(record.message_id, uid, rnd)
+
+        self.leaderboard = Leaderboard()
+        for uid, pdata in self.participants.items():
+            self.leaderboard.add(uid, pdata.score)
+
+        self.photo_counter = max(
+            (record.number or 0 for record in self.photos_all_rounds.get(self.current_round, {}).values()),
+            default=0
+        )
+
+        accepted = {uid for uid, record in self.photos_this_round.items() if record.status == PHOTO_ACCEPTED}
+        self.submitted_count = len(accepted)
+        self.repeat_count = len(self.photos_this_round) - self.submitted_count
+        self.pending_ids = {
+            uid for uid, pdata in self.participants.items()
+            if not pdata.eliminated and uid not in accepted
+        }
+
+    def index_photo(self, message_id, user_id, round_num):
+        """Запоминает, чьё фото лежит в теме под этим message_id."""
+        self.photo_index[message_id] = (user_id, round_num)
+
+    def unindex_photo(self, message_id):
+        self.photo_index.pop(message_id, None)
+
+    def find_photo(self, message_id):
+        """Возвращает (user_id, раунд) по message_id фото в теме или (None, None)."""
+        return self.photo_index.get(message_id, (None, None))
+
+# -------------------- РЕЕСТР ИГР --------------------
+def topic_key(chat_id, topic_id):
+    """Ключ ветки: id из .env приходят строками, из апдейтов — числами."""
+    return (
+        int(chat_id) if chat_id is not None else None,
+        int(topic_id) if topic_id is not None else None,
+    )
+
+class GameRegistry:
+    """Все игры бота с индексами по ведущему, ветке и участнику."""
+
+    def __init__(self):
+        self.by_id = {}           # {game_id: Game}
+        self.by_host = {}         # {host_id: Game} — и черновики, и запущенные
+        self.by_topic = {}        # {(chat_id, topic_id): Game} — только запущенные
+        self.by_participant = {}  # {user_id: Game}
+        self.remote_topics = set()  # ветки, занятые играми других обработчиков (режим воркеров)
+        self.listener = None        # listener(действие, вид, ключ) — так о маршрутах узнаёт приёмный процесс
+
+    def _notify(self, action, kind, key):
+        if self.listener:
+            self.listener(action, kind, key)
+
+    def add(self, game):
+        self.by_id[game.game_id] = game
+        self.by_host[game.host_id] = game
+        self._notify("add", "game", game.game_id)
+        self._notify("add", "host", game.host_id)
+
+    def for_host(self, host_id):
+        return self.by_host.get(host_id)
+
+    def for_topic(self, chat_id, topic_id):
+        return self.by_topic.get(topic_key(chat_id, topic_id))
+
+    def for_participant(self, user_id):
+        return self.by_participant.get(user_id)
+
+    def start(self, game):
+        """Занимает ветку игры. Возвращает False, если в ней уже идёт другая игра."""
+        key = topic_key(game.chat_id, game.topic_id)
+        if self.by_topic.get(key, game) is not game or key in self.remote_topics:
+            return False
+        self.by_topic[key] = game
+        game.started = True
+        self._notify("add", "topic", key)
+        return True
+
+    def add_participant(self, game, user_id):
+        self.by_participant[user_id] = game
+        self._notify("add", "player", user_id)
+
+    def running(self):
+        return list(self.by_topic.values())
+
+    def running_topics(self):
+        """Ветки всех идущих игр, в том числе у других обработчиков."""
+        return sorted({topic for _, topic in self.by_topic} | {topic for _, topic in self.remote_topics})
+
+    def remove(self, game):
+        self.by_id.pop(game.game_id, None)
+        self._notify("drop", "game", game.game_id)
+        if self.by_host.get(game.host_id) is game:
+            del self.by_host[game.host_id]
+            self._notify("drop", "host", game.host_id)
+        key = topic_key(game.chat_id, game.topic_id)
+        if self.by_topic.get(key) is game:
+            del self.by_topic[key]
+            self._notify("drop", "topic", key)
+        for uid in game.participants:
+            if self.by_participant.get(uid) is game:
+                del self.by_participant[uid]
+                self._notify("drop", "player", uid)
+
+games = GameRegistry()
+
+# -------------------- ХРАНИЛИЩЕ (SQLite) --------------------
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY,
+    host_id INTEGER NOT NULL,
+    chat_id TEXT,
+    topic_id TEXT,
+    finished INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS participants (
+    game_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    nickname TEXT,
+    username TEXT,
+    score INTEGER NOT NULL,
+    eliminated INTEGER NOT NULL,
+    round_out INTEGER,
+    rounds_mask TEXT NOT NULL,
+    rounds_played TEXT NOT NULL,
+    PRIMARY KEY (game_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS photos (
+    game_id TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    message_id INTEGER,
+    file_id TEXT,
+    caption TEXT,
+    status TEXT NOT NULL,
+    number INTEGER,
+    thumb_file_id TEXT,
+    PRIMARY KEY (game_id, round, user_id)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    game_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    judge_id INTEGER NOT NULL,
+    judge_name TEXT,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (game_id, user_id, judge_id)
+);
+CREATE INDEX IF NOT EXISTS games_running ON games (finished);
+CREATE TABLE IF NOT EXISTS photo_prints (
+    file_unique_id TEXT PRIMARY KEY,
+    game_id TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    thumb_file_id TEXT,
+    dhash TEXT
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    job_id TEXT PRIMARY KEY,
+    game_id TEXT,
+    host_id INTEGER,
+    title TEXT NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0,
+    worker INTEGER
+);
+CREATE TABLE IF NOT EXISTS broadcast_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE TABLE IF NOT EXISTS worker_updates (
+    worker INTEGER PRIMARY KEY,
+    upto INTEGER NOT NULL,
+    above TEXT NOT NULL
+);
+"""
+
+class GameStore:
+    """Состояние запущенных игр в SQLite (WAL).
+
+    Хендлеры только помечают игру изменённой через save(); раз в
+    DB_FLUSH_INTERVAL секунд все изменённые игры пишутся одной транзакцией
+    в отдельном потоке, так что обработка апдейтов диска не ждёт.
+    Фото прошлых раундов больше не меняются и пишутся один раз.
+    В режиме воркеров в той же транзакции пишется, какие апдейты
+    обработчик уже применил, — повтор после падения не применится дважды.
+    """
+
+    def __init__(self, path, flush_interval=DB_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conn = None
+        self._dirty = {}          # {game_id: Game}
+        self._dirty_jobs = {}     # {job_id: BroadcastJob}
+        self._dirty_prints = {}   # {file_unique_id: строка photo_prints}
+        self._applied = None      # строка worker_updates, ещё не записанная
+        self._archived_upto = {}  # {game_id: последний раунд, чьи фото уже на диске}
+        self._prints_rowid = 0    # последняя прочитанная строка photo_prints
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(DB_SCHEMA)
+        # Базы, созданные до появления номеров и миниатюр фото
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(photos)")}
+        for column, kind in (("number", "INTEGER"), ("thumb_file_id", "TEXT")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE photos ADD COLUMN {column} {kind}")
+        # ...и до режима воркеров: рассылку досылает только создавший её обработчик
+        if "worker" not in {row[1] for row in self.conn.execute("PRAGMA table_info(broadcasts)")}:
+            self.conn.execute("ALTER TABLE broadcasts ADD COLUMN worker INTEGER")
+        # Законченные рассылки раньше оставались в базе целиком
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM broadcast_items WHERE job_id IN (SELECT job_id FROM broadcasts WHERE finished = 1)"
+            )
+            self.conn.execute("DELETE FROM broadcasts WHERE finished = 1")
+
+    def save(self, game):
+        if game.started:
+            self._dirty[game.game_id] = game
+
+    def save_broadcast(self, job):
+        self._dirty_jobs[job.job_id] = job
+
+    def save_print(self, row):
+        self._dirty_prints[row[0]] = row
+
+    def save_applied(self, worker, applied):
+        """Запоминает применённые обработчиком апдейты (AppliedUpdates) вместе со следующим сбросом игр."""
+        self._applied = (worker, applied.upto, json.dumps(sorted(applied.above)))
+
+    # ---- запись ----
+    def _dump(self, game):
+        """Снимок игры в строки таблиц. Вызывается в потоке event loop, пока игра не меняется."""
+        game_row = (
+            game.game_id, game.host_id, str(game.chat_id), str(game.topic_id),
+            int(game.finished), json.dumps(game.state()), time.time()
+        )
+
+        participant_rows = []
+        score_rows = []
+        for uid, p in game.participants.items():
+            participant_rows.append((
+                game.game_id, uid, p.nickname, p.username, p.score,
+                int(p.eliminated), p.round_out, str(p.rounds_mask),
+                json.dumps(p.rounds_played)
+            ))
+            for judge_id, entry in p.detailed_scores.items():
+                score_rows.append((game.game_id, uid, judge_id, entry.name, entry.points))
+
+        # Прошлые раунды пишем один раз, текущий — целиком при каждом сбросе
+        archived_upto = self._archived_upto.get(game.game_id, 0)
+        photo_rows = []
+        for rnd, photos in game.photos_all_rounds.items():
+            if rnd <= archived_upto:
+                continue
+            for uid, record in photos.items():
+                photo_rows.append((
+                    game.game_id, rnd, uid, record.message_id, record.file_id, record.caption, record.status,
+                    record.number, record.thumb_file_id
+                ))
+        # Повтор без фото в photos_all_rounds (участник ещё не прислал замену)
+        current = game.photos_all_rounds.get(game.current_round, {})
+        for uid, record in game.photos_this_round.items():
+            if current.get(uid) is not record:
+                photo_rows.append((game.game_id, game.current_round, uid, None, None, None, record.status, None, None))
+
+        self._archived_upto[game.game_id] = max(archived_upto, game.current_round - 1)
+        return game_row, participant_rows, score_rows, photo_rows, archived_upto
+
+    def _write(self, dumps, job_dumps=(), print_rows=(), applied=None):
+        with self.conn:
+            if applied:
+                self.conn.execute("INSERT OR REPLACE INTO worker_updates VALUES (?, ?, ?)", applied)
+            self.conn.executemany("INSERT OR REPLACE INTO photo_prints VALUES (?, ?, ?, ?, ?, ?)", print_rows)
+            for job_row, item_rows in job_dumps:
+                if job_row[4]:  # рассылка закончена — досылать нечего, строки не нужны
+                    self.conn.execute("DELETE FROM broadcast_items WHERE job_id = ?", job_row[:1])
+                    self.conn.execute("DELETE FROM broadcasts WHERE job_id = ?", job_row[:1])
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO broadcasts (job_id, game_id, host_id, title, finished, worker)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", job_row
+                )
+                self.conn.executemany("INSERT OR REPLACE INTO broadcast_items VALUES (?, ?, ?, ?, ?)", item_rows)
+            for game_row, participant_rows, score_rows, photo_rows, archived_upto in dumps:
+                game_id = game_row[0]
+                self.conn.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?)", game_row)
+                self.conn.executemany("INSERT OR REPLACE INTO participants VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", participant_rows)
+                self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", score_rows)
+                self.conn.execute("DELETE FROM photos WHERE game_id = ? AND round > ?", (game_id, archived_upto))
+                self.conn.executemany("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", photo_rows)
+
+    async def flush(self):
+        """Пишет изменённое на диск; False — запись не удалась и повторится на следующем сбросе."""
+        async with self._flush_lock:
+            if not self._dirty and not self._dirty_jobs and not self._dirty_prints and not self._applied:
+                return True
+            dirty, self._dirty = self._dirty, {}
+            dirty_jobs, self._dirty_jobs = self._dirty_jobs, {}
+            dirty_prints, self._dirty_prints = self._dirty_prints, {}
+            applied, self._applied = self._applied, None
+            dumps = [self._dump(game) for game in dirty.values()]
+            job_dumps = [job.dump() for job in dirty_jobs.values()]
+            try:
+                await asyncio.to_thread(self._write, dumps, job_dumps, list(dirty_prints.values()), applied)
+            except sqlite3.Error as e:
+                print(f"Ошибка записи игр в базу: {e}")
+                if self._applied is None:
+                    self._applied = applied
+                # Вернём игры в очередь и повторим на следующем сбросе
+                for game_id, game in dirty.items():
+                    self._dirty.setdefault(game_id, game)
+                    self._archived_upto.pop(game_id, None)
+                for job_id, job in dirty_jobs.items():
+                    self._dirty_jobs.setdefault(job_id, job)
+                for unique_id, row in dirty_prints.items():
+                    self._dirty_prints.setdefault(unique_id, row)
+                return False
+            return True
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+        self.conn.close()
+
+    # ---- загрузка ----
+    def load_running(self):
+        """Восстанавливает незавершённые игры вместе с индексами и счётчиками."""
+        restored = self._load("finished = 0")
+        for game in restored:
+            self._archived_upto[game.game_id] = game.current_round - 1
+        return restored
+
+    def load_game(self, game_id):
+        """Любая игра из базы, в том числе завершённая, или None."""
+        loaded = self._load("game_id = ?", (game_id,))
+        return loaded[0] if loaded else None
+
+    def last_game_id(self, host_id):
+        row = self.conn.execute(
+            "SELECT game_id FROM games WHERE host_id = ? ORDER BY updated_at DESC LIMIT 1", (host_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _host_game(self, host_id, game_id):
+        game_id = game_id or self.last_game_id(host_id)
+        return self.load_game(game_id) if game_id else None
+
+    async def load_host_game(self, host_id, game_id=None):
+        """Игра game_id (по умолчанию — последняя игра ведущего host_id) из базы, не занимая event loop."""
+        async with self._flush_lock:  # соединение не делим с потоком записи
+            return await asyncio.to_thread(self._host_game, host_id, game_id)
+
+    def _load(self, where, params=()):
+        loaded = {}
+        for game_id, host_id, chat_id, topic_id, finished, state in self.conn.execute(
+            f"SELECT game_id, host_id, chat_id, topic_id, finished, state FROM games WHERE {where}", params
+        ):
+            game = Game(chat_id, host_id)
+            game.game_id = game_id
+            game.topic_id = None if topic_id == "None" else topic_id
+            for field, value in json.loads(state).items():
+                setattr(game, field, value)
+            game.started = True
+            game.finished = bool(finished)
+            loaded[game_id] = game
+
+        if not loaded:
+            return []
+        marks = ",".join("?" * len(loaded))
+        ids = list(loaded)
+
+        for game_id, uid, nickname, username, score, eliminated, round_out, mask, played in self.conn.execute(
+            f"SELECT * FROM participants WHERE game_id IN ({marks})", ids
+        ):
+            # rounds_played пишется для совместимости, при загрузке хватает rounds_mask
+            loaded[game_id].participants[uid] = Participant(
+                nickname, username, score, bool(eliminated), round_out, int(mask)
+            )
+
+        for game_id, uid, judge_id, judge_name, points in self.conn.execute(
+            f"SELECT * FROM scores WHERE game_id IN ({marks})", ids
+        ):
+            loaded[game_id].participants[uid].detailed_scores[judge_id] = ScoreEntry(judge_name, points)
+
+        for game_id, rnd, uid, message_id, file_id, caption, status, number, thumb_file_id in self.conn.execute(
+            f"SELECT game_id, round, user_id, message_id, file_id, caption, status, number, thumb_file_id"
+            f" FROM photos WHERE game_id IN ({marks})", ids
+        ):
+            game = loaded[game_id]
+            if game.finished and status == PHOTO_REPEAT:
+                continue  # ушло на повтор в последнем раунде и в итоги не попало
+            record = PhotoRecord(file_id, message_id, caption, thumb_file_id, number, status)
+            if file_id is not None:
+                game.photos_all_rounds.setdefault(rnd, {})[uid] = record
+            if rnd == game.current_round and game.round_active:
+                game.photos_this_round[uid] = record
+
+        for game in loaded.values():
+            game.rebuild_derived()
+        return list(loaded.values())
+
+    def load_prints(self):
+        """Отпечатки фото из игр последних PHOTO_PRINTS_DAYS дней; более старые удаляются."""
+        self._prints_rowid = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM photo_prints").fetchone()[0]
+        if not PHOTO_PRINTS_DAYS:
+            return self.conn.execute("SELECT * FROM photo_prints").fetchall()
+        recent = "SELECT game_id FROM games WHERE updated_at >= ?"
+        cutoff = time.time() - PHOTO_PRINTS_DAYS * 86400
+        with self.conn:
+            self.conn.execute(f"DELETE FROM photo_prints WHERE game_id NOT IN ({recent})", (cutoff,))
+        return self.conn.execute(f"SELECT * FROM photo_prints WHERE game_id IN ({recent})", (cutoff,)).fetchall()
+
+    def _new_prints(self):
+        rows = self.conn.execute(
+            "SELECT rowid, * FROM photo_prints WHERE rowid > ? ORDER BY rowid", (self._prints_rowid,)
+        ).fetchall()
+        if rows:
+            self._prints_rowid = rows[-1][0]
+        return [row[1:] for row in rows]
+
+    async def load_new_prints(self):
+        """Отпечатки, записанные в базу после прошлого чтения (в режиме воркеров — и соседями)."""
+        async with self._flush_lock:  # соединение не делим с потоком записи
+            return await asyncio.to_thread(self._new_prints)
+
+    def load_applied(self, worker):
+        """AppliedUpdates обработчика worker по базе: что он успел применить до перезапуска."""
+        row = self.conn.execute("SELECT upto, above FROM worker_updates WHERE worker = ?", (worker,)).fetchone()
+        return AppliedUpdates(row[0], json.loads(row[1])) if row else AppliedUpdates()
+
+    def load_broadcasts(self, worker=None):
+        """Недоставленные рассылки, прерванные перезапуском; worker — только созданные этим обработчиком."""
+        jobs = {}
+        where, params = "finished = 0", ()
+        if worker is not None:
+            where += " AND COALESCE(worker, 0) = ?"  # рассылки, начатые до режима воркеров, — нулевому
+            params = (worker,)
+        for job_id, game_id, host_id, title in self.conn.execute(
+            f"SELECT job_id, game_id, host_id, title FROM broadcasts WHERE {where}", params
+        ):
+            jobs[job_id] = BroadcastJob(title, [], host_id=host_id, game_id=game_id, job_id=job_id)
+        for job_id, chat_id, payload, status in self.conn.execute(
+            "SELECT job_id, chat_id, payload, status FROM broadcast_items"
+            f" WHERE job_id IN (SELECT job_id FROM broadcasts WHERE {where}) ORDER BY job_id, idx", params
+        ):
+            jobs[job_id].items.append([chat_id, json.loads(payload), status])
+        return list(jobs.values())
+
+store = GameStore(DB_PATH)
+
+# -------------------- ЖУРНАЛ СОБЫТИЙ --------------------
+SNAPSHOT_VERSION = 2  # 2 — записи фото текущего раунда хранятся один раз
+
+def game_to_dict(game):
+    """Полный снимок игры для JSON (ключи-числа сохраняем парами, а не ключами объекта).
+
+    Фото текущего раунда, которое уже есть в photos_all_rounds, в
+    photos_this_round записывается как None — ссылкой на ту же запись.
+    """
+    current = game.photos_all_rounds.get(game.current_round, {})
+    return {
+        "game_id": game.game_id,
+        "host_id": game.host_id,
+        "chat_id": game.chat_id,
+        "topic_id": game.topic_id,
+        "finished": game.finished,
+        "state": game.state(),
+        "participants": [
+            [uid, dict(pdata.as_dict(), detailed_scores=[
+                [judge_id, entry.as_dict()] for judge_id, entry in pdata.detailed_scores.items()
+            ])]
+            for uid, pdata in game.participants.items()
+        ],
+        "photos_all_rounds": [
+            [rnd, [[uid, record.as_dict()] for uid, record in photos.items()]]
+            for rnd, photos in game.photos_all_rounds.items()
+        ],
+        "photos_this_round": [
+            [uid, None if current.get(uid) is record else record.as_dict()]
+            for uid, record in game.photos_this_round.items()
+        ],
+    }
+
+def game_from_dict(data):
+    game = Game(data["chat_id"], data["host_id"])
+    game.game_id = data["game_id"]
+    game.topic_id = data["topic_id"]
+    game.finished = data["finished"]
+    for field, value in data["state"].items():
+        setattr(game, field, value)
+    for uid, pdata in data["participants"]:
+        detailed = pdata.pop("detailed_scores")
+        participant = game.participants[uid] = Participant(**pdata)
+        participant.detailed_scores = {judge_id: ScoreEntry(**entry) for judge_id, entry in detailed}
+    game.photos_all_rounds = {
+        rnd: {uid: PhotoRecord(**record) for uid, record in photos}
+        for rnd, photos in data["photos_all_rounds"]
+    }
+    current = game.photos_all_rounds.get(game.current_round, {})
+    game.photos_this_round = {
+        uid: current[uid] if record is None else PhotoRecord(**record)
+        for uid, record in data["photos_this_round"]
+    }
+    game.started = True
+    game.rebuild_derived()
+    return game
+
+# Как событие журнала применяется к игре при восстановлении
+JOURNAL_APPLY = {
+    "set": lambda game, d: [setattr(game, field, value) for field, value in d.items()],
+    "join": lambda game, d: game.add_participant(d["uid"], d["nickname"], d["username"]),
+    "photo": lambda game, d: game.record_photo(
+        d["uid"], d["message_id"], d["file_id"], d["caption"], d.get("thumb_file_id"), d.get("number")
+    ),
+    "number": lambda game, d: game.number_photos(d["uids"]),
+    "publish": lambda game, d: game.publish_photo(d["uid"], d["message_id"], d.get("number")),
+    "delivery": lambda game, d: game.record_delivery(d["key"], d["message_id"]),
+    "repeat": lambda game, d: game.mark_repeat(d["uid"]),
+    "score": lambda game, d: game.apply_score(d["uid"], d["judge"], d["name"], d["points"]),
+    "eliminate": lambda game, d: game.eliminate(d["uid"], d["round_out"]),
+    "round_start": lambda game, d: game.reset_round(),
+    "archive": lambda game, d: game.archive_round(),
+    "next_round": lambda game, d: game.next_round(),
+    "end": lambda game, d: game.finish(),
+}
+
+def apply_event(loaded, event):
+    """Применяет одно событие журнала к словарю игр {game_id: Game}."""
+    data = event["d"]
+    if event["e"] == "start":
+        game = Game(data["chat_id"], data["host_id"])
+        game.game_id = event["g"]
+        game.topic_id = data["topic_id"]
+        for field, value in data["state"].items():
+            setattr(game, field, value)
+        game.started = True
+        loaded[game.game_id] = game
+        return
+    game = loaded.get(event["g"])
+    if game:
+        JOURNAL_APPLY[event["e"]](game, data)
+
+def read_journal(path, offset=0):
+    """События журнала начиная с offset; недописанная последняя строка пропускается."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+def replay_journal(path):
+    """Пересобирает все игры (и завершённые) из журнала с самого начала — для разбора офлайн."""
+    loaded = {}
+    for event in read_journal(path):
+        apply_event(loaded, event)
+    return loaded
+
+class GameJournal:
+    """Журнал всех изменений запущенных игр в формате JSON Lines.
+
+    События копятся в памяти и дописываются в файл пачкой в отдельном
+    потоке. Каждые JOURNAL_SNAPSHOT_EVERY событий рядом сохраняется снимок
+    всех запущенных игр вместе со смещением в журнале, поэтому
+    восстановление = снимок + хвост журнала после него.
+    """
+
+    def __init__(self, path, snapshot_every=JOURNAL_SNAPSHOT_EVERY, flush_interval=DB_FLUSH_INTERVAL):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.file = None
+        self._size = 0
+        self._pending = []
+        self._since_snapshot = 0
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self._size = self.file.tell()
+
+    def attach(self, game):
+        """Подключает запущенную игру к журналу и записывает её стартовые настройки."""
+        game.journal = self
+        game.emit("start", host_id=game.host_id, chat_id=game.chat_id, topic_id=game.topic_id, state=game.state())
+
+    def append(self, game_id, kind, data):
+        event = {"t": round(time.time(), 3), "g": game_id, "e": kind, "d": data}
+        self._pending.append(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._since_snapshot += 1
+
+    def _write(self, chunk, snapshot):
+        self.file.write(chunk)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if snapshot is not None:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.snapshot_path)
+
+    async def flush(self, force_snapshot=False):
+        """Дописывает накопленные события; False — запись не удалась и повторится позже."""
+        async with self._flush_lock:
+            if not self._pending and not force_snapshot:
+                return True
+            lines, self._pending = self._pending, []
+            chunk = "".join(lines).encode("utf-8")
+            size_after = self._size + len(chunk)
+
+            # Снимок собираем сразу, пока состояние игр ровно соответствует концу chunk
+            snapshot = None
+            if force_snapshot or self._since_snapshot >= self.snapshot_every:
+                snapshot = {
+                    "version": SNAPSHOT_VERSION, "offset": size_after,
+                    "games": [game_to_dict(g) for g in games.running()]
+                }
+
+            try:
+                await asyncio.to_thread(self._write, chunk, snapshot)
+            except OSError as e:
+                print(f"Ошибка записи журнала: {e}")
+                self._pending = lines + self._pending
+                return False
+            self._size = size_after
+            if snapshot is not None:
+                self._since_snapshot = 0
+            return True
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush(force_snapshot=True)
+        self.file.close()
+
+    def recover(self):
+        """Незавершённые игры: последний снимок + события журнала после него."""
+        loaded = {}
+        offset = 0
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        # Снимок старого формата не читаем: журнал целиком восстановит то же самое
+        if snapshot and snapshot.get("version") == SNAPSHOT_VERSION:
+            offset = snapshot["offset"]
+            for data in snapshot["games"]:
+                game = game_from_dict(data)
+                loaded[game.game_id] = game
+        if os.path.exists(self.path):
+            for event in read_journal(self.path, offset):
+                apply_event(loaded, event)
+        return [game for game in loaded.values() if not game.finished]
+
+journal = GameJournal(JOURNAL_PATH)
+
+def journal_paths(path=JOURNAL_PATH):
+    """Журнал одного процесса и журналы обработчиков (path.0, path.1, ...), какие есть на диске."""
+    paths = [path] if os.path.exists(path) else []
+    directory = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + "."
+    workers = [
+        name for name in os.listdir(directory)
+        if name.startswith(prefix) and name[len(prefix):].isdigit()
+    ]
+    workers.sort(key=lambda name: int(name[len(prefix):]))
+    return paths + [os.path.join(directory, name) for name in workers]
+
+def audit_scores(paths, game_id, user_id=None):
+    """Все изменения баллов в игре: кто, кому, сколько и когда — для разбора спорных оценок."""
+    events = []
+    for path in paths:
+        for event in read_journal(path):
+            if event["g"] == game_id and event["e"] == "score":
+                if user_id is None or event["d"]["uid"] == user_id:
+                    events.append(event)
+    events.sort(key=lambda event: event["t"])  # игра могла переехать на другой обработчик
+    lines = []
+    for event in events:
+        data = event["d"]
+        moment = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["t"]))
+        lines.append(f"{moment}  игрок {data['uid']}  {data['points']:+d}б  судья {data['name']} ({data['judge']})")
+    return lines
+
+# -------------------- РАССЫЛКИ --------------------
+_background_tasks = set()
+
+def run_in_background(coro):
+    """Запускает корутину, не дожидаясь её; ссылку держим, чтобы задачу не собрал GC."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+class BroadcastJob:
+    """Рассылка личных сообщений списку получателей.
+
+    Сообщения уходят параллельно (не больше BROADCAST_CONCURRENCY сразу) с
+    приоритетом PRIORITY_BULK. Статус каждого получателя сохраняется в базе,
+    поэтому после перезапуска рассылка продолжается с недоставленных, а в
+    конце ведущий получает сводку: сколько доставлено и сколько нет.
+    """
+
+    def __init__(self, title, items, host_id=None, game_id=None, job_id=None):
+        self.job_id = job_id or secrets.token_hex(4)
+        self.title = title
+        self.host_id = host_id
+        self.game_id = game_id
+        self.items = items  # [[chat_id, {"text": ..., "reply_markup": ...}, статус]]
+        self.finished = False
+        self.worker = worker_index  # обработчик, который досылает рассылку после перезапуска
+
+    @classmethod
+    def to_players(cls, title, game, user_ids, text, reply_markup=None):
+        """Одинаковое сообщение нескольким участникам игры."""
+        payload = {"text": text}
+        if reply_markup:
+            payload["reply_markup"] = reply_markup.to_dict()
+        return cls(title, [[uid, payload, None] for uid in user_ids], host_id=game.host_id, game_id=game.game_id)
+
+    def counts(self):
+        sent = sum(1 for _, _, status in self.items if status == "sent")
+        failed = sum(1 for _, _, status in self.items if status == "failed")
+        return sent, failed
+
+    def dump(self):
+        job_row = (self.job_id, self.game_id, self.host_id, self.title, int(self.finished), self.worker)
+        item_rows = [
+            (self.job_id, idx, chat_id, json.dumps(payload, ensure_ascii=False), status)
+            for idx, (chat_id, payload, status) in enumerate(self.items)
+        ]
+        return job_row, item_rows
+
+    async def _deliver(self, bot, item, limit):
+        chat_id, payload, status = item
+        if status:
+            return
+        kwargs = dict(payload)
+        if "reply_markup" in kwargs:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], bot)
+        async with limit:
+            try:
+                await bot.send_message(chat_id=chat_id, rate_limit_args=PRIORITY_BULK, **kwargs)
+                item[2] = "sent"
+            except TelegramError as e:
+                print(f"Рассылка «{self.title}»: не доставлено {chat_id}: {e}")
+                item[2] = "failed"
+        store.save_broadcast(self)
+
+    async def run(self, bot):
+        store.save_broadcast(self)
+        limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        await asyncio.gather(*(self._deliver(bot, item, limit) for item in self.items))
+        self.finished = True
+        store.save_broadcast(self)
+
+        if self.host_id:
+            sent, failed = self.counts()
+            text = f"📬 {self.title}: доставлено {sent}"
+            if failed:
+                text += f", не доставлено {failed}"
+            try:
+                await bot.send_message(chat_id=self.host_id, text=text)
+            except TelegramError as e:
+                print(f"Не удалось отправить сводку рассылки ведущему: {e}")
+
+def start_broadcast(context, job):
+    """Запускает рассылку в фоне — хендлер (и ведущий) её не ждёт."""
+    if job.items:
+        run_in_background(job.run(context.bot))
+    return job
+
+# -------------------- НАДЁЖНАЯ ОТПРАВКА --------------------
+class SendUncertain(TelegramError):
+    """Запрос мог дойти до Telegram, но ответа нет: повторять нельзя, иначе будет дубль."""
+
+def send_error_is_safe(error):
+    """True, если сообщение точно не создано и запрос можно повторить."""
+    cause = error.__cause__
+    if cause is None:
+        # Telegram сам ответил ошибкой (502 и т.п.) — сообщение не создано
+        return not isinstance(error, TimedOut)
+    # Соединение не установлено — запрос никуда не ушёл
+    return isinstance(cause, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+async def send_with_retry(send, retries=SEND_RETRIES):
+    """Повторяет send() с экспоненциальной паузой и jitter, пока сбой сети безопасен для повтора."""
+    for attempt in range(retries + 1):
+        try:
+            return await send()
+        except NetworkError as e:
+            if isinstance(e, BadRequest):
+                raise
+            if not send_error_is_safe(e):
+                raise SendUncertain(f"Нет ответа от Telegram: {e}") from e
+            if attempt == retries:
+                raise
+            delay = random.uniform(0, min(SEND_BACKOFF_MAX, 2 ** attempt))
+            print(f"Сбой сети ({e}), повтор через {delay:.1f}с")
+            await asyncio.sleep(delay)
+
+_deliveries_in_flight = {}  # {(game_id, ключ): Future с message_id}
+
+def delivery_in_flight(game, key):
+    return (game.game_id, key) in _deliveries_in_flight
+
+async def deliver(game, key, send):
+    """Важная отправка в тему не больше одного раза на ключ идемпотентности.
+
+    send — функция без аргументов, возвращающая корутину отправки. Если по
+    ключу уже есть доставленное сообщение, ничего не отправляется и
+    возвращается его message_id; одновременные вызовы с тем же ключом ждут
+    первый. Безопасные сбои сети повторяются, а при неизвестном исходе
+    (ответ не дошёл) поднимается SendUncertain.
+    """
+    if key in game.deliveries:
+        return game.deliveries[key]
+    flight_key = (game.game_id, key)
+    if flight_key in _deliveries_in_flight:
+        return await asyncio.shield(_deliveries_in_flight[flight_key])
+
+    future = asyncio.get_running_loop().create_future()
+    _deliveries_in_flight[flight_key] = future
+    try:
+        msg = await send_with_retry(send)
+        game.record_delivery(key, msg.message_id)
+        store.save(game)
+        future.set_result(msg.message_id)
+        return msg.message_id
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # ожидающих может не быть — не пишем "never retrieved"
+        raise
+    finally:
+        del _deliveries_in_flight[flight_key]
+
+# -------------------- СВОДКИ ОЦЕНОК --------------------
+class ScoreDigests:
+    """Копит оценки участникам и шлёт каждому одну сводку вместо сообщения на каждое «+Nб».
+
+    Сводка уходит через window секунд после первой оценки в пачке
+    (window=0 — только в конце раунда) и обязательно при завершении раунда.
+    """
+
+    def __init__(self, window=SCORE_DIGEST_SECONDS):
+        self.window = window
+        self.pending = {}  # {game_id: {user_id: [(баллы, судья), ...]}}
+
+    def add(self, bot, game, user_id, points, judge_name):
+        players = self.pending.setdefault(game.game_id, {})
+        first = user_id not in players
+        players.setdefault(user_id, []).append((points, judge_name))
+        if first and self.window:
+            run_in_background(self._flush_later(bot, game, user_id))
+
+    async def _flush_later(self, bot, game, user_id):
+        await asyncio.sleep(self.window)
+        self.flush(bot, game, [user_id])
+
+    def _text(self, game, user_id, deltas):
+        lines = ["💸 Новые оценки:"]
+        for points, judge_name in deltas:
+            lines.append(f"{'+' if points > 0 else ''}{points}б от {judge_name}")
+        lines.append(f"Всего: {game.participants[user_id].score}б")
+        return "\n".join(lines)
+
+    def flush(self, bot, game, user_ids=None):
+        """Запускает в фоне рассылку накопленных сводок игры (всем или только указанным участникам)."""
+        players = self.pending.get(game.game_id)
+        if not players:
+            return
+        user_ids = list(players) if user_ids is None else [uid for uid in user_ids if uid in players]
+        items = [[uid, {"text": self._text(game, uid, players.pop(uid))}, None] for uid in user_ids]
+        if not players:
+            del self.pending[game.game_id]
+        if items:
+            run_in_background(BroadcastJob("Сводка оценок", items, game_id=game.game_id).run(bot))
+
+score_digests = ScoreDigests()
+
+def restore_games(worker=None):
+    """Поднимает игры, которые шли до перезапуска бота (из базы или из журнала); worker — только свои."""
+    started = time.perf_counter()
+    restored = journal.recover() if RESTORE_FROM == "journal" else store.load_running()
+    if worker is not None and RESTORE_FROM != "journal":  # журнал у каждого обработчика и так свой
+        restored = [game for game in restored if worker_for_user(game.host_id) == worker]
+    photo_prints.load(store.load_prints())
+    for game in restored:
+        game.journal = journal
+        games.add(game)
+        games.start(game)
+        for uid in game.participants:
+            games.add_participant(game, uid)
+    if restored:
+        print(f"Восстановлено игр: {len(restored)} за {time.perf_counter() - started:.3f} с")
+
+# -------------------- КЭШ ПРОФИЛЕЙ --------------------
+class ProfileCache:
+    """Свежие имена пользователей: живут PROFILE_TTL секунд, лишние вытесняются по LRU.
+
+    Заполняется бесплатно — из User, которые приходят в каждом апдейте, —
+    поэтому имена и роли обычно находятся без запросов к Bot API и
+    остаются верными, если пользователь сменил юзернейм.
+    """
+
+    def __init__(self, ttl=PROFILE_TTL, maxsize=PROFILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._profiles = OrderedDict()  # {user_id: {"username", "full_name", "first_name", "seen"}}
+        self._by_username = {}          # {юзернейм в нижнем регистре: user_id}
+
+    def _drop(self, user_id):
+        profile = self._profiles.pop(user_id, None)
+        if profile and profile["username"]:
+            key = profile["username"].lower()
+            if self._by_username.get(key) == user_id:
+                del self._by_username[key]
+
+    def put(self, user_id, username, full_name, first_name):
+        self._drop(user_id)
+        self._profiles[user_id] = {
+            "username": username, "full_name": full_name,
+            "first_name": first_name, "seen": time.monotonic(),
+        }
+        if username:
+            self._by_username[username.lower()] = user_id
+        while len(self._profiles) > self.maxsize:
+            self._drop(next(iter(self._profiles)))
+
+    def remember(self, user):
+        if user and not user.is_bot:
+            self.put(user.id, user.username, user.full_name, user.first_name)
+
+    def get(self, user_id):
+        profile = self._profiles.get(user_id)
+        if not profile:
+            return None
+        if time.monotonic() - profile["seen"] > self.ttl:
+            self._drop(user_id)
+            return None
+        self._profiles.move_to_end(user_id)
+        return profile
+
+    def id_for_username(self, username):
+        user_id = self._by_username.get(username.lower().lstrip("@"))
+        return user_id if user_id is not None and self.get(user_id) else None
+
+    async def fetch(self, bot, user_id):
+        """Профиль из кэша, а при промахе — через get_chat."""
+        profile = self.get(user_id)
+        if profile:
+            return profile
+        try:
+            chat = await bot.get_chat(user_id)
+        except TelegramError as e:
+            print(f"Не удалось получить профиль {user_id}: {e}")
+            return None
+        self.put(user_id, chat.username, chat.full_name, chat.first_name)
+        return self.get(user_id)
+
+profiles = ProfileCache()
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Дописывает апдейт в RECORD_UPDATES (JSON на строку) для прогона через replay_updates.py."""
+    with open(RECORD_UPDATES, "a", encoding="utf-8") as f:
+        f.write(json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
+
+async def remember_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кладёт отправителя каждого апдейта в кэш профилей (группа -1, до остальных хэндлеров)."""
+    profiles.remember(update.effective_user)
+
+# -------------------- ФАЙЛЫ ФОТО --------------------
+class MediaCache:
+    """Локальные копии фото, адресованные по file_unique_id.
+
+    Один и тот же файл (даже под разными file_id) хранится и скачивается
+    один раз: одновременные запросы ждут одну загрузку. Общий объём
+    ограничен MEDIA_CACHE_BYTES, давно не нужные файлы удаляются первыми.
+    Содержимое читается через mmap, без копирования в память процесса.
+    """
+
+    def __init__(self, root=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()  # {file_unique_id: размер}, давно не нужные — первыми
+        self._size = 0
+        self._unique_ids = {}        # {file_id: file_unique_id}, чтобы не спрашивать get_file повторно
+        self._fetching = {}          # {file_unique_id или file_id: Task загрузки}
+
+    def open(self):
+        """Поднимает индекс по файлам на диске; порядок вытеснения — по времени последнего доступа.
+
+        Смотрит только папки-префиксы вида path(): каталоги обработчиков
+        (media/worker0, ...) — чужие кэши, их файлы здесь не ищутся и не вытесняются.
+        """
+        found = []
+        os.makedirs(self.root, exist_ok=True)
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or len(shard.name) != 2:
+                continue
+            for name in os.listdir(shard.path):
+                path = os.path.join(shard.path, name)
+                if name.endswith(".part"):  # загрузка, прерванная перезапуском
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, unique_id, size in sorted(found):
+            self._files[unique_id] = size
+            self._size += size
+        self._evict()
+
+    def path(self, unique_id):
+        return os.path.join(self.root, unique_id[:2], unique_id)
+
+    def _touch(self, unique_id):
+        self._files.move_to_end(unique_id)
+        with contextlib.suppress(OSError):
+            os.utime(self.path(unique_id))  # чтобы порядок пережил перезапуск
+        return self.path(unique_id)
+
+    def _evict(self, keep=None):
+        while self._size > self.max_bytes and self._files:
+            unique_id = next(iter(self._files))
+            if unique_id == keep:
+                break
+            self._size -= self._files.pop(unique_id)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(unique_id))
+
+    async def fetch(self, bot, file_id, unique_id=None):
+        """Путь к локальной копии файла; качает его, только если копии ещё нет."""
+        unique_id = unique_id or self._unique_ids.get(file_id)
+        if unique_id in self._files:
+            return self._touch(unique_id)
+        key = unique_id or file_id
+        task = self._fetching.get(key)
+        if task is None:
+            task = asyncio.create_task(self._download(bot, file_id))
+            self._fetching[key] = task
+            task.add_done_callback(functools.partial(self._fetched, key))
+        # shield: если ждущий отменён, загрузка нужна остальным
+        return await asyncio.shield(task)
+
+    def _fetched(self, key, task):
+        self._fetching.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # ошибку получат ждущие; здесь только гасим предупреждение asyncio
+
+    async def _download(self, bot, file_id):
+        file = await bot.get_file(file_id)
+        unique_id = self._unique_ids[file_id] = file.file_unique_id
+        if unique_id in self._files:
+            return self._touch(unique_id)
+        # Тот же файл уже качается под другим file_id
+        other = self._fetching.setdefault(unique_id, asyncio.current_task())
+        if other is not asyncio.current_task():
+            return await asyncio.shield(other)
+        try:
+            path = self.path(unique_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            await file.download_to_drive(f"{path}.part")
+            os.replace(f"{path}.part", path)
+        finally:
+            self._fetching.pop(unique_id, None)
+        size = os.path.getsize(path)
+        self._files[unique_id] = size
+        self._size += size
+        self._evict(keep=unique_id)
+        return path
+
+    @staticmethod
+    @contextlib.contextmanager
+    def mapped(path):
+        """Файл, отображённый в память: читается как файл или срезами, без копии в памяти процесса."""
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield io.BytesIO()
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                yield view
+
+media = MediaCache()
+
+# -------------------- ПОВТОРЫ ФОТО --------------------
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+def dhash(path, size=8):
+    """64-битный разностный хэш: светлее ли каждый пиксель уменьшенной серой копии соседа справа."""
+    with media.mapped(path) as data, Image.open(data) as image:
+        pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = row * (size + 1) + col
+            bits = bits << 1 | (pixels[left] > pixels[left + 1])
+    return bits
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга: хэши в радиусе r ищутся без перебора всех."""
+
+    def __init__(self):
+        self.root = None  # [хэш, [значения], {расстояние: узел}]
+
+    def add(self, key, value):
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                if value not in node[1]:
+                    node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        """[(расстояние, значение)] для всех хэшей не дальше radius от key."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_key, values, children = stack.pop()
+            distance = hamming(key, node_key)
+            if distance <= radius:
+                found.extend((distance, value) for value in values)
+            stack.extend(
+                child for edge, child in children.items()
+                if distance - radius <= edge <= distance + radius
+            )
+        return found
+
+class PhotoPrints:
+    """Отпечатки всех принятых фото — во всех раундах и играх.
+
+    Точный повтор (тот же файл, в том числе пересланный) находится по
+    file_unique_id за O(1) и отклоняется сразу. Похожие фото (пересжатые,
+    обрезанные) ищутся по dHash самой маленькой копии в BK-дереве: хэш
+    считается в фоне, и о находке только сообщается ведущему.
+    """
+
+    def __init__(self):
+        self._seen = {}           # {file_unique_id: (game_id, раунд, user_id)}
+        self._hashes = BKTree()   # dHash -> file_unique_id
+
+    def load(self, rows):
+        for unique_id, game_id, rnd, user_id, _, hash_hex in rows:
+            self._seen[unique_id] = (game_id, rnd, user_id)
+            if hash_hex:
+                self._hashes.add(int(hash_hex, 16), unique_id)
+
+    def find(self, unique_id):
+        """(game_id, раунд, user_id) фото с тем же файлом или None."""
+        return self._seen.get(unique_id)
+
+    def add(self, unique_id, game, user_id, thumb_file_id):
+        self._seen[unique_id] = (game.game_id, game.current_round, user_id)
+        store.save_print((unique_id, game.game_id, game.current_round, user_id, thumb_file_id, None))
+
+    def similar(self, value, unique_id, radius=NEAR_DUPLICATE_DISTANCE):
+        """Ранее принятые фото с похожим хэшем, ближайшие первыми."""
+        return sorted(
+            (distance, self._seen[other])
+            for distance, other in self._hashes.search(value, radius) if other != unique_id
+        )
+
+    async def check_similar(self, bot, game, user_id, unique_id, thumb):
+        """Считает dHash нового фото и сообщает ведущему, если оно похоже на уже присланное."""
+        rnd = game.current_round
+        thumb_file_id = thumb.file_id
+        try:
+            path = await media.fetch(bot, thumb_file_id, thumb.file_unique_id)
+            value = await asyncio.to_thread(dhash, path)
+        except (TelegramError, OSError) as e:
+            print(f"Не удалось посчитать хэш фото {unique_id}: {e}")
+            return
+
+        matches = self.similar(value, unique_id)
+        self._hashes.add(value, unique_id)
+        store.save_print((unique_id, game.game_id, rnd, user_id, thumb_file_id, f"{value:016x}"))
+        if not matches:
+            return
+
+        distance, (other_game, other_round, other_id) = matches[0]
+        author = player_name(user_id, game.participants[user_id])
+        if other_game == game.game_id and other_id in game.participants:
+            source = f"фото {player_name(other_id, game.participants[other_id])} из раунда {other_round}"
+        else:
+            source = f"фото из прошлой игры (раунд {other_round})"
+        try:
+            await bot.send_message(
+                chat_id=game.host_id,
+                text=f"👀 Фото {author} в раунде {rnd} похоже на {source}: отличается {distance} бит из 64. Проверьте, не повтор ли это."
+            )
+        except TelegramError as e:
+            print(f"Не удалось предупредить ведущего о похожем фото: {e}")
+
+photo_prints = PhotoPrints()
+
+def repeat_photo_text(game, user_id, seen) -> str:
+    game_id, rnd, owner_id = seen
+    if game_id == game.game_id and owner_id == user_id:
+        return f"🔁 Это фото вы уже присылали в раунде {rnd}. Пришлите новое фото."
+    return "🔁 Это фото уже участвовало в игре. Пришлите своё новое фото."
+
+def remember_photo(game, context, user_id, photo):
+    """Заносит принятое фото в отпечатки и в фоне ищет похожие."""
+    unique_id, thumb = photo[-1].file_unique_id, photo[0]
+    photo_prints.add(unique_id, game, user_id, thumb.file_id)
+    if Image is not None and NEAR_DUPLICATE_DISTANCE > 0:
+        run_in_background(photo_prints.check_similar(context.bot, game, user_id, unique_id, thumb))
 
 # -------------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ --------------------
+def topic_title(topic_id) -> str:
+    return "⚡️БЛИЦ⚡️" if str(topic_id) == str(TOPIC_BLITZ_ID) else "🖤Черное зеркало🖤"
+
+def join_url(game) -> str:
+    """Ссылка в ЛС бота, которая сразу привязывает участника к ветке игры."""
+    return topic_join_url(game.topic_id)
+
+def topic_join_url(topic_id) -> str:
+    return f"https://t.me/{BOT_USERNAME[1:]}?start=join_{topic_id}"
+
+def find_game_for_message(update: Update):
+    """Игра по сообщению: в группе — по ветке, в ЛС — по участнику или ведущему."""
+    message = update.message
+    if message.chat.type != "private":
+        return games.for_topic(message.chat_id, message.message_thread_id)
+    user_id = message.from_user.id
+    game = games.for_participant(user_id)
+    if game:
+        return game
+    game = games.for_host(user_id)
+    return game if game and game.started else None
+
+def find_game_for_sender(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Игра для фото в ЛС: выбранная по ссылке ветка → участник → ведущий → единственная игра.
+
+    Ссылка «Прислать фото» — явный выбор и важнее прежнего участия: игрок
+    блица, открывший ссылку другой ветки, дальше шлёт фото туда. Выбор
+    действует, пока та игра идёт и игрок в ней не выбыл.
+    """
+    chosen = context.user_data.get("join_game")
+    if chosen:
+        game = games.by_id.get(chosen)
+        pdata = game.participants.get(update.effective_user.id) if game else None
+        if game and not game.finished and not (pdata and pdata.eliminated):
+            return game
+        context.user_data.pop("join_game", None)
+    game = find_game_for_message(update)
+    if game:
+        return game
+    running = games.running()
+    return running[0] if len(running) == 1 and not games.remote_topics else None
+
+def forget_join_choice(context, game):
+    """Снимает выбор игры по ссылке у её участников, когда игра закончилась."""
+    for uid in game.participants:
+        user_data = context.application.user_data.get(uid)
+        if user_data and user_data.get("join_game") == game.game_id:
+            del user_data["join_game"]
+
+def player_name(user_id, pdata) -> str:
+    """Текущее имя игрока: из кэша профилей, иначе сохранённое при входе в игру."""
+    profile = profiles.get(user_id)
+    if profile:
+        return f"@{profile['username']}" if profile["username"] else profile["full_name"]
+    return f"@{pdata.username}" if pdata.username else pdata.nickname
+
+def is_jury(game, user) -> bool:
+    """Второй судья определяется по id; юзернейм нужен, только пока id ещё неизвестен."""
+    if game.co_host_id is None and game.co_host_username:
+        if user.username and user.username.lower() == game.co_host_username.lower():
+            game.set(co_host_id=user.id)
+            store.save(game)
+    return game.co_host_id is not None and user.id == game.co_host_id
+
 def status_text(value: bool) -> str:
     return "✅" if value else "❌"
 
@@ -68,7 +1947,8 @@ def game_settings_text(game, for_start=False) -> str:
         f"• Лимит участников: {limit_text}\n"
         f"• Позднее присоединение: {status_text(game.can_join_late)}\n"
         f"• Показ выбывших: {status_text(game.show_eliminated_nicks)}\n"
-        f"• Пропуск раундов: {status_text(game.skip_allowed)}"
+        f"• Пропуск раундов: {status_text(game.skip_allowed)}\n"
+        f"• Фото альбомами после приёма: {status_text(game.reveal_mode)}"
     )
 
     if for_start:
@@ -90,6 +1970,98 @@ def game_settings_text(game, for_start=False) -> str:
     else:
         return f"🪩 *Игра готова!*\n\n{text}"
 
+# -------------------- КНОПКИ --------------------
+CALLBACK_VERSION = "1"
+CALLBACK_MAX_BYTES = 64  # предел Telegram для callback_data
+
+def pack_callback(action, game, *args):
+    """callback_data вида «версия:действие:game_id:аргументы…»."""
+    data = ":".join([CALLBACK_VERSION, action, game.game_id, *map(str, args)])
+    if len(data.encode()) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CALLBACK_MAX_BYTES} байт: {data}")
+    return data
+
+def unpack_callback(data):
+    """(действие, game_id, [аргументы]) или None для чужого или устаревшего формата."""
+    parts = (data or "").split(":")
+    if len(parts) < 3 or parts[0] != CALLBACK_VERSION:
+        return None
+    return parts[1], parts[2], parts[3:]
+
+def callback_button(text, action, game, *args):
+    return InlineKeyboardButton(text, callback_data=pack_callback(action, game, *args))
+
+CALLBACK_ACTIONS = {}  # {действие: (обработчик(query, context, game, args), для запущенной игры?)}
+
+def on_callback(action, started):
+    """Регистрирует обработчик кнопки. started — кнопка запущенной игры (иначе — черновика)."""
+    def register(handler):
+        CALLBACK_ACTIONS[action] = (handler, started)
+        return handler
+    return register
+
+# -------------------- ОЧЕРЁДНОСТЬ ОБРАБОТКИ --------------------
+class UpdateLocks:
+    """Замки по ключу: апдейты одной игры обрабатываются строго по одному.
+
+    Записи живут, пока замок кто-то держит или ждёт, поэтому словарь не
+    растёт вместе с числом игр и пользователей.
+    """
+
+    def __init__(self):
+        self._locks = {}  # {ключ: [asyncio.Lock, сколько держат и ждут]}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        if key is None:
+            yield
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+update_locks = UpdateLocks()
+
+def game_for_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Игра, которую может изменить апдейт, — по тем же правилам, что и в обработчиках."""
+    user = update.effective_user
+    if update.callback_query:
+        parsed = unpack_callback(update.callback_query.data)
+        return games.by_id.get(parsed[1]) if parsed else games.for_host(user.id)
+    if not update.message:
+        return None
+    if update.message.chat.type != "private":
+        return find_game_for_message(update)
+    if update.message.photo:
+        return find_game_for_sender(update, context)  # та же игра, которую изменит photo_handler
+    # Остальное в ЛС — ведущий настраивает и ведёт свою игру (в том числе черновую)
+    return games.for_host(user.id) or find_game_for_sender(update, context)
+
+def lock_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    game = game_for_update(update, context)
+    if game:
+        return ("game", game.game_id)
+    if update.effective_user:
+        return ("user", update.effective_user.id)
+    return None
+
+def serialized(callback):
+    """Обработчик, меняющий игру: выполняется под замком этой игры.
+
+    Апдейты разных игр и команды только на чтение идут параллельно.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with update_locks.hold(lock_key(update, context)):
+            return await callback(update, context)
+    return wrapper
+
 # -------------------- СТАРТ ИГРЫ --------------------
 async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not getattr(update, "message", None):
@@ -99,15 +2071,15 @@ async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     host_id = update.message.from_user.id
+    existing = games.for_host(host_id)
 
-    # Проверяем, есть ли уже активная игра в чате
-    active_game = next((g for g in games.values() if getattr(g, "started", False)), None)
-    if active_game:
-        await update.message.reply_text("Игра уже начата. Попробуйте позже.")
+    # Ведущий уже ведёт запущенную игру
+    if existing and existing.started:
+        await update.message.reply_text("Вы уже ведёте игру. Завершите её, чтобы начать новую.")
         return
 
     # Если ведущий уже создал черновую игру
-    if host_id in games and not getattr(games[host_id], "started", False):
+    if existing:
         await update.message.reply_text(
             "Вы уже создаёте игру. Завершите настройку или сбросьте её через '🔄 Настроить заново'."
         )
@@ -115,74 +2087,89 @@ async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Создаём новую черновую игру для ведущего
     game = Game(MAIN_CHAT_ID, host_id)
-    game.started = False
-    games[host_id] = game  # ключ — host_id
+    games.add(game)
 
     keyboard = [
-        [InlineKeyboardButton("⚡️БЛИЦ⚡️", callback_data="topic_blitz")],
-        [InlineKeyboardButton("🖤Черное зеркало🖤", callback_data="topic_black_mirror")],
+        [callback_button("⚡️БЛИЦ⚡️", "topic", game, "blitz")],
+        [callback_button("🖤Черное зеркало🖤", "topic", game, "mirror")],
     ]
     await update.message.reply_text(
         "Выберите нужную ветку, а затем настройте параметры 💖",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+# -------------------- ВХОД ПО ССЫЛКЕ --------------------
+async def join_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/start join_<ветка> — кнопка «Прислать фото» привязывает участника к игре ветки."""
+    if not update.message or update.message.chat.type != "private":
+        return
+
+    payload = context.args[0] if context.args else ""
+    topic = payload[len("join_"):] if payload.startswith("join_") else ""
+    game = games.for_topic(MAIN_CHAT_ID, topic) if topic.isdigit() else None
+
+    if not game:
+        await update.message.reply_text("📩 Пришлите фото, чтобы участвовать в игре, или создайте свою: /start_game")
+        return
+
+    context.user_data["join_game"] = game.game_id
+    await update.message.reply_text(f"📩 Присылайте фото для игры в ветке {topic_title(game.topic_id)}!")
+
 # -------------------- НАСТРОЙКИ ИГРЫ --------------------
-async def choose_mode(query):
+def yes_no_keyboard(action, game):
+    return InlineKeyboardMarkup([
+        [callback_button("✅", action, game, 1)],
+        [callback_button("❌", action, game, 0)]
+    ])
+
+async def choose_mode(query, game):
     keyboard = [
-        [InlineKeyboardButton("На баллы", callback_data="mode_normal")],
-        [InlineKeyboardButton("На выбывание", callback_data="mode_elimination")]
+        [callback_button("На баллы", "mode", game, "normal")],
+        [callback_button("На выбывание", "mode", game, "elimination")]
     ]
     await query.edit_message_text("Выберите режим игры:", reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def choose_ref(query):
-    keyboard = [
-        [InlineKeyboardButton("✅", callback_data="ref_yes")],
-        [InlineKeyboardButton("❌", callback_data="ref_no")]
-    ]
-    await query.edit_message_text("Отправлять рефы через бота?", reply_markup=InlineKeyboardMarkup(keyboard))
+async def choose_ref(query, game):
+    await query.edit_message_text("Отправлять рефы через бота?", reply_markup=yes_no_keyboard("ref", game))
 
-async def choose_show_eliminated(query):
-    keyboard = [
-        [InlineKeyboardButton("✅", callback_data="show_out_yes")],
-        [InlineKeyboardButton("❌", callback_data="show_out_no")]
-    ]
-    await query.edit_message_text("Показывать ник участника при выбывании?", reply_markup=InlineKeyboardMarkup(keyboard))
+async def choose_show_eliminated(query, game):
+    await query.edit_message_text("Показывать ник участника при выбывании?", reply_markup=yes_no_keyboard("out", game))
 
-async def choose_join_late(query):
-    keyboard = [
-        [InlineKeyboardButton("✅", callback_data="join_yes")],
-        [InlineKeyboardButton("❌", callback_data="join_no")]
-    ]
-    await query.edit_message_text("Разрешить присоединяться позже?", reply_markup=InlineKeyboardMarkup(keyboard))
+async def choose_join_late(query, game):
+    await query.edit_message_text("Разрешить присоединяться позже?", reply_markup=yes_no_keyboard("late", game))
 
-async def choose_skip(query):
-    keyboard = [
-        [InlineKeyboardButton("✅", callback_data="skip_yes")],
-        [InlineKeyboardButton("❌", callback_data="skip_no")]
-    ]
-    await query.edit_message_text("Разрешить пропуск раунда?", reply_markup=InlineKeyboardMarkup(keyboard))
+async def choose_skip(query, game):
+    await query.edit_message_text("Разрешить пропуск раунда?", reply_markup=yes_no_keyboard("skip", game))
 
-async def choose_show_nicks(query):
-    keyboard = [
-        [InlineKeyboardButton("✅", callback_data="show_nicks_yes")],
-        [InlineKeyboardButton("❌", callback_data="show_nicks_no")]
-    ]
-    await query.edit_message_text("Показывать ник участника при оценке?", reply_markup=InlineKeyboardMarkup(keyboard))
+async def choose_show_nicks(query, game):
+    await query.edit_message_text("Показывать ник участника при оценке?", reply_markup=yes_no_keyboard("nicks", game))
 
-async def ask_participant_limit(query):
+async def ask_participant_limit(query, game):
     keyboard = [
-        [InlineKeyboardButton(str(i), callback_data=f"limit_{i}") for i in range(5, 11)],
-        [InlineKeyboardButton(str(i), callback_data=f"limit_{i}") for i in range(11, 16)],
-        [InlineKeyboardButton(str(i), callback_data=f"limit_{i}") for i in range(16, 21)],
-        [InlineKeyboardButton("Не ограничивать", callback_data="limit_no")],
+        [callback_button(str(i), "limit", game, i) for i in range(5, 11)],
+        [callback_button(str(i), "limit", game, i) for i in range(11, 16)],
+        [callback_button(str(i), "limit", game, i) for i in range(16, 21)],
+        [callback_button("Не ограничивать", "limit", game, "no")],
     ]
     await query.edit_message_text("Выберите ограничение участников:", reply_markup=InlineKeyboardMarkup(keyboard))
 
+async def choose_reveal(query, game):
+    await query.edit_message_text(
+        "Публиковать фото раунда альбомами в случайном порядке после остановки приёма?",
+        reply_markup=yes_no_keyboard("reveal", game)
+    )
+
+def settings_keyboard(game, jury_label):
+    return InlineKeyboardMarkup([
+        [callback_button(jury_label, "jury", game)],
+        [callback_button("🚀 Начать игру", "start", game)],
+        [callback_button("🗑️ Сбросить", "reset", game)]
+    ])
+
 async def set_jury_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     # Ищем игру, где этот пользователь является ведущим
-    game = games.get(user_id)
+    game = games.for_host(user_id)
     
     if not game or not getattr(game, 'waiting_for_cohost_input', False):
         return
@@ -194,6 +2181,7 @@ async def set_jury_text_handler(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     game.co_host_username = username
+    game.co_host_id = profiles.id_for_username(username)
     game.waiting_for_cohost_input = False # Выключаем режим ожидания текста
 
     await update.message.reply_text(f"✅ Второй судья добавлен: @{username}")
@@ -202,220 +2190,287 @@ async def set_jury_text_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
     jury_label = f"👮‍♂️ Жюри: @{game.co_host_username} (Изм.)"
     
-    keyboard = [
-        [InlineKeyboardButton(jury_label, callback_data="add_jury")],
-        [InlineKeyboardButton("🚀 Начать игру", callback_data="start_confirm")],
-        [InlineKeyboardButton("🗑️ Сбросить", callback_data="start_reset")]
-    ]
-    
     await update.message.reply_text(
         text, 
         parse_mode="Markdown", 
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=settings_keyboard(game, jury_label)
     )
 
 async def confirm_game_settings(query, game):
     text = game_settings_text(game)
     # Если жюри уже добавлено, можно изменить текст кнопки
     jury_label = f"👮‍♂️ Жюри: @{game.co_host_username}" if game.co_host_username else "👮‍♂️ Добавить жюри"
-
-    keyboard = [
-        [InlineKeyboardButton("👮‍♂️ Добавить жюри", callback_data="add_jury")],
-        [InlineKeyboardButton("🚀 Начать игру", callback_data="start_confirm")],
-        [InlineKeyboardButton("🗑️ Сбросить", callback_data="start_reset")]
-    ]
-    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=settings_keyboard(game, jury_label))
 
 # -------------------- CALLBACK --------------------
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Все кнопки бота: действие из callback_data сразу ведёт к своему обработчику."""
     query = update.callback_query
     if not query:
         return
-    await query.answer()
-    user_id = query.from_user.id
 
-    # Получаем игру текущего ведущего
-    game = games.get(user_id)
-    if not game:
-        await query.edit_message_text("✖️ Игра не найдена или была завершена.")
+    parsed = unpack_callback(query.data)
+    action, game_id, args = parsed if parsed else (None, None, [])
+    handler, for_started = CALLBACK_ACTIONS.get(action, (None, None))
+    game = games.by_id.get(game_id)
+
+    # Кнопка чужая, от завершённой или сброшенной игры, либо уже не к месту
+    if not handler or not game or game.host_id != query.from_user.id or game.started != for_started:
+        await query.answer("⌛ Кнопка устарела.", show_alert=True)
+        current = games.for_host(query.from_user.id)
+        if current and current.started and query.message and query.message.message_id == current.host_menu_message_id:
+            await show_host_menu(current, context)  # меню в старом формате — перерисовываем
+        else:
+            try:
+                await query.edit_message_reply_markup(reply_markup=None)
+            except BadRequest:
+                pass
         return
 
-    data = query.data
-
-    # ---- выбор темы и настроек  ----
-    if data == "topic_blitz":
-        game.topic_id = TOPIC_BLITZ_ID
-        await choose_ref(query)
-        return
-    if data == "topic_black_mirror":
-        game.topic_id = TOPIC_BLACK_MIRROR_ID
-        await choose_ref(query)
-        return
-    if data == "ref_yes":
-        game.ref_mode = True
-        game.current_ref_sent = False
-        await choose_mode(query)
-        return
-    if data == "ref_no":
-        game.ref_mode = False
-        await choose_mode(query)
-        return
-    if data == "mode_elimination":
+    await query.answer()
+    await handler(query, context, game, args)
+
+# ---- выбор темы и настроек ----
+@on_callback("topic", started=False)
+async def on_topic(query, context, game, args):
+    game.topic_id = TOPIC_BLITZ_ID if args[0] == "blitz" else TOPIC_BLACK_MIRROR_ID
+    await choose_ref(query, game)
+
+@on_callback("ref", started=False)
+async def on_ref(query, context, game, args):
+    game.ref_mode = args[0] == "1"
+    game.current_ref_sent = False
+    await choose_mode(query, game)
+
+@on_callback("mode", started=False)
+async def on_mode(query, context, game, args):
+    if args[0] == "elimination":
         game.mode = "elimination"
         game.can_join_late = False
         game.skip_allowed = False
-        await choose_show_eliminated(query)
-        return
-    if data == "mode_normal":
+        await choose_show_eliminated(query, game)
+    else:
         game.mode = "normal"
-        await choose_join_late(query)
-        return
-    if data == "show_out_yes":
-        game.show_eliminated_nicks = True
-        game.show_nicks = True
-        await ask_participant_limit(query)
-        return
-    if data == "show_out_no":
-        game.show_eliminated_nicks = False
-        game.show_nicks = False
-        await ask_participant_limit(query)
-        return
-    if data == "join_yes":
-        game.can_join_late = True
-        await choose_skip(query)
-        return
-    if data == "join_no":
-        game.can_join_late = False
-        await choose_skip(query)
-        return
-    if data == "skip_yes":
-        game.skip_allowed = True
-        await choose_show_nicks(query)
-        return
-    if data == "skip_no":
-        game.skip_allowed = False
-        await choose_show_nicks(query)
-        return
-    if data == "show_nicks_yes":
-        game.show_nicks = True
-        if game.mode == "normal":
-            game.show_eliminated_nicks = True
-        await ask_participant_limit(query)
-        return
-    if data == "show_nicks_no":
-        game.show_nicks = False
-        if game.mode == "normal":
-            game.show_eliminated_nicks = False
-        await ask_participant_limit(query)
+        await choose_join_late(query, game)
+
+@on_callback("out", started=False)
+async def on_show_eliminated(query, context, game, args):
+    game.show_eliminated_nicks = game.show_nicks = args[0] == "1"
+    await ask_participant_limit(query, game)
+
+@on_callback("late", started=False)
+async def on_join_late(query, context, game, args):
+    game.can_join_late = args[0] == "1"
+    await choose_skip(query, game)
+
+@on_callback("skip", started=False)
+async def on_skip(query, context, game, args):
+    game.skip_allowed = args[0] == "1"
+    await choose_show_nicks(query, game)
+
+@on_callback("nicks", started=False)
+async def on_show_nicks(query, context, game, args):
+    game.show_nicks = args[0] == "1"
+    if game.mode == "normal":
+        game.show_eliminated_nicks = game.show_nicks
+    await ask_participant_limit(query, game)
+
+# ---- лимит участников ----
+@on_callback("limit", started=False)
+async def on_limit(query, context, game, args):
+    game.participant_limit = None if args[0] == "no" else int(args[0])
+    await choose_reveal(query, game)
+
+@on_callback("reveal", started=False)
+async def on_reveal(query, context, game, args):
+    game.reveal_mode = args[0] == "1"
+    await confirm_game_settings(query, game)
+
+# ---- запуск игры ----
+@on_callback("start", started=False)
+async def on_start_confirm(query, context, game, args):
+    # Проверяем, не занята ли выбранная ветка другой игрой
+    if not games.start(game):
+        await query.edit_message_text("🎮 В этой ветке уже идёт игра. Попробуйте позже.")
         return
+    journal.attach(game)
+    store.save(game)
 
-    # ---- лимит участников ----
-    if data.startswith("limit_"):
-        val = data.split("_")[1]
-        game.participant_limit = None if val == "no" else int(val)
-        await confirm_game_settings(query, game)
-        return
+    # --- кнопка Перейти в тему ---
+    button = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💬 Перейти в тему", url=f"t.me/c/{str(MAIN_CHAT_ID)[4:]}/{game.topic_id}")]
+    ])
 
-    # ---- запуск игры ----
-    if data == "start_confirm":
-        # Проверяем, есть ли уже активная игра в MAIN_CHAT_ID
-        active_game = next((g for g in games.values() if getattr(g, "started", False)), None)
-        if active_game:
-            await query.edit_message_text("🎮 Игра уже начата. Попробуйте позже.")
-            return
+    # --- Редактируем сообщение, добавляя кнопку ---
+    edited = await query.edit_message_text(
+        f"🎮 Игра запущена!\n\n"
+        f"🟢 /call_people – позовет в ЛС участников, не приславших фото в этом раунде, но которые участвовали раньше.\n"
+        f"🟢 /check_photos – пришлет, сколько участников не прислали работы в этом раунде.\n"
+        f"🟢 /show_players – пришлет список активных участников игры.\n"
+        f"🟢 /standings – покажет таблицу лидеров.\n\n"
+        f"Дополнительно:\n"
+        f"⭐ Чтобы засчитать участнику баллы – ответьте на его фото +1б или +10б).\n"
+        f"❌ Чтобы участник покинул игру – ответьте на его фото \"вылет\".\n"
+        f"👤 Чтобы показать автора фото – ответьте на фото \"кто автор\".\n"
+        f"🔄 Чтобы дать участнику возможность отправить фото повторно – ответьте на фото \"повтор\".\n",
+        reply_markup=button,
+        parse_mode="None"
+    )
 
-        game.started = True
-        # --- кнопка Перейти в тему ---
-        button = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💬 Перейти в тему", url=f"t.me/c/{str(MAIN_CHAT_ID)[4:]}/{game.topic_id}")]
-        ])
+    # --- Закрепляем это сообщение в ЛС ведущего ---
+    try:
+        await context.bot.pin_chat_message(
+            chat_id=game.host_id,
+            message_id=edited.message_id,
+            disable_notification=True
+        )
+    except Exception as e:
+        print("Ошибка закрепления:", e)
 
-        # --- Редактируем сообщение, добавляя кнопку ---
-        edited = await query.edit_message_text(
-            f"🎮 Игра запущена!\n\n"
-            f"🟢 /call_people – позовет в ЛС участников, не приславших фото в этом раунде, но которые участвовали раньше.\n"
-            f"🟢 /check_photos – пришлет, сколько участников не прислали работы в этом раунде.\n"
-            f"🟢 /show_players – пришлет список активных участников игры.\n\n"
-            f"Дополнительно:\n"
-            f"⭐ Чтобы засчитать участнику баллы – ответьте на его фото +1б или +10б).\n"
-            f"❌ Чтобы участник покинул игру – ответьте на его фото \"вылет\".\n"
-            f"👤 Чтобы показать автора фото – ответьте на фото \"кто автор\".\n"
-            f"🔄 Чтобы дать участнику возможность отправить фото повторно – ответьте на фото \"повтор\".\n",
-            reply_markup=button,
-            parse_mode="None"
+    if game.ref_mode:
+        await start_game_with_ref(game, context)
+    else:  
+        await start_round(game, context)
+        await show_host_menu(game, context)
+
+@on_callback("jury", started=False)
+async def on_add_jury(query, context, game, args):
+    game.waiting_for_cohost_input = True
+    try:
+        await query.edit_message_text(
+            "✍️ *Напишите юзернейм второго судьи в чат.*\nПример: `durov` или `@durov`",
+            parse_mode="Markdown"
         )
+    except BadRequest:
+        pass
 
-        # --- Закрепляем это сообщение в ЛС ведущего ---
-        try:
-            await context.bot.pin_chat_message(
-                chat_id=game.host_id,
-                message_id=edited.message_id,
-                disable_notification=True
-            )
-        except Exception as e:
-            print("Ошибка закрепления:", e)
+# ---- сброс настроек ----
+@on_callback("reset", started=False)
+async def on_reset(query, context, game, args):
+    games.remove(game)
+    await query.edit_message_text("🚩 Все настройки сброшены. Начните заново командой /start_game")
 
-        if game.ref_mode:
-            await start_game_with_ref(game, context)
-        else:  
-            await start_round(game, context)
-            await show_host_menu(game, context)
+# -------------------- МЕНЮ ВЕДУЩЕГО --------------------
+class MenuRenderer:
+    """Правки сообщений-меню ведущего без лишних запросов.
+
+    Помнит последний отправленный текст и клавиатуру каждого сообщения,
+    пропускает правки, которые ничего не меняют, и склеивает несколько
+    быстрых изменений в одну правку через HOST_MENU_DEBOUNCE секунд.
+    Текст и клавиатура всегда уходят одним edit_message_text.
+    """
+
+    def __init__(self, delay=HOST_MENU_DEBOUNCE):
+        self.delay = delay
+        self.shown = {}    # {(chat_id, message_id): (text, клавиатура как dict)}
+        self.pending = {}  # {(chat_id, message_id): (text, markup)}
+        self.locks = {}    # {(chat_id, message_id): Lock} — правка сообщения в полёте
+
+    @staticmethod
+    def _view(text, markup):
+        return text, markup.to_dict() if markup else None
+
+    async def send(self, bot, chat_id, text, markup=None):
+        msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+        self.shown[(chat_id, msg.message_id)] = self._view(text, markup)
+        return msg
+
+    def edit(self, bot, chat_id, message_id, text, markup=None):
+        """Ставит правку в очередь; без markup клавиатура у сообщения убирается."""
+        key = (chat_id, message_id)
+        first = key not in self.pending
+        if text is None and not first:
+            text = self.pending[key][0]  # текст из ещё не отправленной правки
+        self.pending[key] = (text, markup)
+        if first:
+            run_in_background(self._flush_later(bot, key))
+
+    async def _flush_later(self, bot, key, attempt=0):
+        await asyncio.sleep(self.delay if not attempt else min(SEND_BACKOFF_MAX, 2 ** attempt))
+        # Правки одного сообщения уходят по очереди: следующая видит итог предыдущей
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            await self._flush(bot, key, attempt)
+
+    async def _flush(self, bot, key, attempt):
+        text, markup = self.pending.pop(key)
+        if text is None:
+            text = self.shown.get(key, (None, None))[0]
+        view = self._view(text, markup)
+        previous = self.shown.get(key)
+        if previous == view:
+            return
 
-        return
-    
-    if data == "add_jury":
-        game.waiting_for_cohost_input = True
+        # Ставим новый вид до запроса: retire и другие правки без текста берут его отсюда
+        self.shown[key] = view
+        chat_id, message_id = key
         try:
-            await query.edit_message_text(
-                "✍️ *Напишите юзернейм второго судьи в чат.*\nПример: `durov` или `@durov`",
-                parse_mode="Markdown"
-            )
-        except BadRequest:
-            pass
-        return
+            if text is None:
+                # Текст сообщения неизвестен (например, после перезапуска) — меняем только клавиатуру
+                await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            else:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup)
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                return
+            self._restore(key, view, previous)
+            if "Message to edit not found" not in str(e):
+                print(f"Ошибка правки меню ведущего: {e}")
+        except TelegramError as e:
+            # Сеть или флуд-лимит: повторяем правку, если новой за это время не появилось
+            print(f"Ошибка правки меню ведущего: {e}")
+            self._restore(key, view, previous)
+            if attempt < SEND_RETRIES and key not in self.pending:
+                self.pending[key] = (text, markup)
+                run_in_background(self._flush_later(bot, key, attempt + 1))
+
+    def _restore(self, key, view, previous):
+        """Правка не прошла: в сообщении остался прежний вид."""
+        if self.shown.get(key) == view:
+            if previous is None:
+                self.shown.pop(key, None)
+            else:
+                self.shown[key] = previous
 
-    # ---- сброс настроек ----
-    if data == "start_reset":
-        if user_id in games:
-            del games[user_id]
-        await query.edit_message_text("🚩 Все настройки сброшены. Начните заново командой /start_game")
-        return
+    def retire(self, bot, chat_id, message_id, text=None):
+        """Убирает кнопки у старого меню (и, если задан, меняет текст) и забывает его."""
+        self.edit(bot, chat_id, message_id, text)
+        run_in_background(self._forget_later((chat_id, message_id)))
+
+    async def _forget_later(self, key):
+        await asyncio.sleep(self.delay * 2)
+        # Сначала дожидаемся правок в полёте и их повторов
+        while key in self.pending or key in self.locks and self.locks[key].locked():
+            await asyncio.sleep(self.delay)
+        self.shown.pop(key, None)
+        self.locks.pop(key, None)
+
+host_menu = MenuRenderer()
 
-# -------------------- МЕНЮ ВЕДУЩЕГО --------------------
 async def show_host_menu(game: Game, context: ContextTypes.DEFAULT_TYPE):
     """Показывает меню ведущего. Кнопка для остановки фото зависит от состояния photo_reception_active."""
     if getattr(game, "photo_reception_active", True):
-        end_photo_button = InlineKeyboardButton("⏹ Остановить приём фото", callback_data="host_stop_photo")
+        end_photo_button = callback_button("⏹ Остановить приём фото", "stop", game)
     else:
-        end_photo_button = InlineKeyboardButton("⏹ Приём фото остановлен", callback_data="host_stop_photo_disabled")
+        end_photo_button = callback_button("⏹ Приём фото остановлен", "stopped", game)
 
     keyboard = [
         [end_photo_button],
-        [InlineKeyboardButton("➡ Следующий раунд", callback_data="host_next_round")],
-        [InlineKeyboardButton("🏁 Завершить игру", callback_data="host_end_game")]
+        [callback_button("➡ Следующий раунд", "next", game)],
+        [callback_button("🏁 Завершить игру", "end", game)]
     ]
     text = f"Идет игра (Раунд {game.current_round})"
 
+    if getattr(game, "host_menu_message_id", None):
+        host_menu.edit(context.bot, game.host_id, game.host_menu_message_id, text, InlineKeyboardMarkup(keyboard))
+        return
+
     try:
-        if getattr(game, "host_menu_message_id", None):
-            await context.bot.edit_message_text(
-                chat_id=game.host_id,
-                message_id=game.host_menu_message_id,
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            msg = await context.bot.send_message(
-                chat_id=game.host_id,
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            game.host_menu_message_id = msg.message_id
-    except BadRequest as e:
-        if "Message is not modified" in str(e):
-            pass
-        else:
-            print(f"Ошибка show_host_menu: {e}")
+        msg = await host_menu.send(context.bot, game.host_id, text, InlineKeyboardMarkup(keyboard))
+    except TelegramError as e:
+        print(f"Ошибка show_host_menu: {e}")
+        return
+    game.set(host_menu_message_id=msg.message_id)
+    store.save(game)
 
 async def start_game_with_ref(game, context):
     text = game_settings_text(game, for_start=True)
@@ -443,7 +2498,7 @@ async def actually_start_round_after_ref(game, context, caption):
     if caption.strip():
         text += f"\n{caption}"
 
-    keyboard = [[InlineKeyboardButton("💌 Прислать фото", url=f"https://t.me/{BOT_USERNAME[1:]}")]]
+    keyboard = [[InlineKeyboardButton("💌 Прислать фото", url=join_url(game))]]
 
     await context.bot.send_message(
         chat_id=MAIN_CHAT_ID,
@@ -464,16 +2519,12 @@ async def notify_round_start(game: Game, context: ContextTypes.DEFAULT_TYPE):
         )]
     ])
 
-    for uid, pdata in game.participants.items():
-        if not pdata.get("eliminated", False):
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"🔥 Раунд {game.current_round} начался! Присылайте фото в ЛС бота!",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                print(f"Не удалось уведомить {uid}: {e}")
+    active = [uid for uid, pdata in game.participants.items() if not pdata.eliminated]
+    start_broadcast(context, BroadcastJob.to_players(
+        f"Уведомление о раунде {game.current_round}", game, active,
+        f"🔥 Раунд {game.current_round} начался! Присылайте фото в ЛС бота!",
+        keyboard
+    ))
 
 async def start_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
     if game.round_active:
@@ -490,7 +2541,7 @@ async def start_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
         text=f"🏳️ Раунд {game.current_round} начался!"
     )
 
-    keyboard = [[InlineKeyboardButton("💌 Прислать фото", url=f"https://t.me/{BOT_USERNAME[1:]}")]]
+    keyboard = [[InlineKeyboardButton("💌 Прислать фото", url=join_url(game))]]
 
     if game.current_round == 1:
         text_message = game_settings_text(game, for_start=True)
@@ -498,13 +2549,23 @@ async def start_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
         text_message = f"🔥 Раунд {game.current_round} стартовал!\n\n📩 Присылайте фото в ЛС бота!"
 
     # Отправка сообщения в тему
-    round_start_msg = await context.bot.send_message(
-        chat_id=MAIN_CHAT_ID,
-        message_thread_id=game.topic_id,
-        text=text_message,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    game.last_round_message_id = round_start_msg.message_id
+    try:
+        round_start_id = await deliver(game, f"round:{game.current_round}", lambda: context.bot.send_message(
+            chat_id=MAIN_CHAT_ID,
+            message_thread_id=game.topic_id,
+            text=text_message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            read_timeout=CRITICAL_READ_TIMEOUT
+        ))
+    except TelegramError as e:
+        print(f"Не удалось объявить раунд {game.current_round}: {e}")
+        await context.bot.send_message(
+            chat_id=game.host_id,
+            text="⚠️ Не удалось отправить сообщение о старте раунда в тему. Проверьте тему."
+        )
+        return
+    game.set(last_round_message_id=round_start_id)
+    store.save(game)
 
     # Закрепление сообщения
     try:
@@ -521,19 +2582,100 @@ async def start_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
 
 # -------------------- ОБРАБОТКА ФОТО --------------------
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото в ЛС: реф ведущего или фото участника.
+
+    Замок игры берётся только на проверки и на запись фото. Отправка в тему
+    (с повторами и ожиданием лимита группы) идёт без него, чтобы ответы
+    судей и кнопки ведущего не ждали одну медленную загрузку.
+    """
     if not update.message:
         return
 
+    lock = lock_key(update, context)
+    async with update_locks.hold(lock):
+        accepted = await accept_photo(update, context)
+    if not accepted:
+        return
+    game, rnd, photo_number, caption_text = accepted
+    # deliver занимает ключ до первого await, так что второе фото участника accept_photo уже отклонит
+    user_id = update.message.from_user.id
+    photo_file_id = update.message.photo[-1].file_id
+    key = f"photo:{rnd}:{user_id}"
+
+    uncertain = False
+    try:
+        sent_msg_id = await deliver(game, key, lambda: context.bot.send_photo(
+            chat_id=MAIN_CHAT_ID,
+            message_thread_id=game.topic_id,
+            photo=photo_file_id,
+            caption=caption_text,
+            read_timeout=CRITICAL_READ_TIMEOUT
+        ))
+    except SendUncertain as e:
+        print(f"Неизвестно, дошло ли фото участника: {e}")
+        # Фото, скорее всего, уже в теме под своим номером: засчитываем его, а не просим прислать ещё раз
+        sent_msg_id, uncertain = None, True
+    except TelegramError as e:
+        print(f"Не удалось отправить фото участника: {e}")
+        await update.message.reply_text("⚠️ Сеть недоступна. Попробуйте позже.")
+        return
+
+    async with update_locks.hold(lock):
+        # Пока фото отправлялось, раунд мог закончиться, а фото — прийти ещё раз
+        if not game.round_active or game.current_round != rnd:
+            await update.message.reply_text("👀 Раунд завершился, пока фото отправлялось, — оно не засчитано.")
+            return
+        record = game.photos_this_round.get(user_id)
+        if record and record.status == PHOTO_ACCEPTED:
+            return
+
+        if uncertain:
+            game.record_delivery(key, None)  # повторно не шлём, чтобы не было дубля
+        # Сохраняем данные о фото
+        game.record_photo(
+            user_id, sent_msg_id, photo_file_id, update.message.caption or "",
+            update.message.photo[0].file_id, photo_number
+        )
+        remember_photo(game, context, user_id, update.message.photo)
+        store.save(game)
+
+    if not uncertain:
+        await update.message.reply_text("Фото принято ♥️")
+        return
+    await update.message.reply_text(
+        "Фото принято ♥️ Telegram не ответил вовремя — если фото не появилось в теме, ведущий уже знает об этом."
+    )
+    try:
+        await context.bot.send_message(
+            chat_id=game.host_id,
+            text=f"⚠️ Telegram не ответил вовремя: фото #{photo_number} (Раунд {rnd}) от "
+                 f"{player_name(user_id, game.participants[user_id])} могло не появиться в теме. "
+                 f"Фото засчитано; если в теме его нет, выложите его вручную."
+        )
+    except TelegramError as e:
+        print(f"Не удалось сообщить ведущему о фото без ответа Telegram: {e}")
+
+async def accept_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет фото под замком игры; (игра, раунд, номер, подпись), если его нужно выложить в тему."""
     user = update.message.from_user
     user_id = user.id
     photo_file_id = update.message.photo[-1].file_id
     participant_caption = f"\n\n💬 {update.message.caption}" if update.message.caption else ""
 
-    # 🔑 ИЩЕМ АКТИВНУЮ ИГРУ
-    game = next((g for g in games.values() if g.started), None)
-
+    # 🔑 ИЩЕМ ИГРУ: выбранная по ссылке ветка → участник → ведущий → единственная игра
+    game = find_game_for_sender(update, context)
     if not game:
-        await update.message.reply_text("👀 Игра ещё не запущена ведущим.")
+        running = games.running_topics()
+        if not running:
+            await update.message.reply_text("👀 Игра ещё не запущена ведущим.")
+            return
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(topic_title(topic), url=topic_join_url(topic))] for topic in running
+        ])
+        await update.message.reply_text(
+            "Сейчас идёт несколько игр. Выберите игру и пришлите фото ещё раз 💖",
+            reply_markup=keyboard
+        )
         return
 
     # ⏳ ждём реф
@@ -546,8 +2688,7 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- ВЕДУЩИЙ ОТПРАВЛЯЕТ РЕФ ---
     if game.ref_mode and user_id == game.host_id:
         if not game.current_ref_sent:
-            game.current_ref_sent = True
-            game.round_active = True
+            game.set(current_ref_sent=True, round_active=True)
 
             if game.current_round == 0:
                 game.current_round = 1
@@ -555,40 +2696,54 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Публикуем реф в теме
             text = f"🔥 Раунд {game.current_round} начался!{participant_caption}\n\n📩 Присылайте фото в ЛС бота!"
             keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("💌 Прислать фото", url=f"https://t.me/{BOT_USERNAME[1:]}")]
+                [InlineKeyboardButton("💌 Прислать фото", url=join_url(game))]
             ])
 
+            key = f"ref:{game.current_round}"
             try:
-                ref_msg = await context.bot.send_photo(
+                ref_msg_id = await deliver(game, key, lambda: context.bot.send_photo(
                     chat_id=MAIN_CHAT_ID,
                     message_thread_id=game.topic_id,
                     photo=photo_file_id,
                     caption=text,
-                    reply_markup=keyboard
+                    reply_markup=keyboard,
+                    read_timeout=CRITICAL_READ_TIMEOUT
+                ))
+            except SendUncertain as e:
+                print(f"Неизвестно, дошёл ли реф: {e}")
+                # Реф, скорее всего, в теме: раунд идёт дальше, повторная отправка дала бы дубль
+                game.record_delivery(key, None)
+                ref_msg_id = None
+                await update.message.reply_text(
+                    "⚠️ Telegram не ответил вовремя — реф мог не появиться в теме. "
+                    "Раунд начат; если рефа в теме нет, выложите его туда вручную."
                 )
-                game.last_round_message_id = ref_msg.message_id
+            except TelegramError as e:
+                print(f"Не удалось отправить реф: {e}")
+                game.set(current_ref_sent=False)
+                await update.message.reply_text("⚠️ Сеть недоступна. Попробуйте позже.")
+                return
 
+            if ref_msg_id:
+                game.set(last_round_message_id=ref_msg_id)
                 # Закрепляем сообщение
                 try:
                     await context.bot.pin_chat_message(
                         chat_id=MAIN_CHAT_ID,
-                        message_id=ref_msg.message_id,
+                        message_id=ref_msg_id,
                         disable_notification=True
                     )
                 except Exception as e:
                     print(f"Ошибка закрепления сообщения: {e}")
+            store.save(game)
 
-                # Ведущему
-                await context.bot.send_message(
-                    chat_id=game.host_id,
-                    text=f"🎉 Реф принят! Раунд {game.current_round} стартовал."
-                )
-
-                await show_host_menu(game, context)
+            # Ведущему
+            await context.bot.send_message(
+                chat_id=game.host_id,
+                text=f"🎉 Реф принят! Раунд {game.current_round} стартовал."
+            )
 
-            except telegram.error.NetworkError as e:
-                print(f"Не удалось отправить реф: {e}")
-                await update.message.reply_text("⚠️ Сеть недоступна. Попробуйте позже.")
+            await show_host_menu(game, context)
         else:
             await update.message.reply_text("📌 Реф на этот раунд уже отправлен.")
         return
@@ -614,58 +2769,44 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("👀 Лимит участников достигнут. Вы не можете присоединиться.")
         return
 
-    if user_in_game and game.participants[user_id]["eliminated"]:
+    if user_in_game and game.participants[user_id].eliminated:
         await update.message.reply_text("👀 Вы выбыли и не можете участвовать в этом раунде.")
         return
 
-    if user_in_game and user_id in game.photos_this_round:
-        if game.photos_this_round[user_id] != "REPEAT":
-            await update.message.reply_text("📮 Вы уже отправили фото в этом раунде.")
-            return
+    record = game.photos_this_round.get(user_id)
+    if user_in_game and record and record.status == PHOTO_ACCEPTED:
+        await update.message.reply_text("📮 Вы уже отправили фото в этом раунде.")
+        return
+
+    # Тот же файл уже был — в этой игре или в прошлых
+    seen = photo_prints.find(update.message.photo[-1].file_unique_id)
+    if seen:
+        await update.message.reply_text(repeat_photo_text(game, user_id, seen))
+        return
 
     if not user_in_game:
-        game.participants[user_id] = {
-            "nickname": user.full_name,
-            "username": user.username,
-            "score": 0,
-            "eliminated": False,
-            "rounds_played": []
-        }
+        game.add_participant(user_id, user.full_name, user.username)
+        games.add_participant(game, user_id)
+
+    # Режим показа альбомами: фото ждёт остановки приёма
+    if game.reveal_mode:
+        game.record_photo(user_id, None, photo_file_id, update.message.caption or "", update.message.photo[0].file_id)
+        remember_photo(game, context, user_id, update.message.photo)
+        store.save(game)
+        await update.message.reply_text("Фото принято ♥️ Все фото раунда появятся в теме после окончания приёма.")
+        return
 
     # Формируем подпись для фото с учётом номера и подписи
-    photo_number = len([p for p in game.photos_this_round.values() if p != "REPEAT"]) + 1
+    photo_number = game.next_photo_number()
     caption_text = f"📸 Фото #{photo_number} (Раунд {game.current_round}){participant_caption}"
 
-    try:
-        sent_msg = await context.bot.send_photo(
-            chat_id=MAIN_CHAT_ID,
-            message_thread_id=game.topic_id,
-            photo=photo_file_id,
-            caption=caption_text
-        )
-    except telegram.error.NetworkError as e:
-        print(f"Не удалось отправить фото участника: {e}")
-        await update.message.reply_text("⚠️ Сеть недоступна. Попробуйте позже.")
+    # Одно фото на участника в раунде, даже если второе пришло, пока первое ещё отправляется
+    if delivery_in_flight(game, f"photo:{game.current_round}:{user_id}"):
+        await update.message.reply_text("📮 Вы уже отправили фото в этом раунде.")
         return
 
-    # Сохраняем данные о фото
-    game.photos_this_round[user_id] = {
-        "file_id": photo_file_id,
-        "message_id": sent_msg.message_id,
-        "caption": update.message.caption or ""
-    }
-
-    game.participants[user_id]["rounds_played"].append(game.current_round)
-
-    if game.current_round not in game.photos_all_rounds:
-        game.photos_all_rounds[game.current_round] = {}
-    game.photos_all_rounds[game.current_round][user_id] = {
-        "file_id": photo_file_id,
-        "message_id": sent_msg.message_id,
-        "caption": update.message.caption or ""
-    }
-
-    await update.message.reply_text("Фото принято ♥️") 
+    game.set(photo_counter=photo_number)  # номер занят, пока фото отправляется без замка
+    return game, game.current_round, photo_number, caption_text
 
 async def handle_ref_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -887,41 +3028,72 @@ async def handle_ref_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #             except: pass
 #             return
            
+CMD_AUTHOR, CMD_ELIMINATE, CMD_SCORE, CMD_REPEAT = "author", "eliminate", "score", "repeat"
+
+def _phrase(words):
+    """Слова в альтернативу регулярки: длинные раньше коротких, пробел — любой пробельный промежуток."""
+    escaped = (re.escape(word).replace("\\ ", "\\s+") for word in sorted(words, key=len, reverse=True))
+    return "|".join(escaped)
+
+class JudgeCommands:
+    """Разбор ответа судьи на фото за один проход по тексту.
+
+    Регулярка собирается один раз. С начала текста пробуются команды,
+    которые должны занимать весь ответ («кто автор», «повтор») или с
+    которых он начинается («+5б …»), а слова выбывания ищутся целыми
+    словами в любом месте. classify возвращает (команда, баллы) или None.
+    """
+
+    def __init__(self, elimination_words=ELIMINATION_WORDS, author_words=AUTHOR_WORDS, repeat_words=REPEAT_WORDS):
+        self.pattern = re.compile(
+            rf"^\s*(?:(?P<author>{_phrase(author_words)})\s*$"
+            rf"|(?P<sign>[+-])\s*(?P<points>\d+)\s*б(?!\w)"
+            rf"|(?P<repeat>{_phrase(repeat_words)})\s*$)"
+            rf"|(?<!\w)(?P<eliminate>{_phrase(elimination_words)})(?!\w)",
+            re.IGNORECASE,
+        )
+
+    def classify(self, text):
+        match = self.pattern.search(text)
+        if not match:
+            return None
+        if match["author"]:
+            return CMD_AUTHOR, None
+        if match["sign"]:
+            points = int(match["points"])
+            return CMD_SCORE, points if match["sign"] == "+" else -points
+        if match["repeat"]:
+            return CMD_REPEAT, None
+        return CMD_ELIMINATE, None
+
+judge_commands = JudgeCommands()
+
 async def reply_on_photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.reply_to_message or not update.message.text:
         return
 
-    game = next((g for g in games.values() if getattr(g, "started", False)), None)
+    # Обычная переписка в ветке — без поиска игры и фото
+    command = judge_commands.classify(update.message.text)
+    if not command:
+        return
+    kind, points = command
+
+    game = games.for_topic(update.message.chat_id, update.message.message_thread_id)
     if not game: return
 
     user = update.message.from_user
     user_id = user.id
     
     is_host = (user_id == game.host_id)
-    is_jury = (game.co_host_username and user.username and user.username.lower() == game.co_host_username.lower())
-
-    if not is_host and not is_jury: return
+    if not is_host and not is_jury(game, user): return
 
     # Имя судьи (именно оно пойдет в итоговую таблицу)
     judge_name = user.first_name if not is_host else "Ведущего"
 
     reply_msg = update.message.reply_to_message
-    text = update.message.text.strip().lower()
     replied_id = reply_msg.message_id
 
-    author_id = None
-    round_found = None
-
-    for uid, data in game.photos_this_round.items():
-        if data != "REPEAT" and isinstance(data, dict) and data.get("message_id") == replied_id:
-            author_id = uid; round_found = game.current_round; break
-            
-    if not author_id:
-        for r_num, r_photos in game.photos_all_rounds.items():
-            for uid, data in r_photos.items():
-                if data != "REPEAT" and isinstance(data, dict) and data.get("message_id") == replied_id:
-                    author_id = uid; round_found = r_num; break
-            if author_id: break
+    author_id, round_found = game.find_photo(replied_id)
 
     if not author_id: return
     pdata = game.participants.get(author_id)
@@ -929,70 +3101,252 @@ async def reply_on_photo_handler(update: Update, context: ContextTypes.DEFAULT_T
 
     # --- КОМАНДЫ ---
 
-    if text in ["кто автор", "автор", "автор?"]:
-        username = pdata.get("username")
-        nickname = pdata.get("nickname")
-        author_text = f"@{username}" if username else nickname or "🤫 секретик 🤫"
+    if kind == CMD_AUTHOR:
+        author_text = player_name(author_id, pdata) or "🤫 секретик 🤫"
         await update.message.reply_text(f"👤 {judge_name} спрашивает автора.\nЭто: {author_text}")
         return
 
-    if any(word in text for word in ELIMINATION_WORDS):
+    if kind == CMD_ELIMINATE:
         if is_host: # Удаляет только ГЛАВНЫЙ ведущий
-            if pdata.get("eliminated"):
+            if pdata.eliminated:
                 await update.message.reply_text("Этот игрок уже выбыл.")
                 return
-            pdata["eliminated"] = True
-            pdata["round_out"] = round_found
-            nickname = pdata["nickname"]
-            text_out = f"🤝 Игрок @{nickname} выбывает из игры в {round_found} раунде." if game.show_eliminated_nicks else f"🤝 Игрок выбывает из игры в {round_found} раунде."
+            game.eliminate(author_id, round_found)
+            store.save(game)
+            text_out = f"🤝 Игрок {player_name(author_id, pdata)} выбывает из игры в {round_found} раунде." if game.show_eliminated_nicks else f"🤝 Игрок выбывает из игры в {round_found} раунде."
             await context.bot.send_message(chat_id=MAIN_CHAT_ID, message_thread_id=game.topic_id, text=text_out)
             try: await context.bot.send_message(chat_id=author_id, text=f"🤝 Ведущий исключил вас из игры в раунде {round_found}.")
             except: pass
         return
 
     # --- БАЛЛЫ ---
-    if round_found == game.current_round:
-        if (text.startswith("+") or text.startswith("-")) and text.endswith("б"):
-            try:
-                # Определяем знак и число
-                sign = 1 if text.startswith("+") else -1
-                points = int(text[1:-1]) * sign
-                
-                if game.photos_this_round.get(author_id) == "REPEAT":
-                    await update.message.reply_text("✖️ Фото на повторе, нельзя оценивать.")
-                    return
-
-                pdata["score"] += points
+    if kind == CMD_SCORE:
+        if round_found != game.current_round:
+            return
+        record = game.photos_this_round.get(author_id)
+        if record and record.status == PHOTO_REPEAT:
+            await update.message.reply_text("✖️ Фото на повторе, нельзя оценивать.")
+            return
 
-                # ЗАПИСЬ ДЛЯ ИТОГОВОЙ ТАБЛИЦЫ
-                if "detailed_scores" not in pdata: pdata["detailed_scores"] = {}
-                if user_id in pdata["detailed_scores"]:
-                    pdata["detailed_scores"][user_id]["points"] += points
-                else:
-                    pdata["detailed_scores"][user_id] = {"name": judge_name, "points": points}
+        # Баллы + запись для итоговой таблицы
+        game.apply_score(author_id, user_id, judge_name, points)
+        store.save(game)
 
-                await update.message.reply_text(f"💸 {judge_name} {'начислил(а)' if sign > 0 else 'снял(а)'} {abs(points)}б.")
-                try:
-                    await context.bot.send_message(
-                        chat_id=author_id,
-                        text=f"💸 {judge_name} {'начислил(а)' if sign > 0 else 'снял(а)'} вам {abs(points)}б. (Всего: {pdata['score']}б)"
-                    )
-                except: pass
-            except ValueError: pass
-            return
+        await update.message.reply_text(f"💸 {judge_name} {'начислил(а)' if points > 0 else 'снял(а)'} {abs(points)}б.")
+        # Автору — сводкой, а не отдельным сообщением на каждую оценку
+        score_digests.add(context.bot, game, author_id, points, judge_name)
+        return
 
-    if text in ["повтор", "повтори", "переделай"]:
+    if kind == CMD_REPEAT:
         if is_host:
-            game.photos_this_round[author_id] = "REPEAT"
+            game.mark_repeat(author_id)
+            store.save(game)
             try: await context.bot.edit_message_caption(chat_id=MAIN_CHAT_ID, message_id=replied_id, caption="⛔️ ПОВТОР ⛔️")
             except: pass
             await update.message.reply_text("⛔️ Фото отклонено.")
             try: await context.bot.send_message(chat_id=author_id, text="⛔️ Повтор. Пришлите новое!")
             except: pass
 
-            
+
+# -------------------- ПОКАЗ ФОТО АЛЬБОМАМИ --------------------
+MEDIA_GROUP_LIMIT = 10  # больше фото в одном альбоме Telegram не принимает
+
+def split_albums(items, limit=MEDIA_GROUP_LIMIT):
+    """Делит фото на альбомы поровну, чтобы не остался альбом из одного фото."""
+    if not items:
+        return []
+    count = -(-len(items) // limit)
+    size, extra = divmod(len(items), count)
+    albums, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        albums.append(items[start:end])
+        start = end
+    return albums
+
+def photo_numbers(numbers):
+    return ", ".join(f"#{number}" for number in numbers)
+
+async def reveal_round_photos(game: Game, context: ContextTypes.DEFAULT_TYPE):
+    """Выкладывает придержанные фото раунда альбомами в случайном порядке.
+
+    Порядок и номера выбираются один раз, альбомы уходят через deliver с
+    ключом "reveal:<раунд>:<первый номер>-<последний>". Повторный вызов (из
+    end_round) досылает только невыложенные фото и пропускает альбомы,
+    которые могли дойти без ответа Telegram. О сбоях узнаёт ведущий.
+    """
+    uids = game.unpublished()
+    if not uids:
+        return
+    records = game.photos_this_round
+    fresh = [uid for uid in uids if not records[uid].number]
+    if fresh:
+        random.shuffle(fresh)
+        game.number_photos(fresh)
+        store.save(game)
+
+    # Альбомы без ответа Telegram: их фото, возможно, уже в теме
+    prefix = f"reveal:{game.current_round}:"
+    maybe_sent = [
+        tuple(map(int, key[len(prefix):].split("-")))
+        for key, message_id in game.deliveries.items() if key.startswith(prefix) and message_id is None
+    ]
+    uids = sorted(
+        (uid for uid in uids if not any(low <= records[uid].number <= high for low, high in maybe_sent)),
+        key=lambda uid: records[uid].number
+    )
+
+    failed = []
+    for chunk in split_albums(uids):
+        numbers = [records[uid].number for uid in chunk]
+        album = []
+        for uid, number in zip(chunk, numbers):
+            caption = f"\n\n💬 {records[uid].caption}" if records[uid].caption else ""
+            album.append(InputMediaPhoto(
+                media=records[uid].file_id,
+                caption=f"📸 Фото #{number} (Раунд {game.current_round}){caption}"
+            ))
+
+        sent = []
+        async def send_album(album=album):
+            if len(album) == 1:
+                sent[:] = [await context.bot.send_photo(
+                    chat_id=MAIN_CHAT_ID, message_thread_id=game.topic_id,
+                    photo=album[0].media, caption=album[0].caption, read_timeout=CRITICAL_READ_TIMEOUT
+                )]
+            else:
+                sent[:] = await context.bot.send_media_group(
+                    chat_id=MAIN_CHAT_ID, message_thread_id=game.topic_id, media=album,
+                    read_timeout=CRITICAL_READ_TIMEOUT
+                )
+            return sent[0]
+
+        key = f"{prefix}{numbers[0]}-{numbers[-1]}"
+        try:
+            await deliver(game, key, send_album)
+        except SendUncertain as e:
+            print(f"Неизвестно, дошёл ли альбом раунда {game.current_round}: {e}")
+            game.record_delivery(key, None)  # повторно не шлём, чтобы не было дубля
+            failed.append(f"⚠️ Telegram не ответил вовремя — фото {photo_numbers(numbers)} могли уже появиться в теме.")
+            continue
+        except TelegramError as e:
+            print(f"Не удалось выложить альбом раунда {game.current_round}: {e}")
+            failed.append(f"⚠️ Не удалось выложить в тему фото {photo_numbers(numbers)}.")
+            continue
+
+        for uid, msg, number in zip(chunk, sent, numbers):
+            game.publish_photo(uid, msg.message_id, number)
+    store.save(game)
+
+    if failed:
+        try:
+            await context.bot.send_message(chat_id=game.host_id, text="\n".join(failed))
+        except TelegramError as e:
+            print(f"Не удалось сообщить ведущему о невыложенных фото: {e}")
+
+# -------------------- КОНТАКТНЫЙ ЛИСТ --------------------
+SHEET_TILE = 160        # сторона клетки с миниатюрой, px
+SHEET_GAP = 4           # зазор между клетками, px
+SHEET_MAX_COLUMNS = 10
+_sheet_pool = None      # процессы, рисующие листы; создаются при первом листе
+
+def sheet_font(size=20):
+    try:
+        return ImageFont.load_default(size=size)  # Pillow 10.1+
+    except TypeError:
+        return ImageFont.load_default()
+
+def render_contact_sheet(tiles):
+    """Рисует сетку миниатюр с подписями "#N" и возвращает JPEG; tiles — [(номер, путь или None)].
+
+    Выполняется в отдельном процессе, поэтому получает и возвращает только простые значения.
+    """
+    columns = min(SHEET_MAX_COLUMNS, math.ceil(math.sqrt(len(tiles))))
+    rows = -(-len(tiles) // columns)
+    step = SHEET_TILE + SHEET_GAP
+    sheet = Image.new("RGB", (columns * step + SHEET_GAP, rows * step + SHEET_GAP), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = sheet_font()
+
+    for i, (number, path) in enumerate(tiles):
+        x = SHEET_GAP + i % columns * step
+        y = SHEET_GAP + i // columns * step
+        try:
+            if path is None:
+                raise FileNotFoundError
+            with MediaCache.mapped(path) as data, Image.open(data) as image:
+                thumb = ImageOps.contain(image.convert("RGB"), (SHEET_TILE, SHEET_TILE))
+            x += (SHEET_TILE - thumb.width) // 2
+            y += (SHEET_TILE - thumb.height) // 2
+            sheet.paste(thumb, (x, y))
+        except OSError:
+            draw.rectangle((x, y, x + SHEET_TILE - 1, y + SHEET_TILE - 1), fill="#dddddd")
+
+        # Номер — в левом верхнем углу самого фото
+        label = f"#{number}"
+        left, top, right, bottom = draw.textbbox((x + 6, y + 4), label, font=font)
+        draw.rectangle((x, y, right + 4, bottom + 2), fill="black")
+        draw.text((x + 6, y + 4), label, fill="white", font=font)
+
+    out = io.BytesIO()
+    sheet.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+def sheet_pool():
+    global _sheet_pool
+    if _sheet_pool is None:
+        # spawn, а не fork: в родителе уже работают потоки и event loop
+        _sheet_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=SHEET_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _sheet_pool
+
+def post_contact_sheet(game, context):
+    """Выкладывает в фоне контактный лист раунда; обработка апдейтов его не ждёт."""
+    if not CONTACT_SHEET or Image is None:
+        return
+    records = sorted(
+        (record.number, record.thumb_file_id or record.file_id)
+        for record in game.photos_this_round.values()
+        if record.status == PHOTO_ACCEPTED and record.number
+    )
+    if len(records) > 1:
+        run_in_background(send_contact_sheet(context.bot, game, game.current_round, records))
+
+async def send_contact_sheet(bot, game, rnd, records):
+    """Качает миниатюры (самые маленькие PhotoSize), рисует лист в пуле процессов и отправляет его в тему."""
+    fetching = asyncio.Semaphore(MEDIA_FETCH_CONCURRENCY)
+
+    async def fetch(file_id):
+        async with fetching:
+            try:
+                return await media.fetch(bot, file_id)
+            except Exception as e:  # не только сеть и диск: например, неожиданный ответ getFile
+                print(f"Не удалось скачать миниатюру {file_id}: {e!r}")
+                return None
+
+    paths = await asyncio.gather(*(fetch(file_id) for _, file_id in records))
+    tiles = [(number, path) for (number, _), path in zip(records, paths)]
+    try:
+        sheet = await asyncio.get_running_loop().run_in_executor(sheet_pool(), render_contact_sheet, tiles)
+    except Exception as e:
+        print(f"Не удалось нарисовать контактный лист раунда {rnd}: {e}")
+        return
+
+    try:
+        await deliver(game, f"sheet:{rnd}", lambda: bot.send_photo(
+            chat_id=game.chat_id,
+            message_thread_id=game.topic_id,
+            photo=sheet,
+            caption=f"🗂 Раунд {rnd}: все фото на одном листе ({len(tiles)})",
+            read_timeout=CRITICAL_READ_TIMEOUT
+        ))
+    except TelegramError as e:
+        print(f"Не удалось отправить контактный лист раунда {rnd}: {e}")
+
 # -------------------- ЗАВЕРШЕНИЕ РАУНДА --------------------
 async def stop_photo_reception(game: Game, context: ContextTypes.DEFAULT_TYPE):
+    """Останавливает приём фото раунда: сообщает ведущему и теме, выкладывает придержанные фото и лист."""
     if not game.round_active:
         await context.bot.send_message(
             chat_id=game.host_id,
@@ -1008,20 +3362,20 @@ async def stop_photo_reception(game: Game, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Блокируем приём фото
-    game.photo_reception_active = False
+    game.set(photo_reception_active=False)
+    store.save(game)
 
     # Сообщение ведущему
-    await context.bot.send_message(
-        chat_id=game.host_id,
-        text=f"📸 Приём фото для Раунда {game.current_round} остановлен."
-    )
+    await context.bot.send_message(chat_id=game.host_id, text="⏹ Приём фото остановлен.")
 
     # Сообщение в тему
     await context.bot.send_message(
         chat_id=game.chat_id,
         message_thread_id=game.topic_id,
-        text=f"📸 Приём фото для Раунда {game.current_round} остановлен."
+        text=f"⏹ Приём фото для Раунда {game.current_round} остановлен."
     )
+    await reveal_round_photos(game, context)
+    post_contact_sheet(game, context)
 
 async def end_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
     if not game.round_active:
@@ -1034,102 +3388,182 @@ async def end_round(game: Game, context: ContextTypes.DEFAULT_TYPE):
     # Фиксируем номер текущего раунда
     ended_round = game.current_round
 
-    # Останавливаем приём фото
-    game.round_active = False
+    # Придержанные фото выкладываем до архивации раунда
+    await reveal_round_photos(game, context)
 
-    # Сохраняем данные текущего раунда в общее хранилище
-    game.photos_all_rounds[ended_round] = {
-        uid: pdata for uid, pdata in game.photos_this_round.items() if isinstance(pdata, dict)
-    }
+    # Оценки за раунд — всем сводкой сразу
+    score_digests.flush(context.bot, game)
+
+    # Останавливаем приём фото
+    game.set(round_active=False)
 
-    # Теперь можно очищать текущий раунд
-    game.photos_this_round.clear()
+    # Сохраняем данные текущего раунда в общее хранилище и очищаем текущий раунд
+    game.archive_round()
+    store.save(game)
 
     # # Сообщение ведущему
     # await context.bot.send_message(chat_id=game.host_id, text=f"🏴 Раунд {ended_round} завершён.")
 
     # Автовыбывание участников за отсутствие фото
     if game.mode == "elimination":
-        for uid, pdata in game.participants.items():
-            # Проверяем, отправлял ли участник фото в этом раунде
-            sent_rounds = [r for r, photos in game.photos_all_rounds.items() if uid in photos]
-            if not pdata.get("eliminated") and ended_round not in sent_rounds:
-                pdata["eliminated"] = True
-                pdata["round_out"] = ended_round
-                nickname = pdata["nickname"]
-                await context.bot.send_message(
-                    chat_id=game.chat_id,
-                    message_thread_id=game.topic_id,
-                    text=f"💤 @{nickname} выбывает за пропуск раунда {ended_round} 💤"
-                    if game.show_eliminated_nicks else f"💤 Игрок выбывает за пропуск раунда {ended_round} 💤"
-                )
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"💤 Вы выбываете за пропуск раунда {ended_round} 💤"
-                )
+        dropped = [
+            uid for uid, pdata in game.participants.items()
+            if not pdata.eliminated and not game.submitted_in(uid, ended_round)
+        ]
+        if not dropped:
+            return
+
+        for uid in dropped:
+            game.eliminate(uid, ended_round)
+        store.save(game)
+
+        # Одно сообщение в тему на всех выбывших (длинный список — страницами) + параллельные ЛС
+        if game.show_eliminated_nicks:
+            lines = [
+                f"💤 @{game.participants[uid].nickname} выбывает за пропуск раунда {ended_round} 💤"
+                for uid in dropped
+            ]
+        elif len(dropped) == 1:
+            lines = [f"💤 Игрок выбывает за пропуск раунда {ended_round} 💤"]
+        else:
+            lines = [f"💤 {len(dropped)} игроков выбывают за пропуск раунда {ended_round} 💤"]
+
+        await send_pages(
+            game, context, f"dropped:{ended_round}", paginate(lines),
+            f"Выбывшие за пропуск раунда {ended_round}", parse_mode=None
+        )
+        start_broadcast(context, BroadcastJob.to_players(
+            f"Выбывание за пропуск раунда {ended_round}", game, dropped,
+            f"💤 Вы выбываете за пропуск раунда {ended_round} 💤"
+        ))
 
 # -------------------- ЗАВЕРШЕНИЕ ИГРЫ --------------------
+MESSAGE_LIMIT = 4096  # символов в одном сообщении Telegram
+PAGE_HEADER_RESERVE = 64  # место под заголовок страницы
+
 def escape_markdown(text):
-    return re.sub(r'([_*[\]()~`>#+-=|{}.!])', r'\\\1', text)
+    """Экранирует текст для MarkdownV2."""
+    return re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', str(text))
+
+def tg_len(text):
+    """Длина текста так, как её считает Telegram (в единицах UTF-16)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def fit_line(line, limit):
+    """Обрезает слишком длинную строку, не разрывая экранирование MarkdownV2."""
+    if tg_len(line) <= limit:
+        return line
+    cut = line[:limit - 1]
+    while tg_len(cut) > limit - 1:
+        cut = cut[:-1]
+    if (len(cut) - len(cut.rstrip("\\"))) % 2:
+        cut = cut[:-1]
+    return cut + "…"
+
+def paginate(lines, limit=MESSAGE_LIMIT):
+    """Раскладывает строки по страницам не длиннее limit, разрывая только между строками."""
+    pages, page, size = [], [], 0
+    for line in lines:
+        line = fit_line(line, limit)
+        length = tg_len(line)
+        if page and size + 1 + length > limit:
+            pages.append("\n".join(page))
+            page, size = [], 0
+        size += length + (1 if page else 0)
+        page.append(line)
+    if page:
+        pages.append("\n".join(page))
+    return pages
+
+def result_lines(game):
+    """Строки итогов в порядке таблицы лидеров, уже экранированные для MarkdownV2."""
+    lines = []
+    for uid in game.ranked_participants():
+        pdata = game.participants[uid]
 
-async def end_game(game: Game, context: ContextTypes.DEFAULT_TYPE):
-    if not game: return
-    game.round_active = False
+        # Основная строка: Имя - 10б
+        line = f"{player_name(uid, pdata)} — {pdata.score} б"
 
-    text_lines = ["🏆 *Результаты игры:*"]
-    
-    # Сортировка по баллам
-    sorted_participants = sorted(
-        game.participants.values(),
-        key=lambda x: (x["score"], -x.get("round_out", 0)),
-        reverse=True
-    )
+        # Разбивка по судьям: "5 от дашули"
+        parts = [
+            f"{d.points} от {d.name}"
+            for d in pdata.detailed_scores.values() if d.points != 0
+        ]
+        if parts:
+            line += f" ({', '.join(parts)})"
+
+        if pdata.eliminated:
+            line += f" ☠️ выбыл в раунде {pdata.round_out or '?'}"
+
+        lines.append(escape_markdown(line))
+    return lines
+
+def results_pages(game):
+    """Итоги игры страницами, каждая помещается в одно сообщение."""
+    pages = paginate(result_lines(game), MESSAGE_LIMIT - PAGE_HEADER_RESERVE)
+    if len(pages) <= 1:
+        return ["\n".join(["🏆 *Результаты игры:*", *pages])]
+    return [
+        f"🏆 *Результаты игры* \\({number}/{len(pages)}\\)\n{page}"
+        for number, page in enumerate(pages, start=1)
+    ]
 
-    for pdata in sorted_participants:
-        user_display = f"@{pdata['username']}" if pdata.get("username") else pdata["nickname"]
-        score = pdata['score']
-        
-        # Основная строка: Имя - 10б
-        line = f"{escape_markdown(user_display)} — {score} б"
-        
-        # ДОБАВЛЯЕМ РАЗБИВКУ (кто сколько дал)
-        detailed = pdata.get("detailed_scores", {})
-        if detailed:
-            # Собираем части типа "5 от дашули"
-            parts = []
-            for d in detailed.values():
-                if d['points'] != 0:
-                    parts.append(f"{d['points']} от {d['name']}")
-            
-            if parts:
-                # Добавляем в скобках к строке результата
-                # Важно: в MarkdownV2 скобки нужно экранировать \( \)
-                line += f" \\({', '.join(parts)}\\)"
-        
-        if pdata.get("eliminated"):
-            line += f" ☠️ выбыл в раунде {pdata.get('round_out', '?')}"
-        
-        text_lines.append(line)
+async def send_pages(game, context, key, pages, title, parse_mode="MarkdownV2"):
+    """Отправляет страницы в тему игры строго по порядку; каждая — со своим ключом идемпотентности.
 
-    text = "\n".join(text_lines)
+    Возвращает True, если дошли все страницы. Иначе ведущий узнаёт, какая
+    страница не ушла, и получает её вместе со следующими в ЛС, чтобы
+    переслать в тему.
+    """
+    for number, page in enumerate(pages, start=1):
+        try:
+            await deliver(game, f"{key}:{number}", lambda page=page: context.bot.send_message(
+                chat_id=game.chat_id,
+                message_thread_id=game.topic_id,
+                text=page,
+                parse_mode=parse_mode,
+                read_timeout=CRITICAL_READ_TIMEOUT
+            ))
+        except TelegramError as e:
+            print(f"Не удалось отправить страницу {number}/{len(pages)} ({key}): {e}")
+            # Следующие страницы без этой пришли бы не по порядку
+            await send_unsent_pages(game, context, title, pages, number, parse_mode)
+            return False
+    return True
+
+async def send_unsent_pages(game, context, title, pages, number, parse_mode):
+    """Сообщает ведущему, с какой страницы текст не дошёл до темы, и присылает ему эти страницы."""
+    rest = "" if number == len(pages) else " и следующие"
+    try:
+        await context.bot.send_message(
+            chat_id=game.host_id,
+            text=f"⚠️ {title}: в тему не ушла страница {number} из {len(pages)}{rest}. "
+                 f"Ниже — их текст, перешлите его в тему."
+        )
+        for page in pages[number - 1:]:
+            await context.bot.send_message(chat_id=game.host_id, text=page, parse_mode=parse_mode)
+    except TelegramError as e:
+        print(f"Не удалось прислать ведущему неотправленные страницы ({title}): {e}")
 
-    # Отправка в чат
-    await context.bot.send_message(
-        chat_id=game.chat_id,
-        message_thread_id=game.topic_id,
-        text=text,
-        parse_mode="MarkdownV2"
-    )
+async def end_game(game: Game, context: ContextTypes.DEFAULT_TYPE):
+    if not game: return
+    score_digests.flush(context.bot, game)  # сводки уходят в фоне, итоги их не ждут
+    game.round_active = False
+
+    # Итоги в тему — столько сообщений, сколько нужно
+    await send_pages(game, context, "results", results_pages(game), "Итоги игры")
 
     # Отправка личных сообщений каждому участнику 
-    host_user = await context.bot.get_chat(game.host_id)
-    host_username = f"@{host_user.username}" if host_user.username else "Ведущий"
+    host_profile = await profiles.fetch(context.bot, game.host_id)
+    host_username = f"@{host_profile['username']}" if host_profile and host_profile["username"] else "Ведущий"
+
+    top_score = game.leaderboard.top_score()
+    results = BroadcastJob("Итоги игры", [], host_id=game.host_id, game_id=game.game_id)
 
     for user_id, pdata in game.participants.items():
-        user_display = f"@{pdata['username']}" if pdata.get("username") else pdata["nickname"]
-        score = pdata["score"]
-        eliminated = pdata.get("eliminated", False)
-        round_out = pdata.get("round_out")
+        score = pdata.score
+        eliminated = pdata.eliminated
+        round_out = pdata.round_out
     
         text = f"🏆 Игра завершена. "
 
@@ -1151,280 +3585,188 @@ async def end_game(game: Game, context: ContextTypes.DEFAULT_TYPE):
                 text += f"\nВаш результат {score}б 💰"
                 if eliminated:
                     text += f" Но вы выбыли в {round_out} раунде из {game.current_round} ☠️"
-                elif score == max([p['score'] for p in game.participants.values()]):
+                elif score == top_score:
                     text += " Вы победили, у вас наибольшее количество очков 🎁"
 
-        text += f"\nВедущим был/а @{host_username}.\n\n"
+        text += f"\nВедущим был/а {host_username}.\n\n"
         text += "Хотите устроить свою игру? Используйте команду /start_game 🪩"
 
-        try:
-            await context.bot.send_message(chat_id=user_id, text=text)
-        except Exception as e:
-            print(f"🤡 Не удалось отправить личное сообщение {user_display}: {e}")
+        results.items.append([user_id, {"text": text}, None])
 
-    # Удаляем все данные о текущей игре
-    games.pop(game.host_id, None)
+    start_broadcast(context, results)
 
-# -------------------- ХЭНДЛЕР МЕНЮ ВЕДУЩЕГО --------------------
-async def host_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if not query:
-        return
-    await query.answer()
-    user_id = query.from_user.id
-    game = next((g for g in games.values() if g.host_id == user_id), None)
-    if not game:
-        await query.answer("👊 Вы не являетесь ведущим ни одной игры.", show_alert=True)
-        return
+    # Удаляем игру из активных; в базе она остаётся завершённой
+    game.finish()
+    store.save(game)
+    games.remove(game)
+    forget_join_choice(context, game)
 
-    data = query.data
+    if EXPORT_ON_END:
+        run_in_background(export_game(context.bot, game, game.host_id))
 
-    # -------------------- Завершение раунда --------------------
-    if data == "host_end_round":
+# -------------------- ХЭНДЛЕР МЕНЮ ВЕДУЩЕГО --------------------
+@on_callback("stop", started=True)
+async def on_stop_photo(query, context, game, args):
+    await stop_photo_reception(game, context)
+    await show_host_menu(game, context)  # обновляем меню
+
+@on_callback("stopped", started=True)
+async def on_stop_photo_disabled(query, context, game, args):
+    pass  # приём уже остановлен — кнопка только показывает состояние
+
+# -------------------- Следующий раунд --------------------
+@on_callback("next", started=True)
+async def on_next_round(query, context, game, args):
+    # Если раунд был активен — завершаем
+    if game.round_active:
         await end_round(game, context)
-        await show_host_menu(game, context)
-        return
-    
-    if data == "host_stop_photo":
-        game.photo_reception_active = False
-        await context.bot.send_message(chat_id=game.host_id, text="⏹ Приём фото остановлен.")
+        game.round_active = False
+
+    # Меняем текст меню → "Раунд завершён" и убираем кнопки (одной правкой)
+    if game.host_menu_message_id:
+        host_menu.retire(
+            context.bot, game.host_id, game.host_menu_message_id,
+            f"🏴 Раунд {game.current_round} завершён."
+        )
+
+    # Сбрасываем старое меню и переходим на следующий раунд
+    game.next_round()
+    store.save(game)
+
+    # -----------------------------
+    #         РЕФ-МОДЕ ВКЛ
+    # -----------------------------
+    if game.ref_mode:
+
         await context.bot.send_message(
-            chat_id=game.chat_id,
-            message_thread_id=game.topic_id,
-            text=f"⏹ Приём фото для Раунда {game.current_round} остановлен."
+            chat_id=game.host_id,
+            text=f"📸 Отправьте реф для Раунда {game.current_round}."
         )
-        await show_host_menu(game, context)  # обновляем меню
+
         return
 
-    # -------------------- Следующий раунд --------------------
-    if data == "host_next_round":
-    
-        # Если раунд был активен — завершаем
-        if game.round_active:
-            await end_round(game, context)
-            game.round_active = False
+    # -----------------------------
+    #        БЕЗ РЕФОВ (режим обычный)
+    # -----------------------------
 
-        # Меняем текст меню → "Раунд завершён"
-        try:
-            await context.bot.edit_message_text(
-                chat_id=game.host_id,
-                message_id=game.host_menu_message_id,
-                text=f"🏴 Раунд {game.current_round} завершён."
-            )
-        except:
-            pass
+    await start_round(game, context)   # ← сразу стартуем раунд
+    await show_host_menu(game, context)
 
-        # Удаляем кнопки
-        try:
-            await context.bot.edit_message_reply_markup(
-                chat_id=game.host_id,
-                message_id=game.host_menu_message_id,
-                reply_markup=None
-            )
-        except:
-            pass
+# # -------------------- УЧАСТНИК ХОЧЕТ ПОКИНУТЬ ИГРУ --------------------
+# if data.startswith("leave_"):
+#     uid = int(data.split("_")[1])
 
-        # Сбрасываем старое меню
-        game.host_menu_message_id = None
+#     # Проверка: это сообщение для текущего пользователя
+#     if query.from_user.id != uid:
+#         return
 
-        # Переходим на следующий раунд
-        game.current_round += 1
-        game.current_ref_sent = False
-        game.photo_reception_active = True
+#     keyboard = [
+#         [InlineKeyboardButton("✅ Да, покинуть", callback_data=f"leave_confirm_{uid}")],
+#         [InlineKeyboardButton("❌ Отмена", callback_data=f"leave_cancel_{uid}")]
+#     ]
 
-        # -----------------------------
-        #         РЕФ-МОДЕ ВКЛ
-        # -----------------------------
-        if game.ref_mode:
+#     await query.edit_message_text(
+#         "Вы уверены, что хотите покинуть игру?",
+#         reply_markup=InlineKeyboardMarkup(keyboard)
+#     )
+#     return
 
-            await context.bot.send_message(
-                chat_id=game.host_id,
-                text=f"📸 Отправьте реф для Раунда {game.current_round}."
-            )
+# # -------------------- УЧАСТНИК ПОДТВЕРДИЛ ВЫХОД --------------------
+# if data.startswith("leave_confirm_"):
+#     uid = int(data.split("_")[2])
 
-            return
+#     # Игнорируем, если нажал не тот пользователь
+#     if query.from_user.id != uid:
+#         return
 
-        # -----------------------------
-        #        БЕЗ РЕФОВ (режим обычный)
-        # -----------------------------
+#     if uid in game.participants:
+#         game.participants[uid]["eliminated"] = True
+#         game.participants[uid]["round_out"] = game.current_round
 
-        await start_round(game, context)   # ← сразу стартуем раунд
-        await show_host_menu(game, context)
-        return
-    
-    # # -------------------- УЧАСТНИК ХОЧЕТ ПОКИНУТЬ ИГРУ --------------------
-    # if data.startswith("leave_"):
-    #     uid = int(data.split("_")[1])
-
-    #     # Проверка: это сообщение для текущего пользователя
-    #     if query.from_user.id != uid:
-    #         return
-
-    #     keyboard = [
-    #         [InlineKeyboardButton("✅ Да, покинуть", callback_data=f"leave_confirm_{uid}")],
-    #         [InlineKeyboardButton("❌ Отмена", callback_data=f"leave_cancel_{uid}")]
-    #     ]
-
-    #     await query.edit_message_text(
-    #         "Вы уверены, что хотите покинуть игру?",
-    #         reply_markup=InlineKeyboardMarkup(keyboard)
-    #     )
-    #     return
-
-    # # -------------------- УЧАСТНИК ПОДТВЕРДИЛ ВЫХОД --------------------
-    # if data.startswith("leave_confirm_"):
-    #     uid = int(data.split("_")[2])
-
-    #     # Игнорируем, если нажал не тот пользователь
-    #     if query.from_user.id != uid:
-    #         return
-
-    #     if uid in game.participants:
-    #         game.participants[uid]["eliminated"] = True
-    #         game.participants[uid]["round_out"] = game.current_round
-
-    #     await query.edit_message_text(f"❌ Вы покинули игру добровольно в {game.current_round} раунде.")
-
-    #     await context.bot.send_message(
-    #         chat_id=MAIN_CHAT_ID,
-    #         message_thread_id=game.topic_id,
-    #         text=f"⚠️ Участник @{query.from_user.username} покинул игру добровольно в {game.current_round} раунде."
-    #     )
-    #     return
-
-    # # -------------------- УЧАСТНИК ОТМЕНИЛ ВЫХОД --------------------
-    # if data.startswith("leave_cancel_"):
-    #     uid = int(data.split("_")[2])
-
-    #     # Игнорируем, если нажал не тот пользователь
-    #     if query.from_user.id != uid:
-    #         return
-
-    #     await query.edit_message_text(
-    #         "Вы остались в игре 💖"
-    #     )
-    #     return
-
-    # -------------------- Завершение игры (подтверждение) --------------------
-    if data == "host_end_game":
-    
-        # --- собираем участников и сортируем ---
-        scores_list = []
-        for pdata in game.participants.values():
-            scores_list.append({
-                "username": pdata.get("username"),
-                "nickname": pdata.get("nickname") or "Участник",
-                "score": pdata["score"]
-            })
-
-        # сортировка по убыванию баллов
-        scores_list.sort(key=lambda x: x["score"], reverse=True)
-
-        # --- распределяем по местам ---
-        places = {}      # {place_number: [players]}
-        current_place = 1
-        last_score = None
-
-        for player in scores_list:
-            score = player["score"]
-
-            if last_score is None:
-                # первый человек — первое место
-                places[current_place] = [player]
-                last_score = score
-            else:
-                if score == last_score:
-                    # такой же балл → то же место
-                    places[current_place].append(player)
-                else:
-                    # другой балл → следующее место
-                    current_place += 1
-                    places[current_place] = [player]
-                    last_score = score
-
-        # --- ищем места где >1 игрок (ничьи) ---
-        tied_places = [place for place, players in places.items() if len(players) > 1]
-
-        # формируем текст предупреждения
-        if tied_places:
-            places_text = ", ".join(str(p) for p in tied_places)
-            text = f"⚠️ Несколько победителей с одинаковыми баллами на {places_text} месте. Хотите завершить игру?"
-        else:
-            text = "Вы уверены, что хотите завершить игру?"
+#     await query.edit_message_text(f"❌ Вы покинули игру добровольно в {game.current_round} раунде.")
 
-        # --- кнопки ---
-        keyboard = [
-            [InlineKeyboardButton("✅ Подтвердить завершение", callback_data="host_force_end_game")],
-            [InlineKeyboardButton("❌ Отменить", callback_data="host_cancel_end_game")]
-        ]
+#     await context.bot.send_message(
+#         chat_id=MAIN_CHAT_ID,
+#         message_thread_id=game.topic_id,
+#         text=f"⚠️ Участник @{query.from_user.username} покинул игру добровольно в {game.current_round} раунде."
+#     )
+#     return
 
-        # --- редактируем меню ---
-        try:
-            await context.bot.edit_message_text(
-                chat_id=game.host_id,
-                message_id=game.host_menu_message_id,
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                pass
-            else:
-                print("Ошибка host_end_game:", e)
+# # -------------------- УЧАСТНИК ОТМЕНИЛ ВЫХОД --------------------
+# if data.startswith("leave_cancel_"):
+#     uid = int(data.split("_")[2])
 
-    # -------------------- Подтверждение завершения --------------------
-    if data == "host_force_end_game":
-        # Завершаем текущий раунд, если он активен
-        if game.round_active:
-            await end_round(game, context)
+#     # Игнорируем, если нажал не тот пользователь
+#     if query.from_user.id != uid:
+#         return
 
-        total_rounds = game.current_round or 0
-        await end_game(game, context)
+#     await query.edit_message_text(
+#         "Вы остались в игре 💖"
+#     )
+#     return
 
-        # Убираем меню у ведущего
-        try:
-            await context.bot.edit_message_reply_markup(
-                chat_id=user_id,
-                message_id=game.host_menu_message_id,
-                reply_markup=None
-            )
-        except BadRequest as e:
-            if "Message to edit not found" not in str(e):
-                print("Ошибка при удалении меню:", e)
 
-        # Новое сообщение: игра окончена
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🎉 Игра окончена. Всего {total_rounds} раундов. \n\n 🎮 Для создания новой игры нажмите /start_game",
-        )
+# -------------------- Завершение игры (подтверждение) --------------------
+@on_callback("end", started=True)
+async def on_end_game(query, context, game, args):
+    # --- ищем места где >1 игрок (ничьи) ---
+    tied_places = game.leaderboard.tied_places()
+
+    # формируем текст предупреждения
+    if tied_places:
+        places_text = ", ".join(str(p) for p in tied_places)
+        text = f"⚠️ Несколько победителей с одинаковыми баллами на {places_text} месте. Хотите завершить игру?"
+    else:
+        text = "Вы уверены, что хотите завершить игру?"
+
+    # --- кнопки ---
+    keyboard = [
+        [callback_button("✅ Подтвердить завершение", "endok", game)],
+        [callback_button("❌ Отменить", "endno", game)]
+    ]
 
+    # --- редактируем меню (или присылаем, если ведущий его ещё не открывал) ---
+    if game.host_menu_message_id:
+        host_menu.edit(context.bot, game.host_id, game.host_menu_message_id, text, InlineKeyboardMarkup(keyboard))
         return
 
-    # -------------------- Отмена завершения --------------------
-    if data == "host_cancel_end_game":
-        await show_host_menu(game, context)
+    try:
+        msg = await host_menu.send(context.bot, game.host_id, text, InlineKeyboardMarkup(keyboard))
+    except TelegramError as e:
+        print(f"Ошибка on_end_game: {e}")
         return
+    game.set(host_menu_message_id=msg.message_id)
+    store.save(game)
 
-    # -------------------- Начать новую игру --------------------
-    if data == "start_new_game":
-        # Имитация Update для ЛС бота
-        class FakeMessage:
-            chat = type('Chat', (), {'type': 'private'})
-            from_user = type('User', (), {'id': user_id})()
-            async def reply_text(self, text, reply_markup=None): pass
+# -------------------- Подтверждение завершения --------------------
+@on_callback("endok", started=True)
+async def on_force_end_game(query, context, game, args):
+    # Завершаем текущий раунд, если он активен
+    if game.round_active:
+        await end_round(game, context)
 
-        fake_update = type('Update', (), {'message': FakeMessage()})()
-        await start_game(fake_update, context)
-        return
+    total_rounds = game.current_round or 0
+    await end_game(game, context)
+
+    # Убираем меню у ведущего
+    if game.host_menu_message_id:
+        host_menu.retire(context.bot, game.host_id, game.host_menu_message_id)
+
+    # Новое сообщение: игра окончена
+    await context.bot.send_message(
+        chat_id=game.host_id,
+        text=f"🎉 Игра окончена. Всего {total_rounds} раундов. \n\n 🎮 Для создания новой игры нажмите /start_game",
+    )
+
+# -------------------- Отмена завершения --------------------
+@on_callback("endno", started=True)
+async def on_cancel_end_game(query, context, game, args):
+    await show_host_menu(game, context)
 
 # -------------------- КОМАНДА /call_people --------------------
 async def _call_participants_private(game, context):
-    # Находим участников без фото
-    to_call = []
-    for uid, pdata in game.participants.items():
-        status = game.photos_this_round.get(uid)
-        if not pdata.get("eliminated") and (status is None or status == "REPEAT"):
-            to_call.append(uid)
+    # Участники без фото (ещё не прислали или на повторе)
+    to_call = list(game.pending_ids)
 
     if not to_call:
         return None, None
@@ -1449,22 +3791,15 @@ async def _call_participants_private(game, context):
         print(f"Ошибка при отправке ЛС ведущему: {e}")
 
     # Отправка ЛС участникам
-    for uid in to_call:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "💖 Перейти в тему",
-                url=f"https://t.me/c/{str(MAIN_CHAT_ID)[4:]}/{game.last_round_message_id}"
-            )]
-            # ,[InlineKeyboardButton("🚪 Покинуть игру", callback_data=f"leave_{uid}")]
-        ])
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text="🛎️ Вас вызывает ведущий! 🛎️",
-                reply_markup=keyboard
-            )
-        except Exception as e:
-            print(f"Ошибка при отправке ЛС участнику {uid}: {e}")
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            "💖 Перейти в тему",
+            url=f"https://t.me/c/{str(MAIN_CHAT_ID)[4:]}/{game.last_round_message_id}"
+        )]
+    ])
+    start_broadcast(context, BroadcastJob.to_players(
+        "Вызов участников", game, to_call, "🛎️ Вас вызывает ведущий! 🛎️", keyboard
+    ))
 
     return to_call, None
 
@@ -1473,7 +3808,7 @@ async def call_people(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user_id = update.message.from_user.id
-    game = next((g for g in games.values() if g.host_id == user_id), None)
+    game = games.for_host(user_id)
 
     if not game:
         await update.message.reply_text("👀 Вы не ведущий ни одной игры.")
@@ -1491,7 +3826,7 @@ async def check_photos_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user_id = update.message.from_user.id
     # Ищем игру, где этот пользователь ведущий
-    game = next((g for g in games.values() if g.host_id == user_id), None)
+    game = games.for_host(user_id)
     if not game:
         await update.message.reply_text("👀 Вы не ведущий ни одной игры.")
         return
@@ -1501,13 +3836,11 @@ async def check_photos_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     topic_id = thread_id or game.topic_id
 
     total = len(game.participants)
-    not_sent = sum(
-        1 for uid, pdata in game.participants.items()
-        if not pdata.get("eliminated") and (game.photos_this_round.get(uid) is None or game.photos_this_round.get(uid) == "REPEAT")
-    )
+    not_sent = game.pending_count
 
     # ЛС ведущему
-    await update.message.reply_text(f"Не прислали фото: {not_sent} из {total}")
+    repeat_text = f" (на повторе: {game.repeat_count})" if game.repeat_count else ""
+    await update.message.reply_text(f"Не прислали фото: {not_sent} из {total}{repeat_text}")
 
     # Сообщение в теме
     await context.bot.send_message(
@@ -1518,15 +3851,17 @@ async def check_photos_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 #-------------------- КОМАНДА /show_players --------------------
 async def show_players(update, context):
-    game = next((g for g in games.values() if g.started), None)
+    if not update.message:
+        return
+    game = find_game_for_message(update)
     if not game:
         return
 
 
     players = [
-        f"• @{p['username']}" if p.get("username") else f"• {p.get('nickname', 'Без ника')}"
+        f"• {player_name(uid, p) or 'Без ника'}"
         for uid, p in game.participants.items()
-        if not p.get("eliminated", False)
+        if not p.eliminated
     ]
 
     text = "Участники в игре:\n" + "\n".join(players)
@@ -1537,24 +3872,672 @@ async def show_players(update, context):
     # в тему
     await context.bot.send_message(chat_id=MAIN_CHAT_ID, message_thread_id=game.topic_id, text=text)
 
-# -------------------- MAIN --------------------
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start_game", start_game))
-    app.add_handler(CallbackQueryHandler(host_menu_handler, pattern=r'^host_'))
-    app.add_handler(CallbackQueryHandler(callback_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.REPLY, set_jury_text_handler))
-    app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, photo_handler))
-    app.add_handler(MessageHandler((filters.REPLY) & (filters.TEXT | filters.CAPTION),reply_on_photo_handler))
-    app.add_handler(MessageHandler(filters.TEXT & filters.REPLY,reply_on_photo_handler))
-    app.add_handler(CommandHandler("call_people", call_people))
+# -------------------- КОМАНДА /export --------------------
+EXPORT_UPLOAD_LIMIT = 50 * 1024 * 1024  # Bot API не принимает от бота документы больше 50 МБ
+_exports_running = set()  # game_id, чей архив сейчас собирается
+
+def export_entries(game):
+    """Снимок игры для архива: строки манифеста без имени файла, по одной на принятое фото.
+
+    Собирается сразу целиком: пока архив качается и пишется, игра идёт
+    дальше и её словари меняются. Номер — тот же "Фото #N", что в теме;
+    фото без номера (или с уже занятым) получают следующие за наибольшим,
+    так что имена файлов в раунде не повторяются.
+    """
+    entries = []
+    for rnd in sorted(game.photos_all_rounds):
+        photos = [(uid, record) for uid, record in game.photos_all_rounds[rnd].items() if record.status == PHOTO_ACCEPTED]
+        used, unnumbered, numbered = set(), [], []
+        for uid, record in photos:
+            if record.number and record.number not in used:
+                used.add(record.number)
+                numbered.append((record.number, uid, record))
+            else:
+                unnumbered.append((uid, record))
+        extra = itertools.count(max(used, default=0) + 1)
+        numbered += [(next(extra), uid, record) for uid, record in unnumbered]
+        for number, uid, record in sorted(numbered, key=lambda item: item[0]):
+            pdata = game.participants[uid]
+            judges = "; ".join(f"{d.name}: {d.points:+d}" for d in pdata.detailed_scores.values())
+            entries.append((rnd, number, uid, record.file_id, record.caption, player_name(uid, pdata), pdata.score, judges))
+    return entries
+
+def archive_name(rnd, number, name) -> str:
+    safe = re.sub(r"[^\w-]+", "_", name).strip("_") or "photo"
+    return f"round_{rnd:02d}/{number:03d}_{safe}.jpg"
+
+def write_manifest(archive, rows):
+    with io.TextIOWrapper(archive.open("manifest.csv", "w"), encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["round", "number", "file", "author", "user_id", "score", "judges", "caption"])
+        writer.writerows(rows)
+
+async def build_archive(bot, game, path):
+    """Пишет в path ZIP со всеми фото игры и manifest.csv. Возвращает (фото в архиве, не скачалось).
+
+    Фото качаются через media не больше EXPORT_CONCURRENCY сразу и по мере
+    готовности дописываются в архив по порядку — память не зависит от
+    размера игры.
+    """
+    rows, missing = [], 0
+    window = deque()  # [(запись, задача загрузки)] — скачиваются, пока пишется предыдущее
+
+    async def fetch(file_id):
+        try:
+            return await media.fetch(bot, file_id)
+        except Exception as e:  # не только сеть и диск: например, неожиданный ответ getFile
+            print(f"Не удалось скачать фото {file_id} для архива: {e!r}")
+            return None
+
+    async def add_next(archive):
+        nonlocal missing
+        (rnd, number, uid, file_id, caption, name, score, judges), task = window.popleft()
+        arcname = archive_name(rnd, number, name)
+        source = await task
+        try:
+            if source is None:
+                raise FileNotFoundError(file_id)
+            await asyncio.to_thread(archive.write, source, arcname, zipfile.ZIP_STORED)
+        except OSError:
+            missing += 1
+            arcname = ""
+        rows.append([rnd, number, arcname, name, uid, score, judges, caption or ""])
+
+    entries = export_entries(game)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for entry in entries:
+            window.append((entry, asyncio.create_task(fetch(entry[3]))))
+            if len(window) >= EXPORT_CONCURRENCY:
+                await add_next(archive)
+        while window:
+            await add_next(archive)
+        await asyncio.to_thread(write_manifest, archive, rows)
+    return len(rows) - missing, missing
+
+async def export_game(bot, game, chat_id):
+    """Собирает архив фото игры во временный файл и отправляет его в chat_id документом."""
+    if game.game_id in _exports_running:
+        await bot.send_message(chat_id=chat_id, text="📦 Архив этой игры уже собирается.")
+        return
+    _exports_running.add(game.game_id)
+    fd, path = tempfile.mkstemp(prefix=f"couture-{game.game_id}-", suffix=".zip")
+    os.close(fd)
+    try:
+        await bot.send_message(chat_id=chat_id, text="📦 Собираю архив фото игры…")
+        added, missing = await build_archive(bot, game, path)
+        size = os.path.getsize(path)
+        if size > EXPORT_UPLOAD_LIMIT:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"⚠️ Архив получился {size // 2**20} МБ — Telegram не даёт боту отправить файл больше 50 МБ."
+            )
+            return
+        caption = f"📦 {topic_title(game.topic_id)}: {added} фото"
+        if missing:
+            caption += f", не удалось скачать: {missing}"
+        caption += f"\nИгра {game.game_id}"
+        with open(path, "rb") as f:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=f,
+                filename=f"couture_{game.game_id}.zip",
+                caption=caption,
+                read_timeout=120,
+                write_timeout=120
+            )
+    except TelegramError as e:
+        print(f"Не удалось отправить архив игры {game.game_id}: {e}")
+    finally:
+        _exports_running.discard(game.game_id)
+        os.remove(path)
+
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [id игры] — архив всех фото игры ведущему в личку (по умолчанию — текущая или последняя игра)."""
+    if not update.message:
+        return
+
+    user_id = update.effective_user.id
+    game_id = context.args[0] if context.args else None
+    game = games.by_id.get(game_id) if game_id else games.for_host(user_id)
+
+    # Завершённые игры есть только в базе
+    if game is None or not game.started:
+        if worker_index is None:  # обработчик пишет на диск только между апдейтами; база отстаёт на один сброс
+            await store.flush()
+        game = await store.load_host_game(user_id, game_id)
+
+    if not game or game.host_id != user_id:
+        await update.message.reply_text("📭 Не нашёл вашей игры. Архив может запросить только ведущий.")
+        return
+
+    run_in_background(export_game(context.bot, game, user_id))
+
+# -------------------- КОМАНДА /standings --------------------
+STANDINGS_LIMIT = 10
+
+async def standings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message:
+        return
+    game = find_game_for_message(update)
+    if not game:
+        await update.message.reply_text("👀 Игра ещё не запущена ведущим.")
+        return
+
+    user_id = update.message.from_user.id
+    is_private = update.message.chat.type == "private"
+    # Без показа ников имена видит только ведущий в ЛС
+    show_names = game.show_nicks or (is_private and user_id == game.host_id)
+
+    lines = [f"🏆 Таблица лидеров (Раунд {game.current_round}):"]
+    for place, score, uids in game.leaderboard.places(STANDINGS_LIMIT):
+        if show_names:
+            names = ", ".join(player_name(uid, game.participants[uid]) for uid in uids)
+            lines.append(f"{place}. {names} — {score}б")
+        else:
+            lines.append(f"{place}. {score}б — игроков: {len(uids)}")
+
+    rank = game.leaderboard.rank(user_id)
+    if is_private and rank:
+        lines.append(f"\nВаше место: {rank} ({game.participants[user_id].score}б)")
+
+    await update.message.reply_text("\n".join(lines))
+
+# -------------------- ПРИЛОЖЕНИЕ --------------------
+class UpdateQueue(asyncio.Queue):
+    """Очередь апдейтов, ограниченная вместе с теми, что уже в обработке.
+
+    С concurrent_updates PTB сразу забирает апдейт из очереди и заводит на
+    него задачу, которая ждёт своей очереди уже в памяти, — обычный maxsize
+    так никогда и не заполняется. Здесь место занимает put(), а освобождает
+    task_done(), который PTB вызывает, закончив обработку апдейта.
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self._slots = asyncio.Semaphore(limit)
+
+    async def put(self, item):
+        await self._slots.acquire()
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self._slots.release()
+
+def new_builder():
+    """ApplicationBuilder с токеном, ограниченной очередью апдейтов и своим Bot API, если он задан."""
+    # Противодавление: пока в очереди и в обработке UPDATE_QUEUE_SIZE апдейтов,
+    # вебхук не отвечает Telegram (а polling не забирает новые апдейты)
+    builder = ApplicationBuilder().token(BOT_TOKEN).update_queue(UpdateQueue(UPDATE_QUEUE_SIZE))
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot").base_file_url(f"{BOT_API_URL.rstrip('/')}/file/bot")
+    return builder
+
+def build_app(rate_share=1, updater=True, group_tokens=None):
+    """Приложение со всеми обработчиками игры."""
+    builder = (
+        new_builder()
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(PriorityRateLimiter(share=rate_share, group_tokens=group_tokens))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)  # апдейты кладёт приёмный процесс
+    app = builder.build()
+
+    if RECORD_UPDATES:
+        app.add_handler(TypeHandler(Update, record_update), group=-2)
+    app.add_handler(TypeHandler(Update, remember_profiles), group=-1)
+    # Апдейты обрабатываются параллельно; всё, что меняет игру, — под её замком
+    app.add_handler(CommandHandler("start_game", serialized(start_game)))
+    app.add_handler(CommandHandler("start", serialized(join_start)))
+    app.add_handler(CallbackQueryHandler(serialized(callback_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.REPLY, serialized(set_jury_text_handler)))
+    app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, photo_handler))  # замок берёт сам
+    app.add_handler(MessageHandler((filters.REPLY) & (filters.TEXT | filters.CAPTION), serialized(reply_on_photo_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & filters.REPLY, serialized(reply_on_photo_handler)))
+    app.add_handler(CommandHandler("call_people", serialized(call_people)))  # читает pending_ids и заводит рассылку
+    # Команды только на чтение — без замка
     app.add_handler(CommandHandler("check_photos_handler", check_photos_handler))
     app.add_handler(CommandHandler("check_photos", check_photos_handler))
     app.add_handler(CommandHandler("show_players", show_players))
+    app.add_handler(CommandHandler("standings", standings))
+    app.add_handler(CommandHandler("export", export_handler))
 
     app.add_error_handler(lambda update, context: print(f"Error: {context.error}"))
+    return app
+
+def run_app(app):
+    """Приём апдейтов: вебхук, если задан WEBHOOK_URL, иначе long polling."""
+    if WEBHOOK_URL:
+        print(f"Bot is running (webhook {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        print("Bot is running...")
+        app.run_polling()
+
+# -------------------- РЕЖИМ ВОРКЕРОВ --------------------
+worker_index = None  # номер этого процесса-обработчика; None — единственный процесс
+
+def worker_for_user(user_id):
+    """Обработчик, которому принадлежат игры ведущего user_id и куда идут апдейты незнакомых пользователей."""
+    return user_id % WORKERS
+
+def ipc_line(message):
+    return json.dumps(message, ensure_ascii=False).encode() + b"\n"
+
+class WorkerHub:
+    """Приёмный процесс: держит запущенными WORKERS обработчиков и раздаёт им апдейты по играм.
+
+    Обработчики подключаются к WORKER_SOCKET и сообщают, какие игры, ветки и
+    пользователи у них есть. По этим маршрутам апдейт уходит туда, где его
+    игра: нажатие кнопки — по game_id, сообщение в группе — по ветке, ЛС —
+    по пользователю, незнакомые — по user_id. Участник одной игры может
+    вести черновик другой на соседнем обработчике, поэтому маршруты
+    ведущих и участников раздельные: фото в ЛС идёт к игре участника,
+    остальное — к игре ведущего. Каждому обработчику апдейты
+    идут по одному соединению, поэтому порядок внутри игры сохраняется.
+    Упавший обработчик перезапускается и поднимает свои игры из базы, а его
+    апдейты ждут в очереди; заполненная очередь притормаживает приём.
+    При остановке приёмный процесс ждёт подтверждения всего отправленного,
+    а не дождавшиеся апдейты сохраняет в WORKER_BACKLOG до следующего запуска.
+    Обработчик подтверждает апдейт, когда его обработка закончена и
+    изменения сохранены в журнал и базу: неподтверждённые (в том числе
+    ждавшие в очереди упавшего) получит преемник. Общий лимит бота
+    обработчики делят поровну, а токены групп выдаёт приёмный процесс:
+    группа одна на все игры, и её лимит целиком достаётся тем, кто в неё
+    сейчас пишет. Отпечатки фото обработчики делят через базу: повтор
+    фото, принятого на соседнем обработчике, замечается через одну-две
+    записи на диск (DB_FLUSH_INTERVAL).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.routes = {"game": {}, "topic": {}, "host": {}, "player": {}}  # {вид: {ключ: номер обработчика}}
+        self.outbox = [asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(count)]
+        self.pending = [{} for _ in range(count)]  # {update_id: строка} — отправлено, но не подтверждено
+        self.writers = {}             # {номер: StreamWriter} подключённых обработчиков
+        self.server = None
+        self.tasks = []
+        self.stopping = False
+        self.group_limiter = PriorityRateLimiter()  # лимиты групп, одни на все обработчики
+
+    async def start(self, app):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(WORKER_SOCKET)
+        self.load_backlog()
+        await self.group_limiter.initialize()
+        self.server = await asyncio.start_unix_server(self.serve, WORKER_SOCKET)
+        self.tasks = [asyncio.create_task(self.supervise(index)) for index in range(self.count)]
+
+    async def stop(self, app):
+        # Апдейты, уже принятые у Telegram, сначала доходят до обработчиков и подтверждаются
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        while self.unacked() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.stopping = True
+        self.save_backlog()  # не успевшие — ждут следующего запуска
+        for writer in list(self.writers.values()):
+            writer.close()  # обработчик дочитает очередь, сохранит игры и выйдет
+        await asyncio.gather(*self.tasks)
+        await self.group_limiter.shutdown()
+        self.server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(WORKER_SOCKET)
+
+    def unacked(self):
+        return any(not outbox.empty() for outbox in self.outbox) or any(self.pending)
+
+    def save_backlog(self):
+        """Сохраняет неподтверждённые апдейты; следующий запуск отдаст их тем же обработчикам."""
+        entries = []
+        for index in range(self.count):
+            while not self.outbox[index].empty():
+                update_id, line = self.outbox[index].get_nowait()
+                self.pending[index][update_id] = line
+            for update_id, line in self.pending[index].items():
+                entries.append(ipc_line({"worker": index, "update_id": update_id, "update": json.loads(line)["update"]}))
+        if entries:
+            with open(WORKER_BACKLOG, "wb") as f:
+                f.writelines(entries)
+            print(f"Не подтверждено апдейтов: {len(entries)}, сохранены в {WORKER_BACKLOG}")
+
+    def load_backlog(self):
+        """Апдейты, не подтверждённые до прошлой остановки: уйдут обработчикам первыми."""
+        if not os.path.exists(WORKER_BACKLOG):
+            return
+        with open(WORKER_BACKLOG, "rb") as f:
+            for line in f:
+                entry = json.loads(line)
+                # Игры поднимаются на том же обработчике, пока не изменилось WORKERS
+                self.pending[entry["worker"] % self.count][entry["update_id"]] = ipc_line({"update": entry["update"]})
+        os.remove(WORKER_BACKLOG)
+
+    async def supervise(self, index):
+        """Держит обработчик запущенным: упавший перезапускается."""
+        spawn = multiprocessing.get_context("spawn")
+        while not self.stopping:
+            process = spawn.Process(target=worker_main, args=(index,), name=f"couture-worker-{index}")
+            process.start()
+            while process.is_alive() and not self.stopping:
+                await asyncio.sleep(0.5)
+            if self.stopping:
+                await asyncio.to_thread(process.join, 10)
+                if process.is_alive():
+                    process.terminate()
+                return
+            print(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапускаю")
+            await asyncio.sleep(1)
+
+    async def serve(self, reader, writer):
+        """Соединение с обработчиком: ему — апдейты, от него — маршруты."""
+        index = json.loads(await reader.readline())["worker"]
+        self.writers[index] = writer
+        writer.write(self.topics_line(index))
+        pump = asyncio.create_task(self.pump(index, writer))
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if "ack" in message:
+                    self.pending[index].pop(message["ack"], None)
+                elif "token" in message:
+                    run_in_background(self.grant(writer, *message["token"]))
+                elif "block" in message:
+                    chat_id, seconds = message["block"]
+                    self.group_limiter._bucket(chat_id).block(time.monotonic() + seconds)
+                else:
+                    self.learn(index, message["route"])
+        except ConnectionError:
+            pass
+        finally:
+            pump.cancel()
+            if self.writers.get(index) is writer:
+                del self.writers[index]
+            writer.close()
+
+    async def grant(self, writer, request_id, chat_id, priority):
+        """Выдаёт обработчику токен группы, когда до его запроса доходит очередь."""
+        await self.group_limiter._acquire(priority, chat_id)
+        writer.write(ipc_line({"granted": request_id}))
+
+    async def pump(self, index, writer):
+        pending = self.pending[index]
+        for line in pending.values():
+            writer.write(line)  # не дошедшее до упавшего предшественника
+        try:
+            while True:
+                update_id, line = await self.outbox[index].get()
+                pending[update_id] = line
+                writer.write(line)
+                await writer.drain()
+        except ConnectionError:
+            pass  # обработчик упал — неподтверждённое уйдёт его преемнику
+
+    def learn(self, index, route):
+        action, kind, key = route
+        if kind == "topic":
+            key = tuple(key)
+        table = self.routes[kind]
+        if action == "add":
+            table[key] = index
+        elif table.get(key) == index:
+            del table[key]
+        if kind == "topic":
+            for other, writer in self.writers.items():
+                writer.write(self.topics_line(other))
+
+    def topics_line(self, index):
+        """Ветки, занятые другими обработчиками: в них нельзя начать игру и о них нужно знать участникам."""
+        return ipc_line({"topics": [key for key, owner in self.routes["topic"].items() if owner != index]})
+
+    def worker_for(self, update):
+        routes = self.routes
+        user = update.effective_user
+        if update.callback_query:
+            parsed = unpack_callback(update.callback_query.data)
+            if parsed and parsed[1] in routes["game"]:
+                return routes["game"][parsed[1]]
+        message = update.effective_message
+        text = (message.text or "") if message else ""
+        if message and message.chat.type != "private":
+            owner = routes["topic"].get(topic_key(message.chat_id, message.message_thread_id))
+            if owner is not None:
+                return owner
+        elif text.startswith("/start join_") and user:
+            # Ссылка «Прислать фото»: дальше участник пишет обработчику этой ветки
+            topic = text.split("join_", 1)[1]
+            owner = routes["topic"].get(topic_key(MAIN_CHAT_ID, topic)) if topic.isdigit() else None
+            if owner is not None:
+                routes["player"][user.id] = owner
+                return owner
+        if user is None:
+            return 0
+        if text.startswith("/start_game"):
+            return worker_for_user(user.id)  # там же игра поднимется после перезапуска
+        order = ("player", "host") if message and message.photo else ("host", "player")
+        for kind in order:
+            if user.id in routes[kind]:
+                return routes[kind][user.id]
+        if message and message.chat.type == "private" and len(routes["topic"]) == 1:
+            return next(iter(routes["topic"].values()))  # единственная игра примет фото нового участника
+        return worker_for_user(user.id)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        line = ipc_line({"update": update.to_dict()})
+        await self.outbox[self.worker_for(update)].put((update.update_id, line))
+
+class AppliedUpdates:
+    """Апдейты, которые обработчик уже применил: после падения приёмный процесс пришлёт их снова.
+
+    upto — применены все апдейты до него включительно; above — применённые
+    позже, пока более ранние ещё обрабатываются (апдейты идут параллельно).
+    """
+
+    def __init__(self, upto=0, above=()):
+        self.upto = upto
+        self.above = set(above)
+        self.arrived = deque()  # полученные и ещё не вошедшие в upto, в порядке прихода
+
+    def seen(self, update_id):
+        return update_id <= self.upto or update_id in self.above
+
+    def arrive(self, update_id):
+        self.arrived.append(update_id)
+
+    def applied(self, update_id):
+        self.above.add(update_id)
+        while self.arrived and self.arrived[0] in self.above:
+            first = self.arrived.popleft()
+            self.above.discard(first)
+            self.upto = max(self.upto, first)
+
+class RemoteGroupTokens:
+    """Токены групповых чатов, которые обработчик получает у приёмного процесса."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.waiting = {}  # {номер запроса: Future}
+        self.seq = itertools.count()
+        self.closed = False
+
+    async def take(self, chat_id, priority):
+        if self.closed:
+            return
+        request_id = next(self.seq)
+        future = self.waiting[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(ipc_line({"token": [request_id, chat_id, priority]}))
+        try:
+            await future
+        finally:
+            self.waiting.pop(request_id, None)
+
+    def granted(self, request_id):
+        future = self.waiting.get(request_id)
+        if future and not future.done():
+            future.set_result(None)
+
+    def block(self, chat_id, seconds):
+        self.writer.write(ipc_line({"block": [chat_id, seconds]}))
+
+    def release(self):
+        """Соединение закрыто: запросы уходят без токена, на флуд-лимит ответит сам Telegram."""
+        self.closed = True
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_result(None)
+
+def worker_main(index):
+    """Процесс-обработчик index: свои игры, свой журнал и кэш фото, общая база."""
+    global journal, media, worker_index
+    worker_index = index
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # останавливает приёмный процесс, закрыв соединение
+    journal = GameJournal(f"{JOURNAL_PATH}.{index}")
+    media = MediaCache(os.path.join(MEDIA_CACHE_DIR, f"worker{index}"))
+    asyncio.run(run_worker(index))
+
+async def run_worker(index):
+    reader, writer = await asyncio.open_unix_connection(WORKER_SOCKET)
+    writer.write(ipc_line({"worker": index}))
+    games.listener = lambda action, kind, key: writer.write(ipc_line({"route": [action, kind, key]}))
+
+    store.open()
+    journal.open()
+    media.open()
+    restore_games(index)  # заодно сообщает приёмному процессу маршруты поднятых игр
+    applied = store.load_applied(index)
+
+    handled = []  # обработанные апдейты, чьи изменения ещё не на диске
+    held = []     # апдейты, пришедшие во время сброса на диск
+    checkpoint = asyncio.Lock()
+
+    async def ack(update, context):
+        handled.append(update.update_id)
+        applied.applied(update.update_id)
+        store.save_applied(index, applied)  # запишется одной транзакцией с изменёнными играми
+
+    async def feed(update):
+        applied.arrive(update.update_id)
+        await app.update_queue.put(update)
+
+    async def ack_saved():
+        """Сбрасывает игры на диск между апдейтами и подтверждает сохранённые.
+
+        Новые апдейты на это время придерживаются, а начатые дорабатывают:
+        в базу попадают игры ровно после применённых апдейтов вместе с их
+        списком (AppliedUpdates), и повтор после падения пропускается.
+        Подтверждённый апдейт приёмный процесс забывает, поэтому
+        подтверждать его до записи на диск нельзя.
+        """
+        async with checkpoint:
+            deadline = time.monotonic() + WORKER_CHECKPOINT_WAIT
+            while applied.arrived and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            count = len(handled)
+            saved = await journal.flush()
+            if await store.flush() and saved:
+                for update_id in handled[:count]:
+                    writer.write(ipc_line({"ack": update_id}))
+                del handled[:count]
+            # Иначе подтвердим после следующей удачной записи
+            while held:
+                await feed(held.pop(0))
+
+    async def ack_loop():
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            await ack_saved()
+
+    group_tokens = RemoteGroupTokens(writer)
+    app = build_app(rate_share=WORKERS, updater=False, group_tokens=group_tokens)
+    app.add_handler(TypeHandler(Update, ack), group=1)  # после всех обработчиков апдейта
+    async with app:
+        await on_startup(app)
+        await app.start()
+        run_in_background(share_prints())
+        run_in_background(ack_loop())
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if "topics" in message:
+                    games.remote_topics = {topic_key(*key) for key in message["topics"]}
+                elif "granted" in message:
+                    group_tokens.granted(message["granted"])
+                else:
+                    update = Update.de_json(message["update"], app.bot)
+                    if applied.seen(update.update_id):
+                        # Применён и сохранён до падения, подтвердить не успели
+                        writer.write(ipc_line({"ack": update.update_id}))
+                        continue
+                    if checkpoint.locked():
+                        held.append(update)
+                    else:
+                        await feed(update)
+        except ConnectionError:
+            pass
+        finally:
+            group_tokens.release()
+            await app.stop()
+            await ack_saved()
+            await on_shutdown(app)
+
+async def share_prints():
+    """Подхватывает отпечатки фото, принятых другими обработчиками."""
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        try:
+            photo_prints.load(await store.load_new_prints())
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения отпечатков фото: {e}")
+
+def run_ingress():
+    hub = WorkerHub(WORKERS)
+    app = new_builder().post_init(hub.start).post_shutdown(hub.stop).build()
+    app.add_handler(TypeHandler(Update, hub.route))
+    app.add_error_handler(lambda update, context: print(f"Error: {context.error}"))
+    print(f"Приёмный процесс, обработчиков: {WORKERS}")
+    run_app(app)
 
-    print("Bot is running...")
-    app.run_polling()
+# -------------------- MAIN --------------------
+async def on_startup(app):
+    if Image is None and (CONTACT_SHEET or NEAR_DUPLICATE_DISTANCE > 0):
+        print("Pillow не установлен: контактных листов и поиска похожих фото не будет (pip install -r requirements.txt).")
+    if worker_index is None:  # обработчик пишет на диск сам, между апдейтами (run_worker)
+        store.start()
+        journal.start()
+    # Досылаем рассылки, прерванные перезапуском (в режиме воркеров — только свои)
+    for job in store.load_broadcasts(worker_index):
+        run_in_background(job.run(app.bot))
+
+async def on_shutdown(app):
+    if _sheet_pool:
+        _sheet_pool.shutdown(cancel_futures=True)
+    await store.close()
+    await journal.close()
 
+if __name__ == "__main__":
+    # python botTG.py --audit <game_id> [user_id] — история оценок из журнала (и журналов обработчиков)
+    if len(sys.argv) > 2 and sys.argv[1] == "--audit":
+        target_user = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        print("\n".join(audit_scores(journal_paths(), sys.argv[2], target_user)) or "Оценок не найдено.")
+        sys.exit(0)
+
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        print("WEBHOOK_SECRET обязателен в режиме вебхука.")
+        sys.exit(1)
+
+    if WORKERS:
+        run_ingress()
+    else:
+        store.open()
+        journal.open()
+        media.open()
+        restore_games()
+        run_app(build_app())
@@ -0,0 +1,294 @@
+"""Стенд: прогон записанных апдейтов через бота без выхода в сеть.
+
+Поднимает на localhost поддельный Bot API, запускает botTG.py с
+BOT_API_URL на него и отдаёт боту апдейты из файла, записанного с
+RECORD_UPDATES (JSON на строку):
+
+    python replay_updates.py updates.jsonl --mode webhook
+    python replay_updates.py updates.jsonl --mode polling
+
+Задержка приёма — время от выдачи апдейта (POST на вебхук или появление
+в getUpdates) до первого запроса бота к API в чат этого апдейта. Если
+один чат шлёт апдейты пачкой, ответ на предыдущий может засчитаться
+следующему — для сравнения режимов это не важно. Для вебхука отдельно
+печатается время ответа на POST: оно растёт, когда очередь бота
+заполнена (противодавление).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qsl
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "botTG.py")
+WEBHOOK_SECRET = "replay-secret"
+
+# -------------------- HTTP --------------------
+async def read_request(reader):
+    """Читает один HTTP-запрос: (путь, заголовки, тело) или None, если соединение закрыто."""
+    line = await reader.readline()
+    if not line:
+        return None
+    _, path, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return path, headers, body
+
+def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+
+def parse_params(headers, body):
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return dict(parse_qsl(body.decode()))
+    return {}  # multipart с файлами — параметры стенду не нужны
+
+async def wait_listening(port, timeout):
+    """Ждёт, пока бот начнёт слушать порт вебхука: PTB ставит вебхук раньше, чем поднимает сервер."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+async def post_json(port, path, payload, headers):
+    """POST на вебхук бота, возвращает код ответа."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(payload).encode()
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(
+        f"POST /{path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n{head}\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+# -------------------- ПОДДЕЛЬНЫЙ BOT API --------------------
+class FakeBotApi:
+    """Отвечает на запросы бота правдоподобными объектами и запоминает, когда и в какой чат он писал."""
+
+    def __init__(self):
+        self.updates = []                # апдейты, ждущие getUpdates
+        self.has_updates = asyncio.Event()
+        self.ready = asyncio.Event()     # бот поставил вебхук или начал polling
+        self.calls = []                  # [(время, метод, chat_id)]
+        self.message_ids = itertools.count(1)
+
+    def message(self, chat_id):
+        chat_id = int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+        }
+
+    async def call(self, method, params):
+        self.calls.append((time.perf_counter(), method, str(params.get("chat_id"))))
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Couture", "username": "couture_bot"}
+        if method == "getUpdates":
+            self.ready.set()
+            if not self.updates:
+                try:
+                    await asyncio.wait_for(self.has_updates.wait(), float(params.get("timeout", 0)))
+                except asyncio.TimeoutError:
+                    pass
+            updates, self.updates = self.updates, []
+            self.has_updates.clear()
+            return updates
+        if method == "setWebhook":
+            self.ready.set()
+            return True
+        if method == "getChat":
+            return {"id": int(params["chat_id"]), "type": "private", "first_name": "Replay"}
+        if method == "sendMediaGroup":
+            media = params["media"]
+            media = json.loads(media) if isinstance(media, str) else media
+            return [self.message(params["chat_id"]) for _ in media]
+        if method.startswith(("send", "copy", "forward", "edit")):
+            return self.message(params.get("chat_id"))
+        return True
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                path, headers, body = request
+                result = await self.call(path.rsplit("/", 1)[-1], parse_params(headers, body))
+                write_response(writer, 200, {"ok": True, "result": result})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+# -------------------- ПРОГОН --------------------
+def update_chat_id(update):
+    for key in ("message", "edited_message", "channel_post"):
+        if key in update:
+            return str(update[key]["chat"]["id"])
+    query = update.get("callback_query")
+    if query and "message" in query:
+        return str(query["message"]["chat"]["id"])
+    return None
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    for update_id, update in enumerate(updates, start=1):
+        update["update_id"] = update_id
+    return updates
+
+def percentiles(values):
+    if not values:
+        return "—"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return f"p50 {pick(0.5) * 1000:.1f}, p95 {pick(0.95) * 1000:.1f}, max {values[-1] * 1000:.1f}"
+
+def bot_env(args, workdir):
+    """Окружение бота: поддельный Bot API, временная база и нужный режим приёма."""
+    env = dict(
+        os.environ,
+        BOT_TOKEN=os.getenv("BOT_TOKEN") or "1:replay",
+        BOT_API_URL=f"http://127.0.0.1:{args.api_port}",
+        DB_PATH=os.path.join(workdir, "replay.db"),
+        JOURNAL_PATH=os.path.join(workdir, "replay.journal"),
+        RECORD_UPDATES="",
+        WEBHOOK_URL="",
+    )
+    if args.mode == "webhook":
+        env.update(
+            WEBHOOK_URL=f"http://127.0.0.1:{args.webhook_port}",
+            WEBHOOK_SECRET=WEBHOOK_SECRET,
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(args.webhook_port),
+            WEBHOOK_PATH="telegram",
+        )
+    return env
+
+async def feed(args, api, updates):
+    """Отдаёт апдейты боту; возвращает [(время выдачи, chat_id)], время ответов на POST и число отказов."""
+    released, acks = [], []
+    rejected = 0
+    connections = asyncio.Semaphore(args.connections)
+
+    async def post(update):
+        nonlocal rejected
+        async with connections:
+            sent_at = time.perf_counter()
+            released.append((sent_at, update_chat_id(update)))
+            status = await post_json(
+                args.webhook_port, "telegram", update,
+                {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+            )
+            acks.append(time.perf_counter() - sent_at)
+            if status != 200:
+                rejected += 1
+
+    posts = []
+    for update in updates:
+        if args.mode == "webhook":
+            posts.append(asyncio.create_task(post(update)))
+        else:
+            released.append((time.perf_counter(), update_chat_id(update)))
+            api.updates.append(update)
+            api.has_updates.set()
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*posts)
+    return released, acks, rejected
+
+async def stop_bot(bot):
+    if bot.returncode is not None:
+        return
+    bot.terminate()
+    try:
+        await asyncio.wait_for(bot.wait(), 10)
+    except asyncio.TimeoutError:
+        bot.kill()
+        await bot.wait()
+
+async def replay(args):
+    api = FakeBotApi()
+    server = await asyncio.start_server(api.handle, "127.0.0.1", args.api_port)
+    updates = load_updates(args.file)
+    workdir = tempfile.mkdtemp(prefix="couture-replay-")
+
+    output = None if args.verbose else asyncio.subprocess.DEVNULL
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, BOT_PATH, env=bot_env(args, workdir), stdout=output, stderr=output
+    )
+    try:
+        # Ждём, пока бот поставит вебхук или начнёт polling — или упадёт
+        ready = asyncio.create_task(api.ready.wait())
+        exited = asyncio.create_task(bot.wait())
+        await asyncio.wait({ready, exited}, timeout=args.startup_timeout, return_when=asyncio.FIRST_COMPLETED)
+        ready.cancel()
+        exited.cancel()
+        if not api.ready.is_set():
+            sys.exit(f"Бот не запустился за {args.startup_timeout}с (запустите с --verbose).")
+        if args.mode == "webhook":
+            await wait_listening(args.webhook_port, args.startup_timeout)
+
+        started = time.perf_counter()
+        released, acks, rejected = await feed(args, api, updates)
+        fed_in = time.perf_counter() - started
+        await asyncio.sleep(args.settle)
+    finally:
+        await stop_bot(bot)
+        api.has_updates.set()  # отпускаем getUpdates, который ждал уже остановленный бот
+        server.close()
+        await asyncio.sleep(0.1)
+
+    latencies = []
+    for released_at, chat_id in released:
+        answered = next((t for t, _, call_chat in api.calls if t >= released_at and call_chat == chat_id), None)
+        if answered is not None:
+            latencies.append(answered - released_at)
+
+    print(f"Режим: {args.mode}, апдейтов: {len(updates)}, выдано за {fed_in:.2f}с")
+    print(f"Задержка приёма, мс: {percentiles(latencies)} (с ответом бота: {len(latencies)} из {len(updates)})")
+    if args.mode == "webhook":
+        print(f"Ответ на POST вебхука, мс: {percentiles(acks)}; не 200: {rejected}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон записанных апдейтов через бота на локальном поддельном Bot API.")
+    parser.add_argument("file", help="апдейты, записанные с RECORD_UPDATES")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (0 — без пауз)")
+    parser.add_argument("--connections", type=int, default=40, help="одновременных POST на вебхук, как max_connections")
+    parser.add_argument("--settle", type=float, default=3, help="секунд на дообработку после последнего апдейта")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument("--startup-timeout", type=float, default=20)
+    parser.add_argument("--verbose", action="store_true", help="показывать вывод бота")
+    asyncio.run(replay(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()